@@ -2,24 +2,49 @@ import os
 import logging
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
-from aiogram.fsm.storage.memory import MemoryStorage 
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, BufferedInputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, BufferedInputFile, FSInputFile, InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
 from aiogram.filters import Command
 from aiogram import F
-from PIL import Image
-import io
 import asyncio
-import psycopg2
-from psycopg2 import sql
+import signal
+import uuid
+import hmac
+import csv
+import tempfile
+from contextlib import aclosing
 from datetime import datetime
 import html # Імпортуємо модуль html для екранування
-from aiogram.exceptions import TelegramAPIError # Імпортуємо для обробки помилок API
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError # Імпортуємо для обробки помилок API
 
 # Для Aiohttp Webhook
 from aiohttp import web
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+from cache import TTLCache
+from db import (
+    database, add_product_to_db,
+    get_product_by_id, get_product_with_photos, get_user_products, update_product_status, update_product_moderator_message_id,
+    delete_product_from_db, update_product_price, increment_product_republish_count, update_product_photos_in_db,
+    enqueue_product_publication, replace_photo_hashes, get_photo_hashes, find_photo_hash_candidates,
+    search_products, get_search_facets,
+    mark_product_sold, stream_commission_report, get_commission_totals, mark_commissions_paid, COMMISSION_PERIODS,
+)
+from fsm_storage import PostgresStorage
+from migrations import run_migrations
+from workers import WEB_CONCURRENCY, PostgresEventIsolation, run_workers
+from update_scheduler import UpdateScheduler, ScheduledRequestHandler
+from rate_limiter import RateLimiterMiddleware
+from outbox import ChannelOutbox
+from jobs import JobQueue
+from exchange_rates import ExchangeRates
+from image_service import image_service
+from image_cache import image_cache
+from prices import parse_price, format_amount
+from search import SEARCH_CONFIG, PrefixResultCache, parse_search_query, search_cache_key
+from image_hash import DUPLICATE_PHOTO_DISTANCE, chunk_probes, to_signed, to_unsigned
 
 # Завантажуємо змінні оточення з файлу .env
 load_dotenv()
@@ -42,11 +67,29 @@ CHANNEL_ID = int(CHANNEL_ID_STR) if CHANNEL_ID_STR.strip().lstrip('-').isdigit()
 MONOBANK_CARD_NUMBER = "4441111153021484" 
 
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") 
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "") # Токен для /metrics (заголовок Authorization: Bearer <токен>); без нього /metrics вимкнено
+
+# Де зберігати стани FSM: "postgres" (за замовчуванням, переживає перезапуск) або "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres").strip().lower()
 
 # Конфігурація комісії та курсів
 COMMISSION_RATE = 0.10 # 10% комісія
-USD_TO_UAH_RATE = 40 # Приблизний курс USD до UAH
 MAX_REPUBLISH_COUNT = 3 # Максимальна кількість переопублікацій
+MAX_DUPLICATES_IN_CAPTION = 3 # Скільки можливих дублікатів показувати модератору
+MY_PRODUCTS_PAGE_SIZE = 5 # Кількість товарів на одній сторінці "Мої товари"
+MY_PRODUCTS_CACHE_TTL = 120 # Скільки секунд зберігати сторінки "Мої товари" в кеші
+SEARCH_PAGE_SIZE = 10 # Скільки результатів пошуку показувати за раз
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 60)) # Скільки секунд зберігати результати пошуку в кеші
+INLINE_PAGE_SIZE = 20 # Результатів на одну сторінку інлайн-пошуку (Telegram дозволяє до 50)
+INLINE_CANDIDATES = 100 # Скільки перших результатів інлайн-запиту зберігати в кеші префіксів
+INLINE_SHORT_QUERY_CACHE_TIME = 300 # cache_time для коротких запитів (1-3 символи): їх набирають усі, результати майже не змінюються
+INLINE_CAPTION_LIMIT = 1024 # Ліміт Telegram на підпис фото в результаті інлайн-пошуку
+INLINE_MESSAGE_LIMIT = 4096 # Ліміт Telegram на текст повідомлення в результаті інлайн-пошуку
+
+# Автоматичне виправлення орієнтації фото, надісланих файлом (документом): EXIF Orientation застосовується у фоновій задачі
+AUTO_ORIENT_PHOTOS = os.getenv("AUTO_ORIENT_PHOTOS", "false").strip().lower() == "true"
+PHOTO_BUFFER_CHAT_ID = int(os.getenv("PHOTO_BUFFER_CHAT_ID", 0)) # Службовий чат для отримання file_id оброблених фото (0 — чат користувача)
+PENDING_PHOTO_PREFIX = "pending:" # Позначка фото, яке ще обробляється, у списку фото чернетки
 
 # Перевірка на наявність критичних змінних
 if not BOT_TOKEN:
@@ -62,11 +105,38 @@ if not WEBHOOK_URL:
     logging.warning("⚠️ WEBHOOK_URL не встановлено. Webhook може не працювати належним чином.")
 if not os.getenv("DATABASE_URL"):
     logging.error("❌ DATABASE_URL не встановлено. Функціонал бази даних буде недоступний.")
+if WEB_CONCURRENCY > 1 and (FSM_STORAGE != "postgres" or not os.getenv("DATABASE_URL")):
+    logging.error("❌ WEB_CONCURRENCY > 1 потребує FSM_STORAGE=postgres і DATABASE_URL. Бот буде запущено в одному процесі.")
+    WEB_CONCURRENCY = 1
 
 
 # Ініціалізація бота та диспетчера
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Усі вихідні запити проходять через ліміти Telegram (загальний, на чат і на канал)
+rate_limiter = RateLimiterMiddleware()
+bot.session.middleware(rate_limiter)
+# Повільні дії (поворот фото, надсилання на модерацію, сповіщення) виконуються у фонових задачах
+job_queue = JobQueue(database)
+# Курси валют для комісії оновлюються у фоні; EXCHANGE_RATE_PROVIDER=file/stub — без мережі
+exchange_rates = ExchangeRates(database)
+if FSM_STORAGE == "postgres" and os.getenv("DATABASE_URL"):
+    fsm_storage = PostgresStorage(database)
+    if WEB_CONCURRENCY > 1:
+        # Кілька процесів: оновлення одного користувача серіалізуються блокуванням у БД
+        dp = Dispatcher(storage=fsm_storage, events_isolation=PostgresEventIsolation(database, fsm_storage))
+    else:
+        # Один процес: блокування в пам'яті. Без нього (DisabledEventIsolation) фонові задачі,
+        # що змінюють стан модератора, могли б затерти зміни обробників
+        dp = Dispatcher(storage=fsm_storage, events_isolation=SimpleEventIsolation())
+else:
+    dp = Dispatcher(storage=MemoryStorage(), events_isolation=SimpleEventIsolation())
+
+# Кеш сторінок "Мої товари": user_id -> {'cursors': [...], 'pages': {номер: товари}}
+my_products_pages = TTLCache(maxsize=10000, ttl=MY_PRODUCTS_CACHE_TTL)
+# Кеш результатів пошуку: нормалізований запит -> (товари, чи є ще, фасети)
+search_results = TTLCache(maxsize=5000, ttl=SEARCH_CACHE_TTL)
+# Кеш інлайн-пошуку за текстом запиту (з фільтрацією результатів коротшого префікса)
+inline_results = PrefixResultCache(maxsize=5000, ttl=SEARCH_CACHE_TTL)
 
 # Створення станів для FSM
 class NewProduct(StatesGroup):
@@ -85,279 +155,6 @@ class ModeratorActions(StatesGroup):
 class ChangingPrice(StatesGroup):
     new_price = State()
 
-# --- База даних ---
-def get_db_connection():
-    """Встановлює з'єднання з базою даних PostgreSQL."""
-    database_url = os.getenv("DATABASE_URL")
-    if not database_url:
-        logging.error("DATABASE_URL не встановлено. Неможливо підключитися до бази даних.")
-        raise ValueError("DATABASE_URL environment variable is not set.")
-    conn = psycopg2.connect(database_url)
-    return conn
-
-async def init_db():
-    """Ініціалізує таблиці в базі даних, якщо вони не існують."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Ці рядки були видалені, щоб запобігти втраті даних при кожному запуску.
-        # cur.execute("DROP TABLE IF EXISTS product_photos CASCADE;")
-        # cur.execute("DROP TABLE IF EXISTS products CASCADE;")
-
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS products (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                username TEXT,
-                name TEXT NOT NULL,
-                price TEXT NOT NULL,
-                photos TEXT[],
-                location TEXT,
-                description TEXT NOT NULL,
-                delivery TEXT NOT NULL,
-                status TEXT DEFAULT 'moderation',
-                moderator_message_id BIGINT,
-                channel_message_id BIGINT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                published_at TIMESTAMP,
-                views INT DEFAULT 0,
-                republish_count INT DEFAULT 0
-            );
-            CREATE TABLE IF NOT EXISTS product_photos (
-                id SERIAL PRIMARY KEY,
-                product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
-                file_id TEXT NOT NULL,
-                photo_index INTEGER NOT NULL
-            );
-        """)
-        conn.commit()
-        logging.info("✅ База даних ініціалізована успішно.")
-    except Exception as e:
-        logging.error(f"❌ Помилка ініціалізації бази даних: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-async def add_product_to_db(user_id: int, username: str, name: str, price: str, location: str, description: str, delivery: str):
-    """Додає новий товар до бази даних."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """INSERT INTO products (user_id, username, name, price, location, description, delivery)
-               VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;""",
-            (user_id, username, name, price, location, description, delivery)
-        )
-        product_id = cur.fetchone()[0]
-        conn.commit()
-        return product_id
-    except Exception as e:
-        logging.error(f"❌ Помилка додавання товару до БД: {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
-
-async def add_product_photo_to_db(product_id: int, file_id: str, photo_index: int):
-    """Додає фотографію до товару в базі даних."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """INSERT INTO product_photos (product_id, file_id, photo_index)
-               VALUES (%s, %s, %s);""",
-            (product_id, file_id, photo_index)
-        )
-        conn.commit()
-    except Exception as e:
-        logging.error(f"❌ Помилка додавання фото до БД: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-async def get_product_photos_from_db(product_id: int):
-    """Отримує список file_id фотографій для товару."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """SELECT file_id FROM product_photos WHERE product_id = %s ORDER BY photo_index;""",
-            (product_id,)
-        )
-        photos = [row[0] for row in cur.fetchall()]
-        return photos
-    except Exception as e:
-        logging.error(f"❌ Помилка отримання фото з БД: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
-
-async def get_product_by_id(product_id: int):
-    """Отримує інформацію про товар за його ID."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM products WHERE id = %s;", (product_id,))
-        product = cur.fetchone()
-        if product:
-            column_names = [desc[0] for desc in cur.description]
-            return dict(zip(column_names, product))
-        return None
-    except Exception as e:
-        logging.error(f"❌ Помилка отримання товару за ID: {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
-
-async def get_user_products(user_id: int):
-    """Отримує список товарів користувача."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, name, price, status, created_at, views, republish_count FROM products WHERE user_id = %s ORDER BY created_at DESC;", (user_id,))
-        products = []
-        for row in cur.fetchall():
-            products.append({
-                'id': row[0],
-                'name': row[1],
-                'price': row[2],
-                'status': row[3],
-                'created_at': row[4],
-                'views': row[5],
-                'republish_count': row[6]
-            })
-        return products
-    except psycopg2.ProgrammingError as e:
-        logging.error(f"❌ Помилка отримання товарів користувача: {e}")
-        logging.error("Можливо, схема бази даних не відповідає очікуваній. Спробуйте перезапустити бота.")
-        return []
-    except Exception as e:
-        logging.error(f"❌ Помилка отримання товарів користувача: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
-
-async def update_product_status(product_id: int, status: str, channel_message_id: int = None):
-    """Оновлює статус товару."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        if status == 'published' and channel_message_id:
-            cur.execute(
-                """UPDATE products SET status = %s, published_at = CURRENT_TIMESTAMP, channel_message_id = %s WHERE id = %s;""",
-                (status, channel_message_id, product_id)
-            )
-        else:
-            cur.execute(
-                """UPDATE products SET status = %s WHERE id = %s;""",
-                (status, product_id)
-            )
-        conn.commit()
-    except Exception as e:
-        logging.error(f"❌ Помилка оновлення статусу товару: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-async def update_product_moderator_message_id(product_id: int, message_id: int):
-    """Оновлює ID повідомлення модератору для товару."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """UPDATE products SET moderator_message_id = %s WHERE id = %s;""",
-            (message_id, product_id)
-        )
-        conn.commit()
-    except Exception as e:
-        logging.error(f"❌ Помилка оновлення ID повідомлення модератору: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-async def delete_product_from_db(product_id: int):
-    """Видаляє товар з бази даних."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM products WHERE id = %s;", (product_id,))
-        conn.commit()
-    except Exception as e:
-        logging.error(f"❌ Помилка видалення товару з БД: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-async def update_product_price(product_id: int, new_price: str):
-    """Оновлює ціну товару."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """UPDATE products SET price = %s WHERE id = %s;""",
-            (new_price, product_id)
-        )
-        conn.commit()
-    except Exception as e:
-        logging.error(f"❌ Помилка оновлення ціни товару: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-async def increment_product_republish_count(product_id: int):
-    """Збільшує лічильник переопублікацій товару."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """UPDATE products SET republish_count = republish_count + 1 WHERE id = %s RETURNING republish_count;""",
-            (product_id,)
-        )
-        new_count = cur.fetchone()[0]
-        conn.commit()
-        return new_count
-    except Exception as e:
-        logging.error(f"❌ Помилка збільшення лічильника переопублікацій: {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
-
-async def update_product_photos_in_db(product_id: int, new_file_ids: list):
-    """Оновлює фотографії товару в базі даних."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM product_photos WHERE product_id = %s;", (product_id,))
-        for i, file_id in enumerate(new_file_ids):
-            cur.execute(
-                """INSERT INTO product_photos (product_id, file_id, photo_index)
-                   VALUES (%s, %s, %s);""",
-                (product_id, file_id, i)
-            )
-        conn.commit()
-    except Exception as e:
-        logging.error(f"❌ Помилка оновлення фотографій товару в БД: {e}")
-    finally:
-        if conn:
-            conn.close()
-
 # --- Допоміжні функції ---
 def get_main_menu_keyboard():
     """Повертає клавіатуру головного меню."""
@@ -373,21 +170,42 @@ def get_product_moderation_keyboard(product_id: int):
     keyboard_buttons = [
         [InlineKeyboardButton(text="✅ Опублікувати", callback_data=f"publish_product_{product_id}")],
         [InlineKeyboardButton(text="❌ Відхилити", callback_data=f"reject_product_{product_id}")],
-        [InlineKeyboardButton(text="🔄 Повернути фото", callback_data=f"rotate_photos_{product_id}")]
+        [InlineKeyboardButton(text="🔄 Повернути фото", callback_data=f"rotate_photos_{product_id}")],
+        [InlineKeyboardButton(text="🔄 Повернути всі фото (сітка)", callback_data=f"rotate_all_photos_{product_id}")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
-def get_product_actions_keyboard(product_id: int, channel_message_id: int, republish_count: int):
+def get_channel_post_url(channel_message_id: int) -> str:
+    """Посилання на пост товару в каналі."""
+    channel_short_id = str(CHANNEL_ID).replace('-100', '')
+    return f"https://t.me/c/{channel_short_id}/{channel_message_id}"
+
+def get_product_actions_keyboard(product_id: int, channel_message_id: int, republish_count: int, back_page: int = None):
     """Повертає клавіатуру дій для користувача в розділі "Мої товари"."""
     buttons = []
     if channel_message_id and CHANNEL_ID != 0:
-        channel_short_id = str(CHANNEL_ID).replace('-100', '')
-        buttons.append([InlineKeyboardButton(text="👁 Переглянути в каналі", url=f"https://t.me/c/{channel_short_id}/{channel_message_id}")]) 
+        buttons.append([InlineKeyboardButton(text="👁 Переглянути в каналі", url=get_channel_post_url(channel_message_id))])
     if republish_count < MAX_REPUBLISH_COUNT: # Використання константи
         buttons.append([InlineKeyboardButton(text="🔁 Переопублікувати", callback_data=f"republish_product_{product_id}")])
     buttons.append([InlineKeyboardButton(text="✅ Продано", callback_data=f"sold_product_{product_id}")])
     buttons.append([InlineKeyboardButton(text="✏ Змінити ціну", callback_data=f"change_price_{product_id}")])
     buttons.append([InlineKeyboardButton(text="🗑 Видалити", callback_data=f"delete_product_{product_id}")])
+    if back_page is not None:
+        buttons.append([InlineKeyboardButton(text="⬅️ До списку", callback_data=f"my_products_page_{back_page}")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def get_my_products_page_keyboard(products: list, page: int, has_next: bool):
+    """Повертає клавіатуру сторінки "Мої товари": кнопка на кожен товар і навігація."""
+    buttons = []
+    for i, product in enumerate(products, start=page * MY_PRODUCTS_PAGE_SIZE + 1):
+        buttons.append([InlineKeyboardButton(text=f"{i}. {product['name'][:40]}", callback_data=f"product_actions_{page}_{product['id']}")])
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"my_products_page_{page - 1}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"my_products_page_{page + 1}"))
+    if navigation:
+        buttons.append(navigation)
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 def get_photo_rotation_keyboard(product_id: int, photo_index: int):
@@ -397,6 +215,22 @@ def get_photo_rotation_keyboard(product_id: int, photo_index: int):
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
+def get_photo_rotation_grid_keyboard(product_id: int, photos_count: int, rotations: dict):
+    """Повертає сітку кутів повороту для всіх фото товару: натискання на фото додає 90°."""
+    buttons = []
+    row = []
+    for index in range(photos_count):
+        degrees = rotations.get(str(index), 0)
+        row.append(InlineKeyboardButton(text=f"{index + 1}: {degrees}°" if degrees else f"{index + 1}: —", callback_data=f"rotate_grid_{product_id}_{index}"))
+        if len(row) == 4:
+            buttons.append(row)
+            row = []
+    if row:
+        buttons.append(row)
+    buttons.append([InlineKeyboardButton(text="🔃 Застосувати повороти", callback_data=f"apply_rotation_grid_{product_id}")])
+    buttons.append([InlineKeyboardButton(text="✅ Готово", callback_data=f"done_rotating_photos_{product_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 def get_photo_rotation_done_keyboard(product_id: int):
     """Повертає клавіатуру "Готово" після редагування фото."""
     keyboard_buttons = [
@@ -404,16 +238,20 @@ def get_photo_rotation_done_keyboard(product_id: int):
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
-async def send_product_to_moderation(product_id: int, user_id: int, username: str):
-    """Надсилає товар модераторам для перевірки."""
-    product = await get_product_by_id(product_id)
+async def send_product_to_moderation(product_id: int, user_id: int, username: str, product: dict = None):
+    """
+    Надсилає товар модераторам для перевірки.
+    product — вже завантажений товар з фото (get_product_with_photos), щоб не читати його повторно.
+    Викликається з фонової задачі send_to_moderation: помилка Telegram призводить до повторної спроби.
+    """
+    if product is None:
+        product = await get_product_with_photos(product_id)
     if not product:
         logging.error(f"Товар з ID {product_id} не знайдено для модерації.")
         return
 
-    photos_file_ids = await get_product_photos_from_db(product_id)
     media_group = []
-    for file_id in photos_file_ids:
+    for file_id in product['photo_file_ids']:
         media_group.append(InputMediaPhoto(media=file_id))
 
     caption = (
@@ -427,44 +265,305 @@ async def send_product_to_moderation(product_id: int, user_id: int, username: st
     escaped_username = html.escape(username) if username else None
     if product['location']:
         caption += f"📍 Геолокація: {html.escape(product['location'])}\n"
+    duplicates = await find_duplicate_products(product_id)
+    if duplicates:
+        caption += "⚠️ <b>Можливий дублікат:</b>\n"
+        for duplicate in duplicates[:MAX_DUPLICATES_IN_CAPTION]:
+            caption += f"  • #{duplicate['product_id']} «{html.escape(duplicate['name'])}» ({duplicate['status']}), схожих фото: {duplicate['photos']}\n"
     caption += f"👤 Продавець: @{escaped_username}" if escaped_username else f"👤 Продавець: <a href='tg://user?id={user_id}'>{user_id}</a>"
 
-    try:
-        if not ADMIN_IDS:
-            logging.error("Немає ADMIN_IDS для надсилання на модерацію. Повідомлення не буде надіслано модераторам.")
-            await bot.send_message(user_id, "Наразі модератори недоступні. Спробуйте пізніше.")
-            return
+    if not ADMIN_IDS:
+        logging.error("Немає ADMIN_IDS для надсилання на модерацію. Повідомлення не буде надіслано модераторам.")
+        await bot.send_message(user_id, "Наразі модератори недоступні. Спробуйте пізніше.")
+        return
 
-        # Відправляємо медіа-групу модератору
-        # Розбиваємо на групи по 10 фото, якщо їх більше
-        if media_group:
-            media_group[0].caption = caption
-            media_group[0].parse_mode = 'HTML' 
-            
-            for i in range(0, len(media_group), 10):
-                chunk = media_group[i:i+10]
-                await bot.send_media_group(
-                    chat_id=ADMIN_IDS[0],
-                    media=chunk
-                )
-        else:
-            await bot.send_message(
+    # Відправляємо медіа-групу модератору
+    # Розбиваємо на групи по 10 фото, якщо їх більше
+    if media_group:
+        media_group[0].caption = caption
+        media_group[0].parse_mode = 'HTML' 
+        
+        for i in range(0, len(media_group), 10):
+            chunk = media_group[i:i+10]
+            await bot.send_media_group(
                 chat_id=ADMIN_IDS[0],
-                text=caption,
-                parse_mode='HTML' 
+                media=chunk
             )
-
-        # Відправляємо окреме повідомлення з кнопками модерації
-        moderator_keyboard_message = await bot.send_message(
+    else:
+        await bot.send_message(
             chat_id=ADMIN_IDS[0],
-            text="Оберіть дію для товару:",
-            reply_markup=get_product_moderation_keyboard(product_id)
+            text=caption,
+            parse_mode='HTML' 
         )
-        await update_product_moderator_message_id(product_id, moderator_keyboard_message.message_id)
 
-        logging.info(f"✅ Товар {product_id} надіслано на модерацію.")
+    # Відправляємо окреме повідомлення з кнопками модерації
+    moderator_keyboard_message = await bot.send_message(
+        chat_id=ADMIN_IDS[0],
+        text="Оберіть дію для товару:",
+        reply_markup=get_product_moderation_keyboard(product_id)
+    )
+    await update_product_moderator_message_id(product_id, moderator_keyboard_message.message_id)
+
+    logging.info(f"✅ Товар {product_id} надіслано на модерацію.")
+
+async def find_duplicate_products(product_id: int) -> list:
+    """
+    Шукає товари зі схожими фото за перцептивними хешами (таблиця photo_hashes).
+    Кандидати вибираються за індексами частин хеша, тож пошук не перебирає всю таблицю.
+    Повертає [{'product_id', 'name', 'status', 'photos', 'distance'}, ...] — найсхожіші першими.
+    """
+    own_hashes = [row['hash'] for row in await get_photo_hashes(product_id)]
+    if not own_hashes:
+        return []
+    duplicates = {}
+    probes = chunk_probes([to_unsigned(value) for value in own_hashes])
+    for candidate in await find_photo_hash_candidates(product_id, own_hashes, probes, DUPLICATE_PHOTO_DISTANCE):
+        distance = candidate['distance']
+        duplicate = duplicates.setdefault(candidate['product_id'], {
+            'product_id': candidate['product_id'], 'name': candidate['name'], 'status': candidate['status'],
+            'photos': 0, 'distance': distance
+        })
+        duplicate['photos'] += 1
+        duplicate['distance'] = min(duplicate['distance'], distance)
+    return sorted(duplicates.values(), key=lambda d: (d['distance'], -d['photos']))
+
+
+# --- Фонові задачі ---
+@job_queue.job("fingerprint_photos", concurrency=2, max_attempts=3)
+async def fingerprint_photos_job(job: dict):
+    """
+    Обчислює перцептивні хеші фото товару (у пулі процесів) і ставить товар у чергу на модерацію,
+    де за хешами позначаються можливі дублікати. Якщо фото так і не вдалося обробити — товар
+    однаково надсилається на модерацію, просто без перевірки на дублікати.
+    """
+    product = await get_product_with_photos(job['payload']['product_id'])
+    if not product or product['status'] != 'moderation':
+        return
+    try:
+        digests = await asyncio.gather(*(process_telegram_image(file_id, "dhash") for file_id in product['photo_file_ids']))
+        if not await replace_photo_hashes(product['id'], [to_signed(int.from_bytes(digest, 'big')) for digest in digests]):
+            raise RuntimeError("хеші не збережено")
     except Exception as e:
-        logging.error(f"❌ Помилка надсилання товару на модерацію: {e}")
+        if job['attempts'] < job['max_attempts']:
+            raise
+        logging.warning(f"⚠️ Не вдалося обчислити хеші фото товару {product['id']}: {e}")
+    if await job_queue.enqueue("send_to_moderation", {"product_id": product['id']}) is None:
+        raise RuntimeError("не вдалося поставити товар у чергу модерації")
+
+@job_queue.job("send_to_moderation", concurrency=3, max_attempts=5)
+async def send_to_moderation_job(job: dict):
+    """Надсилає товар модераторам (після створення, переопублікації, зміни ціни або фото)."""
+    product = await get_product_with_photos(job['payload']['product_id'])
+    if not product or product['status'] != 'moderation':
+        return # Товар видалено або вже опрацьовано
+    await send_product_to_moderation(product['id'], product['user_id'], product['username'], product=product)
+
+@job_queue.job("notify_user", concurrency=10, max_attempts=5)
+async def notify_user_job(job: dict):
+    """Надсилає сповіщення користувачу (продавцю або модератору)."""
+    payload = job['payload']
+    try:
+        await bot.send_message(
+            payload['chat_id'],
+            payload['text'],
+            parse_mode=payload.get('parse_mode'),
+            reply_markup=get_main_menu_keyboard() if payload.get('main_menu') else None
+        )
+    except TelegramForbiddenError:
+        logging.warning(f"Користувач {payload['chat_id']} заблокував бота, сповіщення не надіслано.")
+
+async def notify_user(chat_id: int, text: str, parse_mode: str = None, main_menu: bool = False):
+    """Ставить сповіщення користувачу в чергу фонових задач."""
+    await job_queue.enqueue("notify_user", {"chat_id": chat_id, "text": text, "parse_mode": parse_mode, "main_menu": main_menu})
+
+async def download_telegram_file(file_id: str) -> bytes:
+    """Повертає вміст файлу Telegram за file_id: з дискового кешу або завантаженням через Bot API."""
+    file_info = None
+    file_unique_id = image_cache.resolve(file_id)
+    if file_unique_id is None:
+        file_info = await bot.get_file(file_id)
+        file_unique_id = file_info.file_unique_id
+        image_cache.remember(file_id, file_unique_id)
+    data = await image_cache.get(file_unique_id)
+    if data is None:
+        file_info = file_info or await bot.get_file(file_id)
+        downloaded_file = await bot.download_file(file_info.file_path)
+        data = downloaded_file.read()
+        await image_cache.put(file_unique_id, data)
+    return data
+
+async def process_telegram_image(file_id: str, operation: str, **kwargs) -> bytes:
+    """
+    Виконує операцію image_service над файлом Telegram.
+    Результат кешується як похідний варіант оригіналу (наприклад, rotate90), тож повторна операція
+    з тими самими параметрами не завантажує і не обробляє фото знову.
+    """
+    variant = operation + "".join(f"-{key}{value}" for key, value in sorted(kwargs.items()))
+    file_unique_id = image_cache.resolve(file_id)
+    if file_unique_id is not None:
+        cached = await image_cache.get(file_unique_id, variant)
+        if cached is not None:
+            return cached
+    result = await image_service.run(operation, await download_telegram_file(file_id), **kwargs)
+    await image_cache.put(image_cache.resolve(file_id), result, variant)
+    return result
+
+@job_queue.job("rotate_photo", concurrency=2, max_attempts=3)
+async def rotate_photo_job(job: dict):
+    """
+    Повертає одне фото товару: завантаження, поворот, відправка модератору для нового file_id.
+    Поворот завжди застосовується до оригінального фото на сумарний кут (payload['degrees']),
+    тому кілька натискань не накопичують втрати якості, а чотири повертають оригінал без обробки.
+    Новий file_id записується в стан FSM модератора (режим редагування фото).
+    """
+    payload = job['payload']
+    product_id, photo_index, degrees = payload['product_id'], payload['photo_index'], payload['degrees']
+    key = StorageKey(bot_id=bot.id, chat_id=payload['chat_id'], user_id=payload['user_id'])
+    state = FSMContext(storage=dp.fsm.storage, key=key)
+
+    new_file_id = None
+    try:
+        if degrees == 0:
+            # Повний оберт — повертаємо оригінал без завантаження і перекодування
+            await bot.send_photo(chat_id=payload['chat_id'], photo=payload['file_id'], caption=f"Повернуте фото {photo_index + 1} (оригінал)")
+            new_file_id = payload['file_id']
+        else:
+            # Декодування/кодування виконується в пулі процесів і не блокує інші оновлення
+            rotated = await process_telegram_image(payload['file_id'], "rotate", degrees=degrees)
+
+            # Надсилаємо повернуте фото назад модератору, щоб отримати новий file_id
+            uploaded_photo = await bot.send_photo(
+                chat_id=payload['chat_id'],
+                photo=BufferedInputFile(rotated, filename=f"rotated_photo_{product_id}_{photo_index}.jpg"),
+                caption=f"Повернуте фото {photo_index + 1} ({degrees}°)"
+            )
+            new_file_id = uploaded_photo.photo[-1].file_id
+    except Exception:
+        if job['attempts'] < job['max_attempts']:
+            raise
+        await bot.send_message(payload['chat_id'], f"❌ Не вдалося повернути фото {photo_index + 1}. Спробуйте ще раз.")
+
+    # Стан читаємо і змінюємо лише під тим самим блокуванням, що й обробники подій цього модератора:
+    # поза ним (інший процес, запис стану ще не скинуто в БД) кут може бути застарілим
+    async with dp.fsm.events_isolation.lock(key):
+        user_data = await state.get_data()
+        rotations = user_data.get('photo_rotations', {})
+        applied = user_data.get('applied_rotations', {})
+        if user_data.get('product_id_to_rotate') != product_id or rotations.get(str(photo_index)) != degrees:
+            return # Модератор уже завершив, почав інший товар або знову повернув це фото
+        if new_file_id:
+            user_data['rotated_photos_file_ids'][photo_index] = new_file_id
+            applied[str(photo_index)] = degrees
+        else:
+            rotations[str(photo_index)] = applied.get(str(photo_index), 0) # Повертаємося до останнього успішного повороту
+        await state.update_data(
+            rotated_photos_file_ids=user_data['rotated_photos_file_ids'],
+            photo_rotations=rotations,
+            applied_rotations=applied
+        )
+
+    if new_file_id:
+        # Оновлюємо клавіатуру під поточним фото, щоб можна було повернути його ще раз
+        await bot.edit_message_reply_markup(
+            chat_id=payload['chat_id'],
+            message_id=payload['message_id'],
+            reply_markup=get_photo_rotation_keyboard(product_id, photo_index)
+        )
+
+
+@job_queue.job("rotate_batch", concurrency=1, max_attempts=3)
+async def rotate_batch_job(job: dict):
+    """
+    Пакетний поворот фото з сітки: всі фото завантажуються одночасно, обробляються паралельно
+    в пулі процесів і надсилаються модератору однією медіагрупою (по 10 фото), що дає нові file_id.
+    """
+    payload = job['payload']
+    product_id, items = payload['product_id'], payload['items'] # items: [[індекс, оригінальний file_id, кут], ...]
+    key = StorageKey(bot_id=bot.id, chat_id=payload['chat_id'], user_id=payload['user_id'])
+    state = FSMContext(storage=dp.fsm.storage, key=key)
+
+    to_process = [item for item in items if item[2]]
+    try:
+        # Завантаження і обробка кожного фото йдуть одночасно; обробка — паралельно в пулі процесів
+        rotated = await asyncio.gather(*(
+            process_telegram_image(file_id, "rotate", degrees=degrees) for _, file_id, degrees in to_process
+        ))
+        new_file_ids = {index: file_id for index, file_id, degrees in items if not degrees} # Повний оберт — оригінал
+        for start in range(0, len(to_process), 10):
+            chunk = list(zip(to_process[start:start + 10], rotated[start:start + 10]))
+            media = [
+                InputMediaPhoto(media=BufferedInputFile(data, filename=f"rotated_photo_{product_id}_{index}.jpg"), caption=f"Фото {index + 1} ({degrees}°)")
+                for (index, _, degrees), data in chunk
+            ]
+            sent_messages = await bot.send_media_group(chat_id=payload['chat_id'], media=media)
+            for ((index, _, _), _), sent in zip(chunk, sent_messages):
+                new_file_ids[index] = sent.photo[-1].file_id
+    except Exception:
+        if job['attempts'] < job['max_attempts']:
+            raise
+        new_file_ids = {}
+        await bot.send_message(payload['chat_id'], "❌ Не вдалося повернути фото. Спробуйте ще раз.")
+
+    async with dp.fsm.events_isolation.lock(key):
+        user_data = await state.get_data()
+        if user_data.get('product_id_to_rotate') != product_id:
+            return
+        rotations = user_data.get('photo_rotations', {})
+        applied = user_data.get('applied_rotations', {})
+        for index, _, degrees in items:
+            if rotations.get(str(index), 0) != degrees:
+                continue # Модератор уже змінив кут цього фото
+            if index in new_file_ids:
+                user_data['rotated_photos_file_ids'][index] = new_file_ids[index]
+                applied[str(index)] = degrees
+            else:
+                rotations[str(index)] = applied.get(str(index), 0)
+        await state.update_data(
+            rotated_photos_file_ids=user_data['rotated_photos_file_ids'],
+            photo_rotations=rotations,
+            applied_rotations=applied
+        )
+    if new_file_ids:
+        await bot.send_message(
+            payload['chat_id'],
+            f"✅ Повернуто фото: {len(to_process)}. Натисніть «✅ Готово», щоб надіслати товар на повторну модерацію.",
+            reply_markup=get_photo_rotation_grid_keyboard(product_id, len(user_data['rotated_photos_file_ids']), rotations)
+        )
+
+@job_queue.job("orient_photo", concurrency=2, max_attempts=3)
+async def orient_photo_job(job: dict):
+    """
+    Обробляє фото, надіслане файлом: застосовує EXIF Orientation, надсилає як фото в службовий чат
+    і замінює позначку в чернетці користувача отриманим file_id.
+    """
+    payload = job['payload']
+    key = StorageKey(bot_id=bot.id, chat_id=payload['chat_id'], user_id=payload['user_id'])
+    state = FSMContext(storage=dp.fsm.storage, key=key)
+    new_file_id = None
+    try:
+        oriented = await process_telegram_image(payload['file_id'], "auto_orient")
+        buffer_chat_id = PHOTO_BUFFER_CHAT_ID or payload['chat_id']
+        uploaded_photo = await bot.send_photo(chat_id=buffer_chat_id, photo=BufferedInputFile(oriented, filename="photo.jpg"))
+        new_file_id = uploaded_photo.photo[-1].file_id
+        try:
+            # Повідомлення потрібне лише для file_id
+            await bot.delete_message(buffer_chat_id, uploaded_photo.message_id)
+        except Exception as e:
+            logging.warning(f"Не вдалося видалити службове фото: {e}")
+    except Exception:
+        if job['attempts'] < job['max_attempts']:
+            raise
+        await bot.send_message(payload['chat_id'], "❌ Не вдалося обробити одне з фото. Надішліть його ще раз.")
+
+    async with dp.fsm.events_isolation.lock(key):
+        photos = (await state.get_data()).get('photos')
+        if not photos or payload['token'] not in photos:
+            return # Чернетку вже скасовано
+        if new_file_id:
+            photos[photos.index(payload['token'])] = new_file_id
+        else:
+            photos.remove(payload['token'])
+        await state.update_data(photos=photos)
 
 
 # --- Обробники команд та повідомлень ---
@@ -495,19 +594,63 @@ async def process_name(message: types.Message, state: FSMContext):
 async def process_price(message: types.Message, state: FSMContext):
     """Обробка ціни товару."""
     logging.info(f"Користувач {message.from_user.id} ввів ціну: {message.text}")
-    await state.update_data(price=message.text, photos=[])
+    parsed_price = parse_price(message.text)
+    if parsed_price is None:
+        await message.answer("Не вдалося розпізнати ціну. Вкажіть суму та валюту (наприклад, 1 500 грн, 20$) або напишіть «договірна».")
+        return
+    amount_minor, currency = parsed_price
+    await state.update_data(price=message.text, amount_minor=amount_minor, currency=currency, photos=[])
     await state.set_state(NewProduct.photos)
     await message.answer("📷 Завантажте фотографії (кожне окремим повідомленням або альбомом). Коли закінчите, натисніть /done_photos")
 
-@dp.message(NewProduct.photos, F.content_type == types.ContentType.PHOTO)
-async def process_photos(message: types.Message, state: FSMContext):
-    """Обробка фотографій товару. Приймає будь-яку кількість фото."""
+@dp.message(NewProduct.photos, F.photo | F.document.mime_type.startswith("image/"))
+async def process_photos(message: types.Message, state: FSMContext, album: list = None):
+    """
+    Обробка фотографій товару. Приймає будь-яку кількість фото.
+    Альбом приходить одним викликом (album — усі його повідомлення), тож і відповідь одна.
+    Зображення, надіслані файлом, при AUTO_ORIENT_PHOTOS обробляються у фоновій задачі (orient_photo):
+    до завершення обробки в списку фото стоїть позначка PENDING_PHOTO_PREFIX.
+    """
+    new_photos = []
+    documents = []
+    for m in album or [message]:
+        if m.photo:
+            new_photos.append(m.photo[-1].file_id)
+            image_cache.remember(m.photo[-1].file_id, m.photo[-1].file_unique_id)
+        elif m.document and AUTO_ORIENT_PHOTOS:
+            image_cache.remember(m.document.file_id, m.document.file_unique_id)
+            token = f"{PENDING_PHOTO_PREFIX}{uuid.uuid4().hex}"
+            new_photos.append(token)
+            documents.append((token, m.document.file_id))
+    if not new_photos:
+        await message.answer("Будь ласка, надішліть зображення як фото, а не як файл.")
+        return
     user_data = await state.get_data()
     photos = user_data.get('photos', [])
-    photos.append(message.photo[-1].file_id)
+    photos.extend(new_photos)
     await state.update_data(photos=photos)
-    logging.info(f"Користувач {message.from_user.id} додав фото. Всього: {len(photos)}")
-    await message.answer(f"Фото {len(photos)} додано. Ви можете додати більше або натисніть /done_photos, щоб продовжити.")
+    # Задачі ставимо після запису позначок у стан, щоб задача завжди знайшла свою позначку
+    failed = []
+    for token, file_id in documents:
+        job_id = await job_queue.enqueue("orient_photo", {
+            "chat_id": message.chat.id,
+            "user_id": message.from_user.id,
+            "token": token,
+            "file_id": file_id,
+        })
+        if job_id is None:
+            failed.append(token)
+    if failed:
+        photos = [photo for photo in photos if photo not in failed]
+        await state.update_data(photos=photos)
+        await message.answer(f"❌ Не вдалося прийняти {len(failed)} фото. Спробуйте надіслати їх ще раз.")
+        if len(failed) == len(new_photos):
+            return
+    logging.info(f"Користувач {message.from_user.id} додав {len(new_photos)} фото. Всього: {len(photos)}")
+    if len(new_photos) == 1:
+        await message.answer(f"Фото {len(photos)} додано. Ви можете додати більше або натисніть /done_photos, щоб продовжити.")
+    else:
+        await message.answer(f"Додано {len(new_photos)} фото (всього {len(photos)}). Ви можете додати більше або натисніть /done_photos, щоб продовжити.")
 
 @dp.message(NewProduct.photos, Command("done_photos"))
 async def done_photos(message: types.Message, state: FSMContext):
@@ -589,24 +732,38 @@ async def process_confirm(message: types.Message, state: FSMContext):
     logging.info(f"Користувач {message.from_user.id} підтверджує/скасовує оголошення: {message.text}")
     if message.text == "✅ Підтвердити":
         user_data = await state.get_data()
+        if any(photo.startswith(PENDING_PHOTO_PREFIX) for photo in user_data.get('photos', [])):
+            await message.answer("⏳ Фото ще обробляються. Натисніть «✅ Підтвердити» ще раз за кілька секунд.")
+            return
         user_id = message.from_user.id
         username = message.from_user.username if message.from_user.username else f"id{user_id}"
         
-        product_id = await add_product_to_db(
-            user_id,
-            username,
-            user_data['name'],
-            user_data['price'],
-            user_data['location'],
-            user_data['description'],
-            user_data['delivery']
-        )
+        try:
+            # Товар і задача для модерації записуються однією транзакцією: товар без задачі не збережеться
+            async with database.transaction() as session:
+                product_id = await add_product_to_db(
+                    user_id,
+                    username,
+                    user_data['name'],
+                    user_data['price'],
+                    user_data['location'],
+                    user_data['description'],
+                    user_data['delivery'],
+                    photo_file_ids=user_data['photos'],
+                    amount_minor=user_data.get('amount_minor'),
+                    currency=user_data.get('currency'),
+                    session=session
+                )
+                # Спочатку хеші фото (пошук дублікатів), потім задача сама надішле товар на модерацію
+                if product_id is None or await job_queue.enqueue("fingerprint_photos", {"product_id": product_id}, session=session) is None:
+                    raise RuntimeError("товар не збережено або не поставлено в чергу модерації")
+            job_queue.wakeup()
+        except Exception as e:
+            logging.error(f"❌ Помилка збереження товару користувача {user_id}: {e}")
+            product_id = None
 
         if product_id:
-            for i, file_id in enumerate(user_data['photos']):
-                await add_product_photo_to_db(product_id, file_id, i)
-            
-            await send_product_to_moderation(product_id, user_id, username)
+            my_products_pages.pop(user_id)
             await message.answer(f"✅ Товар «{html.escape(user_data['name'])}» надіслано на модерацію. Очікуйте!", reply_markup=get_main_menu_keyboard(), parse_mode='HTML')
         else:
             await message.answer("Виникла помилка при збереженні товару. Спробуйте ще раз.", reply_markup=get_main_menu_keyboard())
@@ -615,32 +772,115 @@ async def process_confirm(message: types.Message, state: FSMContext):
     
     await state.clear()
 
+async def get_my_products_page(user_id: int, page: int):
+    """
+    Повертає (товари, чи є наступна сторінка) для сторінки "Мої товари".
+    Курсори сторінок зберігаються в короткоживучому кеші, тому перехід на сусідню сторінку — один запит.
+    Якщо курсор сторінки вже невідомий (кеш застарів), повертає None.
+    """
+    cached = my_products_pages.get(user_id)
+    if cached is None:
+        if page != 0:
+            return None
+        cached = {'cursors': [None], 'pages': {}}
+    if page in cached['pages']:
+        return cached['pages'][page]
+    if page >= len(cached['cursors']):
+        return None
+
+    rows = await get_user_products(user_id, limit=MY_PRODUCTS_PAGE_SIZE + 1, after=cached['cursors'][page])
+    products, has_next = rows[:MY_PRODUCTS_PAGE_SIZE], len(rows) > MY_PRODUCTS_PAGE_SIZE
+    if has_next and len(cached['cursors']) == page + 1:
+        last_product = products[-1]
+        cached['cursors'].append((last_product['created_at'], last_product['id']))
+    cached['pages'][page] = (products, has_next)
+    my_products_pages.set(user_id, cached)
+    return products, has_next
+
+def format_my_products_page(products: list, page: int):
+    """Формує текст сторінки "Мої товари"."""
+    lines = [f"📋 <b>Ваші товари</b> (сторінка {page + 1})\n"]
+    for i, product in enumerate(products, start=page * MY_PRODUCTS_PAGE_SIZE + 1):
+        status_emoji = "✅" if product['status'] == 'published' else "⏳"
+        status_text = "Опубліковано" if product['status'] == 'published' else "На модерації"
+        lines.append(
+            f"{i}. 📦 {html.escape(product['name'])} — 💰 {html.escape(product['price'])}\n"
+            f"    {status_emoji} {status_text} · {product['created_at'].strftime('%d.%m.%Y %H:%M')} · 👁 {product['views']}"
+        )
+    lines.append("\nОберіть товар, щоб керувати ним.")
+    return "\n".join(lines)
+
 @dp.message(F.text == "📋 Мої товари")
 async def my_products(message: types.Message, state: FSMContext):
-    """Показує список товарів користувача."""
+    """Показує першу сторінку товарів користувача одним повідомленням."""
     logging.info(f"Користувач {message.from_user.id} переглядає свої товари.")
     await state.clear()
-    user_products = await get_user_products(message.from_user.id)
-    if not user_products:
+    my_products_pages.pop(message.from_user.id) # Завжди показуємо актуальний список
+    products, has_next = await get_my_products_page(message.from_user.id, 0)
+    if not products:
         await message.answer("У вас ще немає доданих товарів.")
         return
-    
-    for product in user_products:
-        status_emoji = "✅" if product['status'] == 'published' else "⏳"
-        status_text = "Опубліковано" if product['status'] == 'published' else "На модерації"
-        
-        text = (
-            f"📦 Назва: {html.escape(product['name'])}\n"
-            f"💰 Ціна: {html.escape(product['price'])}\n"
-            f"Статус: {status_emoji} {status_text}\n"
-            f"Дата: {product['created_at'].strftime('%d.%m.%Y %H:%M')}\n"
-            f"Перегляди: {product['views']}\n"
+
+    await message.answer(format_my_products_page(products, 0), reply_markup=get_my_products_page_keyboard(products, 0, has_next), parse_mode='HTML')
+
+@dp.callback_query(F.data.startswith('my_products_page_'))
+async def process_my_products_page(callback_query: types.CallbackQuery):
+    """Гортає сторінки "Мої товари", редагуючи те саме повідомлення."""
+    page = int(callback_query.data.split('_')[-1])
+    user_id = callback_query.from_user.id
+    result = await get_my_products_page(user_id, page)
+    if result is None:
+        # Кеш курсорів застарів — починаємо з першої сторінки
+        page = 0
+        result = await get_my_products_page(user_id, page)
+    products, has_next = result
+    if not products:
+        await callback_query.answer("У вас ще немає доданих товарів.")
+        return
+
+    try:
+        await bot.edit_message_text(
+            text=format_my_products_page(products, page),
+            chat_id=callback_query.message.chat.id,
+            message_id=callback_query.message.message_id,
+            reply_markup=get_my_products_page_keyboard(products, page, has_next),
+            parse_mode='HTML'
         )
-        
-        full_product_data = await get_product_by_id(product['id'])
-        channel_message_id = full_product_data['channel_message_id'] if full_product_data else None
+    except TelegramAPIError as e:
+        logging.warning(f"Не вдалося оновити сторінку 'Мої товари': {e}")
+    await callback_query.answer()
 
-        await message.answer(text, reply_markup=get_product_actions_keyboard(product['id'], channel_message_id, product['republish_count']), parse_mode='HTML')
+@dp.callback_query(F.data.startswith('product_actions_'))
+async def process_product_actions(callback_query: types.CallbackQuery):
+    """Показує картку товару з кнопками дій замість сторінки списку."""
+    parts = callback_query.data.split('_')
+    page = int(parts[-2])
+    product_id = int(parts[-1])
+    product = await get_product_by_id(product_id)
+    if not product or product['user_id'] != callback_query.from_user.id:
+        await callback_query.answer("Товар не знайдено.")
+        return
+
+    status_emoji = "✅" if product['status'] == 'published' else "⏳"
+    status_text = "Опубліковано" if product['status'] == 'published' else "На модерації"
+    text = (
+        f"📦 Назва: {html.escape(product['name'])}\n"
+        f"💰 Ціна: {html.escape(product['price'])}\n"
+        f"Статус: {status_emoji} {status_text}\n"
+        f"Дата: {product['created_at'].strftime('%d.%m.%Y %H:%M')}\n"
+        f"Перегляди: {product['views']}\n"
+    )
+    try:
+        await bot.edit_message_text(
+            text=text,
+            chat_id=callback_query.message.chat.id,
+            message_id=callback_query.message.message_id,
+            reply_markup=get_product_actions_keyboard(product['id'], product['channel_message_id'], product['republish_count'], back_page=page),
+            parse_mode='HTML'
+        )
+    except TelegramAPIError as e:
+        logging.warning(f"Не вдалося показати картку товару {product_id}: {e}")
+    await callback_query.answer()
 
 @dp.message(F.text == "📖 Правила")
 async def show_rules(message: types.Message, state: FSMContext):
@@ -651,28 +891,224 @@ async def show_rules(message: types.Message, state: FSMContext):
     simple_rules_text = "Продавець оплачує комісію, покупець - доставку товару."
     await message.answer(simple_rules_text) # Без parse_mode, оскільки текст простий
 
-# --- Обробники Callback-кнопок (Модератор) ---
-@dp.callback_query(F.data.startswith('publish_product_'), F.from_user.id.in_(ADMIN_IDS))
-async def process_publish_product(callback_query: types.CallbackQuery, bot: Bot):
-    """Обробник кнопки 'Опублікувати' для модератора."""
-    product_id = int(callback_query.data.split('_')[-1])
-    logging.info(f"Модератор {callback_query.from_user.id} натиснув 'Опублікувати' для товару {product_id}")
-    product = await get_product_by_id(product_id)
-    
-    if not product:
-        await callback_query.answer("Товар не знайдено.")
+# --- Пошук товарів ---
+async def get_search_results(query: dict, offset: int = 0, limit: int = SEARCH_PAGE_SIZE, with_facets: bool = False):
+    """
+    Повертає (товари, чи є ще, фасети) для розібраного запиту (search.parse_search_query).
+    Результати кешуються на SEARCH_CACHE_TTL секунд: популярні запити не доходять до БД.
+    """
+    key = search_cache_key(query, offset) + (limit, with_facets)
+    cached = search_results.get(key)
+    if cached is not None:
+        return cached
+    rows = await search_products(query, SEARCH_CONFIG, limit=limit, offset=offset)
+    facets = await get_search_facets(query, SEARCH_CONFIG) if with_facets and rows else []
+    result = (rows[:limit], len(rows) > limit, facets)
+    search_results.set(key, result)
+    return result
+
+def format_search_results(products: list, has_next: bool, facets: list, currency: str) -> str:
+    """Формує текст відповіді на /search (HTML)."""
+    lines = ["🔍 <b>Результати пошуку:</b>\n"]
+    for number, product in enumerate(products, start=1):
+        name = html.escape(product['name'])
+        if product['channel_message_id'] and CHANNEL_ID != 0:
+            name = f"<a href='{get_channel_post_url(product['channel_message_id'])}'>{name}</a>"
+        line = f"{number}. {name} — {html.escape(product['price'])}"
+        if product['location']:
+            line += f", 📍 {html.escape(product['location'])}"
+        lines.append(line)
+    if has_next:
+        lines.append(f"\nПоказано перші {len(products)} результатів. Уточніть запит, щоб знайти потрібне.")
+
+    price = next((facet for facet in facets if facet['facet'] == 'price' and facet['count']), None)
+    if price:
+        lines.append(f"\n💰 Ціни: від {format_amount(price['min'], currency)} до {format_amount(price['max'], currency)}")
+    for facet, title in (('delivery', "🚚 Доставка"), ('location', "📍 Місто")):
+        values = [f"{html.escape(row['value'])} ({row['count']})" for row in facets if row['facet'] == facet][:5]
+        if values:
+            lines.append(f"{title}: {', '.join(values)}")
+    return "\n".join(lines)
+
+@dp.message(Command("search"))
+async def cmd_search(message: types.Message):
+    """Пошук опублікованих товарів: /search запит [ціна:100-500] [доставка:...] [місто:...]."""
+    text = message.text.partition(" ")[2]
+    query = parse_search_query(text)
+    if not query['terms'] and not any(query[facet] is not None for facet in ('min_price', 'max_price', 'delivery', 'location')):
+        await message.answer(
+            "🔍 Напишіть, що шукаєте: /search iphone 12\n"
+            "Можна уточнити ціну, доставку та місто: /search велосипед ціна:1000-5000 доставка:\"нова пошта\" місто:київ"
+        )
         return
-    
-    if CHANNEL_ID == 0:
-        await callback_query.answer("ID каналу не налаштовано. Неможливо опублікувати.")
-        logging.error("CHANNEL_ID не встановлено, неможливо опублікувати товар.")
+    logging.info(f"Користувач {message.from_user.id} шукає: {text}")
+    products, has_next, facets = await get_search_results(query, with_facets=True)
+    if not products:
+        await message.answer("Нічого не знайдено. Спробуйте інші слова.")
         return
+    await message.answer(format_search_results(products, has_next, facets, query['currency']), parse_mode='HTML', disable_web_page_preview=True)
 
-    photos_file_ids = await get_product_photos_from_db(product_id)
-    media_group = []
-    for file_id in photos_file_ids:
-        media_group.append(InputMediaPhoto(media=file_id))
+def telegram_length(text: str) -> int:
+    """Довжина тексту так, як її рахує Telegram (у кодових одиницях UTF-16: емодзі — дві)."""
+    return len(text.encode('utf-16-le')) // 2
+
+def format_inline_caption(product: dict, limit: int) -> str:
+    """
+    Підпис товару для інлайн-результату, що вміщується в limit: надто довгий опис обрізається з «…».
+    Рахуємо довжину разом з HTML-розміткою (із запасом), бо один задовгий підпис ламає всю сторінку answerInlineQuery.
+    """
+    caption = format_channel_caption(product)
+    if telegram_length(caption) <= limit:
+        return caption
+    # Найдовший префікс опису, з яким підпис ще вміщується (екранування і емодзі роблять довжину нелінійною)
+    description = product['description']
+    low, high = 0, len(description)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if telegram_length(format_channel_caption({**product, 'description': description[:middle] + "…"})) <= limit:
+            low = middle
+        else:
+            high = middle - 1
+    return format_channel_caption({**product, 'description': description[:low].rstrip() + "…"})
+
+def build_inline_result(product: dict):
+    """Результат інлайн-пошуку: збережене фото товару за file_id (без повторного завантаження) або текст."""
+    keyboard = None
+    if product['channel_message_id'] and CHANNEL_ID != 0:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="👁 Переглянути в каналі", url=get_channel_post_url(product['channel_message_id']))]])
+    description = product['price'] + (f", {product['location']}" if product['location'] else "")
+    if product['photo_file_id']:
+        return InlineQueryResultCachedPhoto(
+            id=str(product['id']),
+            photo_file_id=product['photo_file_id'],
+            title=product['name'],
+            description=description,
+            caption=format_inline_caption(product, INLINE_CAPTION_LIMIT),
+            parse_mode='HTML',
+            reply_markup=keyboard
+        )
+    return InlineQueryResultArticle(
+        id=str(product['id']),
+        title=product['name'],
+        description=description,
+        input_message_content=InputTextMessageContent(message_text=format_inline_caption(product, INLINE_MESSAGE_LIMIT), parse_mode='HTML'),
+        reply_markup=keyboard
+    )
+
+@dp.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+    """
+    Каталог в інлайн-режимі (@бот запит): фото товарів за збереженими file_id, сторінки через next_offset.
+    Перші INLINE_CANDIDATES результатів запиту кешуються за його текстом; довший запит фільтрує
+    результати коротшого префікса в пам'яті. Поки користувач набирає текст, сюди доходить лише
+    останній запит: попередні відкидає UpdateScheduler (INLINE_DEBOUNCE).
+    """
+    text = PrefixResultCache.normalize(inline_query.query)
+    query = parse_search_query(text)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    cached = inline_results.get(text, query)
+    if cached is None:
+        rows, has_next, _ = await get_search_results(query, limit=INLINE_CANDIDATES)
+        cached = (rows, not has_next)
+        inline_results.set(text, query, *cached)
+
+    candidates, complete = cached
+    if offset + INLINE_PAGE_SIZE <= len(candidates) or complete:
+        products = candidates[offset:offset + INLINE_PAGE_SIZE]
+        has_next = offset + INLINE_PAGE_SIZE < len(candidates) or not complete
+    else:
+        # Далі за межами кешованих кандидатів — звичайна сторінка пошуку
+        products, has_next, _ = await get_search_results(query, offset=offset, limit=INLINE_PAGE_SIZE)
+
+    await inline_query.answer(
+        [build_inline_result(product) for product in products],
+        cache_time=INLINE_SHORT_QUERY_CACHE_TIME if len(text) <= 3 else SEARCH_CACHE_TTL,
+        is_personal=False,
+        next_offset=str(offset + INLINE_PAGE_SIZE) if has_next else ""
+    )
+
+# --- Облік комісій (адміністратор) ---
+COMMISSION_REPORT_USAGE = (
+    "Звіт за комісіями:\n"
+    "/commissions sellers — за продавцями\n"
+    "/commissions unpaid — неоплачені за продавцями\n"
+    "/commissions day|week|month|quarter|year — за періодами\n\n"
+    "Позначити оплаченими: /commission_paid <ID товару> [...] або /commission_paid seller <ID продавця>"
+)
+
+def format_commission_totals(totals) -> str:
+    if not totals:
+        return ""
+    return (f"Продажів: {totals['sales']}, комісій: {totals['commission_minor'] / 100:.2f} грн, "
+            f"неоплачено: {totals['unpaid_minor'] / 100:.2f} грн")
+
+def format_report_value(key: str, value):
+    """Значення клітинки CSV-звіту: суми в копійках → гривні, дати → ISO, списки → через пробіл."""
+    if value is None:
+        return ""
+    if key.endswith("_minor"):
+        return f"{value / 100:.2f}"
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ", timespec="seconds")
+    if isinstance(value, list):
+        return " ".join(map(str, value))
+    return value
+
+@dp.message(Command("commissions"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_commissions(message: types.Message):
+    """
+    Звіт за комісіями у CSV. Рядки читаються з БД серверним курсором і одразу пишуться у тимчасовий файл,
+    тож пам'ять не залежить від того, за скільки років накопичено облік.
+    """
+    args = (message.text or "").split()[1:]
+    report = args[0].lower() if args else ""
+    if report not in ("sellers", "unpaid") and report not in COMMISSION_PERIODS:
+        totals = format_commission_totals(await get_commission_totals())
+        await message.answer(f"{totals}\n\n{COMMISSION_REPORT_USAGE}" if totals else COMMISSION_REPORT_USAGE)
+        return
+    kind = "periods" if report in COMMISSION_PERIODS else report
+
+    fd, path = tempfile.mkstemp(prefix="commissions_", suffix=".csv")
+    try:
+        rows = 0
+        with os.fdopen(fd, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f)
+            async with aclosing(stream_commission_report(kind, report)) as report_rows:
+                async for row in report_rows:
+                    if not rows:
+                        writer.writerow(row.keys())
+                    writer.writerow([format_report_value(key, value) for key, value in row.items()])
+                    rows += 1
+        if not rows:
+            await message.answer("ℹ️ Записів про комісії немає.")
+            return
+        await message.answer_document(
+            FSInputFile(path, filename=f"commissions_{report}_{datetime.now():%Y%m%d}.csv"),
+            caption=f"📊 Рядків: {rows}\n{format_commission_totals(await get_commission_totals())}"
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка формування звіту за комісіями: {e}")
+        await message.answer("❌ Не вдалося сформувати звіт.")
+    finally:
+        os.remove(path)
+
+@dp.message(Command("commission_paid"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_commission_paid(message: types.Message):
+    """Позначає комісії оплаченими: за ID товарів або всі неоплачені комісії продавця."""
+    args = (message.text or "").split()[1:]
+    if args[:1] == ["seller"] and len(args) == 2 and args[1].isdigit():
+        updated = await mark_commissions_paid(seller_id=int(args[1]))
+    elif args and all(arg.isdigit() for arg in args):
+        updated = await mark_commissions_paid(product_ids=[int(arg) for arg in args])
+    else:
+        await message.answer(COMMISSION_REPORT_USAGE)
+        return
+    await message.answer(f"✅ Позначено оплаченими: {updated}." if updated else "ℹ️ Неоплачених комісій не знайдено.")
 
+# --- Публікація в канал через чергу (channel_outbox) ---
+def format_channel_caption(product) -> str:
+    """Формує підпис поста товару для каналу (HTML)."""
     caption = (
         f"<b>Новий товар:</b>\n\n"
         f"📦 Назва: {html.escape(product['name'])}\n"
@@ -685,54 +1121,71 @@ async def process_publish_product(callback_query: types.CallbackQuery, bot: Bot)
     if product['location']:
         caption += f"📍 Геолокація: {html.escape(product['location'])}\n"
     caption += f"👤 Продавець: @{escaped_username}" if escaped_username else f"👤 Продавець: <a href='tg://user?id={product['user_id']}'>{product['user_id']}</a>"
+    return caption
+
+async def on_product_published(row, message_ids):
+    """Викликається диспетчером черги після того, як пост з'явився в каналі."""
+    payload = row['payload']
+    my_products_pages.pop(payload['user_id'])
+    await notify_user(payload['user_id'], f"✅ Ваш товар «{html.escape(payload['name'])}» опубліковано в каналі!", parse_mode='HTML')
+    # Видаляємо повідомлення модератору з кнопками та фото
+    if payload.get('moderator_message_id'):
+        try:
+            await bot.delete_message(payload['moderator_chat_id'], payload['moderator_message_id'])
+        except Exception as e:
+            logging.warning(f"Не вдалося видалити повідомлення модератора: {e}")
 
-    try:
-        channel_message_id = None
-        if media_group:
-            media_group[0].caption = caption
-            media_group[0].parse_mode = 'HTML'
-            
-            for i in range(0, len(media_group), 10):
-                chunk = media_group[i:i+10]
-                sent_messages_in_channel = await bot.send_media_group(
-                    chat_id=CHANNEL_ID,
-                    media=chunk
-                )
-                # Зберігаємо message_id першого повідомлення групи
-                if i == 0:
-                    channel_message_id = sent_messages_in_channel[0].message_id
-        else:
-            sent_message_in_channel = await bot.send_message(
-                chat_id=CHANNEL_ID,
-                text=caption,
-                parse_mode='HTML'
-            )
-            channel_message_id = sent_message_in_channel.message_id
-        
-        await update_product_status(product_id, 'published', channel_message_id)
-        await callback_query.answer("Товар опубліковано!")
-        
-        await bot.send_message(product['user_id'], f"✅ Ваш товар «{html.escape(product['name'])}» опубліковано в каналі!", parse_mode='HTML')
-        
-        # Видаляємо повідомлення модератору з кнопками та фото
-        if product['moderator_message_id']:
-            try:
-                # Видаляємо повідомлення з кнопками модерації
-                await bot.delete_message(callback_query.message.chat.id, product['moderator_message_id'])
-            except Exception as e:
-                logging.warning(f"Не вдалося видалити повідомлення модератора: {e}")
-
-    except TelegramAPIError as e: # Ловимо специфічні помилки Telegram API
-        logging.error(f"❌ Помилка Telegram API при публікації товару {product_id} в канал: {e}")
-        await callback_query.answer(f"Помилка при публікації товару в канал: {e.message}. Перевірте права бота.")
-        # Додатково повідомляємо модератора про помилку в чаті
-        await bot.send_message(callback_query.from_user.id, 
-                               f"❗️ Помилка публікації товару {html.escape(product['name'])} в канал: {html.escape(e.message)}. "
-                               "Переконайтеся, що бот є адміністратором каналу та має дозвіл на публікацію повідомлень.",
-                               parse_mode='HTML')
-    except Exception as e:
-        logging.error(f"❌ Невідома помилка при публікації товару {product_id}: {e}")
-        await callback_query.answer("Виникла невідома помилка при публікації товару.")
+async def on_product_publish_failed(row, error):
+    """Викликається, якщо пост так і не вдалося надіслати: товар повернуто на модерацію."""
+    payload = row['payload']
+    my_products_pages.pop(payload['user_id'])
+    await notify_user(payload['moderator_id'],
+                      f"❗️ Помилка публікації товару {html.escape(payload['name'])} в канал: {html.escape(str(error))}. "
+                      "Переконайтеся, що бот є адміністратором каналу та має дозвіл на публікацію повідомлень. "
+                      "Товар повернуто на модерацію.",
+                      parse_mode='HTML')
+
+channel_outbox = ChannelOutbox(database, bot, on_sent=on_product_published, on_failed=on_product_publish_failed)
+
+# --- Обробники Callback-кнопок (Модератор) ---
+@dp.callback_query(F.data.startswith('publish_product_'), F.from_user.id.in_(ADMIN_IDS))
+async def process_publish_product(callback_query: types.CallbackQuery, bot: Bot):
+    """
+    Обробник кнопки 'Опублікувати' для модератора.
+    Статус товару і пост для каналу записуються в БД однією транзакцією, а надсилає пост
+    фоновий диспетчер черги (ChannelOutbox), тож модератор отримує відповідь одразу.
+    """
+    product_id = int(callback_query.data.split('_')[-1])
+    logging.info(f"Модератор {callback_query.from_user.id} натиснув 'Опублікувати' для товару {product_id}")
+    product = await get_product_with_photos(product_id)
+    
+    if not product:
+        await callback_query.answer("Товар не знайдено.")
+        return
+    
+    if CHANNEL_ID == 0:
+        await callback_query.answer("ID каналу не налаштовано. Неможливо опублікувати.")
+        logging.error("CHANNEL_ID не встановлено, неможливо опублікувати товар.")
+        return
+
+    payload = {
+        "text": format_channel_caption(product),
+        "parse_mode": "HTML",
+        "photo_file_ids": product['photo_file_ids'],
+        "user_id": product['user_id'],
+        "name": product['name'],
+        "moderator_id": callback_query.from_user.id,
+        "moderator_chat_id": callback_query.message.chat.id if callback_query.message else None,
+        "moderator_message_id": product['moderator_message_id'],
+    }
+    outbox_id = await enqueue_product_publication(product_id, CHANNEL_ID, payload)
+    if outbox_id is None:
+        await callback_query.answer("Товар уже опубліковано або знято з модерації.")
+        return
+
+    my_products_pages.pop(product['user_id'])
+    channel_outbox.wake()
+    await callback_query.answer("Товар поставлено в чергу на публікацію!")
 
 
 @dp.callback_query(F.data.startswith('reject_product_'), F.from_user.id.in_(ADMIN_IDS))
@@ -748,9 +1201,10 @@ async def process_reject_product(callback_query: types.CallbackQuery, bot: Bot):
     
     await update_product_status(product_id, 'rejected')
     await delete_product_from_db(product_id) # Видаляємо товар повністю
+    my_products_pages.pop(product['user_id'])
     await callback_query.answer("Товар відхилено.")
     
-    await bot.send_message(product['user_id'], f"❌ Ваш товар «{html.escape(product['name'])}» відхилено модератором.", parse_mode='HTML')
+    await notify_user(product['user_id'], f"❌ Ваш товар «{html.escape(product['name'])}» відхилено модератором.", parse_mode='HTML')
     
     if product['moderator_message_id']:
         try:
@@ -763,42 +1217,125 @@ async def process_rotate_photos(callback_query: types.CallbackQuery, state: FSMC
     """Обробник кнопки 'Повернути фото' для модератора."""
     product_id = int(callback_query.data.split('_')[-1])
     logging.info(f"Модератор {callback_query.from_user.id} натиснув 'Повернути фото' для товару {product_id}")
-    product = await get_product_by_id(product_id)
+    product = await get_product_with_photos(product_id)
 
     if not product:
         await callback_query.answer("Товар не знайдено.")
         return
     
-    photos_file_ids = await get_product_photos_from_db(product_id)
+    if not await start_photo_rotation(callback_query, state, product):
+        return
+    
+    # Відправляємо перше фото для повороту
+    await send_photo_for_rotation(callback_query.message.chat.id, product, 0, bot)
+
+async def start_photo_rotation(callback_query: types.CallbackQuery, state: FSMContext, product: dict) -> bool:
+    """Переводить модератора в режим редагування фото товару. Повертає False, якщо фото немає."""
+    photos_file_ids = product['photo_file_ids']
     if not photos_file_ids:
         await callback_query.answer("У цього товару немає фотографій для редагування.")
-        return
+        return False
 
     await state.update_data(
-        product_id_to_rotate=product_id,
+        product_id_to_rotate=product['id'],
         current_photo_index=0,
         original_photos_file_ids=photos_file_ids, # Зберігаємо оригінальні file_id
-        rotated_photos_file_ids=list(photos_file_ids) # Копія, яку будемо змінювати
+        rotated_photos_file_ids=list(photos_file_ids), # Копія, яку будемо змінювати
+        photo_rotations={}, # Запитаний сумарний кут кожного фото (ключ — індекс фото)
+        applied_rotations={} # Кут, з яким фото вже є в rotated_photos_file_ids
     )
 
     await state.set_state(ModeratorActions.rotating_photos)
     await callback_query.answer("Переходимо в режим редагування фото.")
-    
-    # Відправляємо перше фото для повороту
-    await send_photo_for_rotation(callback_query.message.chat.id, product_id, 0, photos_file_ids[0], bot)
+    return True
+
+@dp.callback_query(F.data.startswith('rotate_all_photos_'), F.from_user.id.in_(ADMIN_IDS))
+async def process_rotate_all_photos(callback_query: types.CallbackQuery, state: FSMContext, bot: Bot):
+    """Обробник кнопки 'Повернути всі фото': всі фото товару і одна сітка кутів повороту."""
+    product_id = int(callback_query.data.split('_')[-1])
+    logging.info(f"Модератор {callback_query.from_user.id} відкрив сітку повороту фото товару {product_id}")
+    product = await get_product_with_photos(product_id)
+
+    if not product:
+        await callback_query.answer("Товар не знайдено.")
+        return
+    if not await start_photo_rotation(callback_query, state, product):
+        return
+
+    photos_file_ids = product['photo_file_ids']
+    chat_id = callback_query.message.chat.id
+    for start in range(0, len(photos_file_ids), 10):
+        await bot.send_media_group(chat_id=chat_id, media=[
+            InputMediaPhoto(media=file_id, caption=f"Фото {index + 1}")
+            for index, file_id in enumerate(photos_file_ids[start:start + 10], start=start)
+        ])
+    await bot.send_message(
+        chat_id,
+        "Натискайте на номер фото, щоб повернути його на 90° за годинниковою стрілкою, потім «🔃 Застосувати повороти».",
+        reply_markup=get_photo_rotation_grid_keyboard(product_id, len(photos_file_ids), {})
+    )
 
-async def send_photo_for_rotation(chat_id: int, product_id: int, photo_index: int, file_id: str, bot: Bot):
-    """Надсилає одне фото модератору для повороту."""
+@dp.callback_query(F.data.startswith('rotate_grid_'), ModeratorActions.rotating_photos, F.from_user.id.in_(ADMIN_IDS))
+async def process_rotate_grid_photo(callback_query: types.CallbackQuery, state: FSMContext):
+    """Змінює кут повороту одного фото в сітці (без обробки фото)."""
+    parts = callback_query.data.split('_')
+    product_id = int(parts[-2])
+    photo_index = int(parts[-1])
+    user_data = await state.get_data()
+    if user_data['product_id_to_rotate'] != product_id:
+        await callback_query.answer("Помилка: невідповідність товару.")
+        return
+
+    rotations = user_data.get('photo_rotations', {})
+    rotations[str(photo_index)] = (rotations.get(str(photo_index), 0) + 90) % 360
+    await state.update_data(photo_rotations=rotations)
+    await callback_query.message.edit_reply_markup(
+        reply_markup=get_photo_rotation_grid_keyboard(product_id, len(user_data['original_photos_file_ids']), rotations)
+    )
+    await callback_query.answer()
+
+@dp.callback_query(F.data.startswith('apply_rotation_grid_'), ModeratorActions.rotating_photos, F.from_user.id.in_(ADMIN_IDS))
+async def process_apply_rotation_grid(callback_query: types.CallbackQuery, state: FSMContext):
+    """Ставить пакетний поворот усіх змінених фото у фонову задачу rotate_batch."""
+    product_id = int(callback_query.data.split('_')[-1])
+    user_data = await state.get_data()
+    if user_data['product_id_to_rotate'] != product_id:
+        await callback_query.answer("Помилка: невідповідність товару.")
+        return
+
+    applied = user_data.get('applied_rotations', {})
+    items = [
+        [int(index), user_data['original_photos_file_ids'][int(index)], degrees]
+        for index, degrees in user_data.get('photo_rotations', {}).items()
+        if applied.get(index, 0) != degrees
+    ]
+    if not items:
+        await callback_query.answer("Немає змін для застосування.")
+        return
+    job_id = await job_queue.enqueue("rotate_batch", {
+        "chat_id": callback_query.message.chat.id,
+        "user_id": callback_query.from_user.id,
+        "product_id": product_id,
+        "items": sorted(items),
+    })
+    if job_id is None:
+        await callback_query.answer("Помилка при повороті фотографій.")
+        return
+    logging.info(f"Модератор {callback_query.from_user.id} застосовує поворот {len(items)} фото товару {product_id}.")
+    await callback_query.answer(f"Повертаємо фото: {len(items)}...")
+
+async def send_photo_for_rotation(chat_id: int, product: dict, photo_index: int, bot: Bot):
+    """Надсилає одне фото модератору для повороту. product — товар з фото (get_product_with_photos)."""
+    product_id = product['id']
     logging.info(f"Надсилання фото {photo_index} товару {product_id} для повороту.")
-    all_photos = await get_product_photos_from_db(product_id) # Для коректного відображення кількості
+    photos_file_ids = product['photo_file_ids']
     await bot.send_photo(
         chat_id=chat_id,
-        photo=file_id,
-        caption=f"Фото {photo_index + 1}/{len(all_photos)}",
+        photo=photos_file_ids[photo_index],
+        caption=f"Фото {photo_index + 1}/{len(photos_file_ids)}",
         reply_markup=get_photo_rotation_keyboard(product_id, photo_index)
     )
-    product = await get_product_by_id(product_id)
-    if product and product['moderator_message_id']:
+    if product['moderator_message_id']:
         try:
             # Оновлюємо клавіатуру під повідомленням модерації на "Готово"
             await bot.edit_message_reply_markup(
@@ -812,7 +1349,7 @@ async def send_photo_for_rotation(chat_id: int, product_id: int, photo_index: in
 
 @dp.callback_query(F.data.startswith('rotate_single_photo_'), ModeratorActions.rotating_photos, F.from_user.id.in_(ADMIN_IDS))
 async def process_rotate_single_photo(callback_query: types.CallbackQuery, state: FSMContext, bot: Bot):
-    """Обробник кнопки 'Повернути фото на 90°' для модератора."""
+    """Обробник кнопки 'Повернути фото на 90°' для модератора. Сам поворот виконує фонова задача rotate_photo."""
     parts = callback_query.data.split('_')
     product_id = int(parts[-2])
     photo_index = int(parts[-1])
@@ -823,43 +1360,28 @@ async def process_rotate_single_photo(callback_query: types.CallbackQuery, state
         await callback_query.answer("Помилка: невідповідність товару.")
         return
 
-    original_file_id = user_data['rotated_photos_file_ids'][photo_index]
-
-    try:
-        file_info = await bot.get_file(original_file_id)
-        downloaded_file = await bot.download_file(file_info.file_path)
-        
-        image = Image.open(io.BytesIO(downloaded_file.read()))
-        
-        rotated_image = image.rotate(-90, expand=True) # Поворот на 90 градусів проти годинникової стрілки
-
-        byte_arr = io.BytesIO()
-        rotated_image.save(byte_arr, format='JPEG') # Зберігаємо як JPEG
-        byte_arr.seek(0)
-
-        # Надсилаємо повернуте фото назад модератору, щоб отримати новий file_id
-        uploaded_photo = await bot.send_photo(
-            chat_id=callback_query.message.chat.id,
-            photo=BufferedInputFile(byte_arr.getvalue(), filename=f"rotated_photo_{product_id}_{photo_index}.jpg"),
-            caption=f"Повернуте фото {photo_index + 1}"
-        )
-        new_file_id = uploaded_photo.photo[-1].file_id
-
-        # Оновлюємо file_id у стані FSM
-        user_data['rotated_photos_file_ids'][photo_index] = new_file_id
-        await state.update_data(rotated_photos_file_ids=user_data['rotated_photos_file_ids'])
-        await callback_query.answer("Фото повернуто.")
-        
-        # Оновлюємо клавіатуру під поточним фото, щоб можна було повернути його ще раз
-        await bot.edit_message_reply_markup(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id,
-            reply_markup=get_photo_rotation_keyboard(product_id, photo_index)
-        )
-
-    except Exception as e:
-        logging.error(f"❌ Помилка повороту фото: {e}")
+    # Кут накопичується: задача повертає оригінальне фото одразу на сумарний кут
+    rotations = user_data.get('photo_rotations', {})
+    previous = rotations.get(str(photo_index), 0)
+    degrees = (previous + 90) % 360
+    # Спершу стан, потім задача: задача перевіряє кут під блокуванням, тож має побачити вже новий
+    rotations[str(photo_index)] = degrees
+    await state.update_data(photo_rotations=rotations)
+    job_id = await job_queue.enqueue("rotate_photo", {
+        "chat_id": callback_query.message.chat.id,
+        "user_id": callback_query.from_user.id,
+        "message_id": callback_query.message.message_id,
+        "product_id": product_id,
+        "photo_index": photo_index,
+        "file_id": user_data['original_photos_file_ids'][photo_index],
+        "degrees": degrees,
+    })
+    if job_id is None:
+        rotations[str(photo_index)] = previous
+        await state.update_data(photo_rotations=rotations)
         await callback_query.answer("Помилка при повороті фотографії.")
+        return
+    await callback_query.answer(f"Фото повертається ({degrees}°)...")
 
 @dp.callback_query(F.data.startswith('done_rotating_photos_'), ModeratorActions.rotating_photos, F.from_user.id.in_(ADMIN_IDS))
 async def process_done_rotating_photos(callback_query: types.CallbackQuery, state: FSMContext, bot: Bot):
@@ -871,21 +1393,34 @@ async def process_done_rotating_photos(callback_query: types.CallbackQuery, stat
         await callback_query.answer("Помилка: невідповідність товару.")
         return
     
+    applied = user_data.get('applied_rotations', {})
+    if any(applied.get(index, 0) != degrees for index, degrees in user_data.get('photo_rotations', {}).items()):
+        await callback_query.answer("Ще не всі фото повернуто: зачекайте або натисніть «🔃 Застосувати повороти».")
+        return
+    
     new_photos_file_ids = user_data['rotated_photos_file_ids']
-    await update_product_photos_in_db(product_id, new_photos_file_ids)
-
     product = await get_product_by_id(product_id)
     if product:
-        # Повідомляємо користувача про оновлення та надсилаємо на повторну модерацію
-        await bot.send_message(
+        try:
+            # Нові фото, статус і задача (фото змінились: нові хеші, потім повторна модерація) — однією транзакцією
+            async with database.transaction() as session:
+                await update_product_photos_in_db(product_id, new_photos_file_ids, session=session)
+                await update_product_status(product_id, 'moderation', session=session)
+                if await job_queue.enqueue("fingerprint_photos", {"product_id": product_id}, session=session) is None:
+                    raise RuntimeError("товар не поставлено в чергу модерації")
+            job_queue.wakeup()
+        except Exception as e:
+            logging.error(f"❌ Помилка збереження повернутих фото товару {product_id}: {e}")
+            await callback_query.answer("❌ Не вдалося зберегти фото. Спробуйте ще раз.")
+            return
+        # Повідомляємо користувача про оновлення та повторну модерацію
+        await notify_user(
             product['user_id'],
             "🔄 Ваш товар оновлено.\n"
             "📸 Фото були повернуті для правильного відображення.\n"
             "Тепер товар знову надіслано на модерацію.",
-            reply_markup=get_main_menu_keyboard()
+            main_menu=True
         )
-        await update_product_status(product_id, 'moderation') # Змінюємо статус на модерацію
-        await send_product_to_moderation(product_id, product['user_id'], product['username']) # Повторно надсилаємо на модерацію
     
     await callback_query.answer("Редагування фото завершено. Товар знову надіслано на модерацію.")
     await state.clear() # Очищаємо стан FSM
@@ -897,7 +1432,7 @@ async def process_republish_product(callback_query: types.CallbackQuery, bot: Bo
     """Обробник кнопки 'Переопублікувати' для користувача."""
     product_id = int(callback_query.data.split('_')[-1])
     logging.info(f"Користувач {callback_query.from_user.id} натиснув 'Переопублікувати' для товару {product_id}.")
-    product = await get_product_by_id(product_id)
+    product = await get_product_with_photos(product_id)
 
     if not product:
         await callback_query.answer("Товар не знайдено.")
@@ -907,9 +1442,19 @@ async def process_republish_product(callback_query: types.CallbackQuery, bot: Bo
         await callback_query.answer(f"Ви досягли ліміту переопублікацій ({MAX_REPUBLISH_COUNT} рази).")
         return
 
-    new_republish_count = await increment_product_republish_count(product_id)
-    await update_product_status(product_id, 'moderation') # Змінюємо статус на модерацію
-    await send_product_to_moderation(product_id, product['user_id'], product['username'])
+    try:
+        # Лічильник, статус і задача модерації — однією транзакцією, щоб товар не застряг без задачі
+        async with database.transaction() as session:
+            new_republish_count = await increment_product_republish_count(product_id, session=session)
+            await update_product_status(product_id, 'moderation', session=session) # Змінюємо статус на модерацію
+            if new_republish_count is None or await job_queue.enqueue("send_to_moderation", {"product_id": product_id}, session=session) is None:
+                raise RuntimeError("товар не поставлено в чергу модерації")
+        job_queue.wakeup()
+    except Exception as e:
+        logging.error(f"❌ Помилка переопублікації товару {product_id}: {e}")
+        await callback_query.answer("❌ Не вдалося надіслати товар на модерацію. Спробуйте пізніше.")
+        return
+    my_products_pages.pop(product['user_id'])
     
     await callback_query.answer(f"Товар надіслано на переопублікацію. Залишилось {MAX_REPUBLISH_COUNT - new_republish_count} спроб.")
     await bot.send_message(product['user_id'], f"🔁 Ваш товар «{html.escape(product['name'])}» надіслано на повторну модерацію.", parse_mode='HTML')
@@ -926,27 +1471,28 @@ async def process_sold_product(callback_query: types.CallbackQuery, bot: Bot):
         return
     
     try:
-        price_value = 0.0
-        # Очищаємо ціну від тексту, залишаємо тільки числа та крапки/коми
-        cleaned_price = product['price'].lower().replace('грн', '').replace('usd', '').replace('договірна', '').strip().replace(',', '.')
-        
-        if cleaned_price:
-            try:
-                price_value = float(cleaned_price)
-            except ValueError:
-                await callback_query.answer("Не вдалося розрахувати комісію. Перевірте формат ціни.")
-                return
-        else:
+        if product['amount_minor'] is None:
             await callback_query.answer("Не вдалося розрахувати комісію. Будь ласка, вкажіть ціну в грн або USD.")
             return
+        # Ціна в гривнях (у копійках). Курс береться з кешу в пам'яті — без запитів до мережі
+        rate = exchange_rates.get_rate(product['currency'])
+        if rate is None:
+            await callback_query.answer("Не вдалося розрахувати комісію. Будь ласка, вкажіть ціну в грн або USD.")
+            return
+        price_uah_minor = product['amount_minor'] * rate
 
-        # Якщо ціна вказана в USD, конвертуємо в гривні (приблизний курс)
-        if "usd" in product['price'].lower():
-            price_value *= USD_TO_UAH_RATE # Використання константи
-            
-        commission = price_value * COMMISSION_RATE # Використання константи
+        commission_minor = round(price_uah_minor * COMMISSION_RATE) # Використання константи
+        rate_line = f"💱 Курс: 1 {product['currency']} = {rate:.2f} грн\n" if product['currency'] != 'UAH' else ""
         
-        await update_product_status(product_id, 'sold')
+        # Статус і запис у облік комісій — однією транзакцією
+        sold = await mark_product_sold(product, rate, COMMISSION_RATE, commission_minor)
+        if sold is None:
+            await callback_query.answer("Виникла помилка.")
+            return
+        if not sold:
+            await callback_query.answer("Товар уже позначено як проданий.")
+            return
+        my_products_pages.pop(product['user_id'])
         
         # Видаляємо оголошення з каналу, якщо воно було опубліковано
         if product['channel_message_id'] and CHANNEL_ID != 0:
@@ -958,12 +1504,11 @@ async def process_sold_product(callback_query: types.CallbackQuery, bot: Bot):
         await callback_query.answer("Статус товару оновлено на 'Продано'.")
         await bot.send_message(
             callback_query.from_user.id,
-            f"💸 Комісія {int(COMMISSION_RATE * 100)}% = {commission:.2f} грн\n" # Використання константи
+            f"💸 Комісія {int(COMMISSION_RATE * 100)}% = {commission_minor / 100:.2f} грн\n" # Використання константи
+            f"{rate_line}"
             f"💳 Оплатіть на картку Monobank: <code>{html.escape(MONOBANK_CARD_NUMBER)}</code>",
             parse_mode='HTML'
         )
-    except ValueError:
-        await callback_query.answer("Не вдалося розрахувати комісію. Перевірте формат ціни.")
     except Exception as e:
         logging.error(f"❌ Помилка при обробці 'Продано': {e}")
         await callback_query.answer("Виникла помилка.")
@@ -987,13 +1532,24 @@ async def process_new_price(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     product_id = user_data['product_id_to_change_price']
     new_price = message.text
-    
-    await update_product_price(product_id, new_price)
-    
-    await update_product_status(product_id, 'moderation') # Відправляємо на модерацію після зміни ціни
-    product = await get_product_by_id(product_id)
-    if product:
-        await send_product_to_moderation(product_id, product['user_id'], product['username'])
+    parsed_price = parse_price(new_price)
+    if parsed_price is None:
+        await message.answer("Не вдалося розпізнати ціну. Вкажіть суму та валюту (наприклад, 1 500 грн, 20$) або напишіть «договірна».")
+        return
+
+    try:
+        # Нова ціна, статус і задача модерації — однією транзакцією, щоб товар не застряг без задачі
+        async with database.transaction() as session:
+            await update_product_price(product_id, new_price, *parsed_price, session=session)
+            await update_product_status(product_id, 'moderation', session=session) # Відправляємо на модерацію після зміни ціни
+            if await job_queue.enqueue("send_to_moderation", {"product_id": product_id}, session=session) is None:
+                raise RuntimeError("товар не поставлено в чергу модерації")
+        job_queue.wakeup()
+    except Exception as e:
+        logging.error(f"❌ Помилка зміни ціни товару {product_id}: {e}")
+        await message.answer("❌ Не вдалося змінити ціну. Спробуйте ввести її ще раз.")
+        return
+    my_products_pages.pop(message.from_user.id)
 
     await message.answer(f"Ціну товару оновлено на '{html.escape(new_price)}' і відправлено на повторну модерацію.", reply_markup=get_main_menu_keyboard(), parse_mode='HTML')
     await state.clear()
@@ -1010,6 +1566,7 @@ async def process_delete_product(callback_query: types.CallbackQuery, bot: Bot):
         return
     
     await delete_product_from_db(product_id)
+    my_products_pages.pop(product['user_id'])
     
     # Видаляємо оголошення з каналу, якщо воно було опубліковано
     if product['channel_message_id'] and CHANNEL_ID != 0:
@@ -1033,8 +1590,10 @@ async def process_delete_product(callback_query: types.CallbackQuery, bot: Bot):
 async def on_startup_webhook(aiohttp_app: web.Application):
     """
     Функція, яка виконується при запуску aiohttp веб-сервера.
-    Встановлює вебхук для Telegram.
+    Встановлює вебхук для Telegram (лише в першому процесі, якщо їх кілька).
     """
+    if aiohttp_app['worker_index'] != 0:
+        return
     if not WEBHOOK_URL:
         logging.error("❌ WEBHOOK_URL не встановлено. Webhook не буде налаштовано.")
         return
@@ -1060,35 +1619,74 @@ async def on_startup_webhook(aiohttp_app: web.Application):
 async def on_shutdown_webhook(aiohttp_app: web.Application):
     """
     Функція, яка виконується при зупинці aiohttp веб-сервера.
-    Видаляє вебхук з Telegram.
+    Видаляє вебхук з Telegram (лише в першому процесі, якщо їх кілька).
     """
-    logging.info("ℹ️ Видалення Webhook...")
-    try:
-        await bot.delete_webhook()
-        logging.info("✅ Webhook успішно видалено.")
-    except Exception as e:
-        logging.error(f"❌ Помилка видалення Webhook: {e}")
+    await aiohttp_app['update_scheduler'].close() # Доробляємо вже прийняті оновлення
+    await channel_outbox.close()
+    await job_queue.close()
+    await exchange_rates.close()
+    await image_service.close()
+    if aiohttp_app['worker_index'] == 0:
+        logging.info("ℹ️ Видалення Webhook...")
+        try:
+            await bot.delete_webhook()
+            logging.info("✅ Webhook успішно видалено.")
+        except Exception as e:
+            logging.error(f"❌ Помилка видалення Webhook: {e}")
+    await dp.storage.close()
+    await database.close()
+    await bot.session.close()
 
 async def health_check_handler(request):
     """Обробник для health check."""
     return web.json_response({"status": "ok", "message": "Bot service is running."})
 
-async def main():
-    """Основна функція для запуску бота та веб-сервера."""
+async def metrics_handler(request):
+    """
+    Повертає внутрішні метрики сервісу (пул з'єднань з БД, сховище FSM, черга оновлень, черга відправки, черга публікацій, фонові задачі, обробка зображень).
+    Доступ лише з токеном METRICS_TOKEN: метрики слухаються на тому ж публічному порту, що й webhook.
+    """
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return web.json_response({"error": "unauthorized"}, status=401)
+    metrics = {"db": database.stats(), "updates": request.app['update_scheduler'].stats(), "telegram": rate_limiter.stats(), "outbox": channel_outbox.stats(), "jobs": job_queue.stats(), "images": image_service.stats(), "image_cache": image_cache.stats(), "search": search_results.stats(), "inline": inline_results.stats(), "exchange_rates": exchange_rates.stats()}
+    if isinstance(dp.storage, PostgresStorage):
+        metrics["fsm"] = dp.storage.stats()
+    return web.json_response(metrics)
+
+async def main(worker_index: int = 0):
+    """
+    Основна функція для запуску бота та веб-сервера.
+    worker_index — номер процесу, якщо бот запущено в кількох процесах (WEB_CONCURRENCY > 1).
+    """
     # Ініціалізуємо базу даних тільки якщо DATABASE_URL встановлено
     if os.getenv("DATABASE_URL"):
-        await init_db() 
+        await database.open(os.getenv("DATABASE_URL"))
+        await run_migrations()
+        if isinstance(dp.storage, PostgresStorage):
+            dp.storage.start()
+        channel_outbox.start() # Надсилає пости з черги публікацій у канал
+        job_queue.start() # Виконує фонові задачі (поворот фото, модерація, сповіщення)
+        exchange_rates.start() # Оновлює курси валют для розрахунку комісії
     else:
         logging.warning("⚠️ DATABASE_URL не встановлено. Функціонал бази даних буде недоступний.")
     
     aiohttp_app = web.Application()
+    aiohttp_app['worker_index'] = worker_index
     
-    # Додаємо обробник для вебхука Telegram
+    # Додаємо обробник для вебхука Telegram.
+    # Оновлення проходять через планувальник: по черзі в межах чату, паралельно між чатами.
     webhook_path = f"/webhook/{BOT_TOKEN}"
-    SimpleRequestHandler(dispatcher=dp, bot=bot).register(aiohttp_app, path=webhook_path)
+    update_scheduler = UpdateScheduler(dp, bot)
+    aiohttp_app['update_scheduler'] = update_scheduler
+    ScheduledRequestHandler(update_scheduler).register(aiohttp_app, path=webhook_path)
 
     # Реєструємо health check endpoint
     aiohttp_app.router.add_get('/', health_check_handler)
+    if METRICS_TOKEN:
+        aiohttp_app.router.add_get('/metrics', metrics_handler)
+    else:
+        logging.info("ℹ️ METRICS_TOKEN не встановлено: /metrics вимкнено.")
 
     # Реєструємо функції запуску/зупинки для aiohttp
     aiohttp_app.on_startup.append(on_startup_webhook)
@@ -1101,15 +1699,30 @@ async def main():
     
     # Отримуємо порт з змінних оточення, за замовчуванням 10000
     port = int(os.getenv("PORT", 10000))
-    site = web.TCPSite(runner, '0.0.0.0', port)
+    # Кілька процесів слухають той самий порт, ядро розподіляє з'єднання між ними
+    site = web.TCPSite(runner, '0.0.0.0', port, reuse_port=WEB_CONCURRENCY > 1)
     await site.start()
     
-    logging.info("🎉 Бот запущено та готовий до роботи!")
+    logging.info(f"🎉 Бот запущено та готовий до роботи! (процес {worker_index})")
     
-    # Тримаємо основний цикл подій активним
-    while True:
-        await asyncio.sleep(3600) # Спимо годину, щоб додаток не завершився
+    # Тримаємо основний цикл подій активним до сигналу зупинки,
+    # після чого коректно зупиняємо сервер (on_shutdown_webhook закриває пул з'єднань)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+
+def run_worker(worker_index: int):
+    """Точка входу окремого процесу бота."""
+    asyncio.run(main(worker_index))
 
 if __name__ == '__main__':
-    # Запускаємо основну асинхронну функцію
-    asyncio.run(main())
+    if WEB_CONCURRENCY > 1:
+        run_workers(run_worker, WEB_CONCURRENCY)
+    else:
+        # Запускаємо основну асинхронну функцію
+        asyncio.run(main())
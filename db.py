@@ -0,0 +1,835 @@
+import os
+import json
+import logging
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+# --- Конфігурація пулу з'єднань ---
+# DB_EXECUTION_MODE: "async" — асинхронний драйвер psycopg 3 (за замовчуванням),
+# "thread" — проміжний режим: psycopg2 у виділеному пулі потоків.
+DB_EXECUTION_MODE = os.getenv("DB_EXECUTION_MODE", "async").strip().lower()
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10)) # Скільки секунд чекати на вільне з'єднання
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", 15)) # Максимальний час виконання одного запиту (сек)
+DB_THREAD_QUEUE_SIZE = int(os.getenv("DB_THREAD_QUEUE_SIZE", 100)) # Скільки запитів можуть чекати на вільний потік
+
+USER_PRODUCTS_PAGE_SIZE = 50 # Скільки товарів користувача читати одним запитом
+STREAM_BATCH_SIZE = 500 # Скільки рядків за раз читати з серверного курсора (stream)
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", 500)) # Серед скількох найновіших збігів сортувати пошук за релевантністю
+
+
+class DatabaseBusyError(Exception):
+    """Черга запитів до БД переповнена."""
+
+
+class DatabaseSession:
+    """Обгортка над з'єднанням з пулу з простими методами для запитів."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def execute(self, query, params=None):
+        """Виконує запит і повертає кількість змінених рядків."""
+        cur = await self.conn.execute(query, params)
+        return cur.rowcount
+
+    async def fetchone(self, query, params=None):
+        """Виконує запит і повертає перший рядок як dict (або None)."""
+        cur = await self.conn.execute(query, params)
+        return await cur.fetchone()
+
+    async def fetchall(self, query, params=None):
+        """Виконує запит і повертає всі рядки як список dict."""
+        cur = await self.conn.execute(query, params)
+        return await cur.fetchall()
+
+    async def fetchval(self, query, params=None):
+        """Виконує запит і повертає перше значення першого рядка."""
+        row = await self.fetchone(query, params)
+        return next(iter(row.values())) if row else None
+
+    async def stream(self, query, params=None, batch_size: int = STREAM_BATCH_SIZE):
+        """
+        Повертає рядки запиту по одному через серверний курсор: у пам'яті одночасно не більше batch_size рядків.
+        Працює лише всередині транзакції (курсор живе до її завершення).
+        """
+        async with self.conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+            cur.itersize = batch_size
+            await cur.execute(query, params)
+            async for row in cur:
+                yield row
+
+
+class ThreadedDatabaseSession(DatabaseSession):
+    """Сесія psycopg2: кожен запит виконується у виділеному пулі потоків."""
+
+    def __init__(self, conn, database, timeout: float = DB_QUERY_TIMEOUT):
+        super().__init__(conn)
+        self.database = database
+        self.timeout = timeout
+
+    def _run_query(self, query, params, fetch):
+        with self.conn.cursor() as cur:
+            cur.execute(query, params)
+            if fetch == 'one':
+                row = cur.fetchone()
+                return dict(row) if row is not None else None
+            if fetch == 'all':
+                return [dict(row) for row in cur.fetchall()]
+            return cur.rowcount
+
+    async def execute(self, query, params=None):
+        return await self.database.run_in_thread(self.conn, self._run_query, query, params, None, timeout=self.timeout)
+
+    async def fetchone(self, query, params=None):
+        return await self.database.run_in_thread(self.conn, self._run_query, query, params, 'one', timeout=self.timeout)
+
+    async def fetchall(self, query, params=None):
+        return await self.database.run_in_thread(self.conn, self._run_query, query, params, 'all', timeout=self.timeout)
+
+    async def stream(self, query, params=None, batch_size: int = STREAM_BATCH_SIZE):
+        cur = self.conn.cursor(name=f"stream_{uuid.uuid4().hex}") # Іменований курсор psycopg2 — серверний
+        try:
+            await self.database.run_in_thread(self.conn, cur.execute, query, params, timeout=self.timeout)
+            while True:
+                rows = await self.database.run_in_thread(self.conn, cur.fetchmany, batch_size, timeout=self.timeout)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+        finally:
+            await self.database.run_in_thread(self.conn, cur.close)
+
+
+class BaseDatabase:
+    """Спільна частина обох режимів роботи з БД: короткі запити та статистика."""
+
+    def __init__(self):
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._hold_total = 0.0
+        self._hold_max = 0.0
+
+    async def execute(self, query, params=None):
+        async with self.transaction() as session:
+            return await session.execute(query, params)
+
+    async def fetchone(self, query, params=None):
+        async with self.transaction() as session:
+            return await session.fetchone(query, params)
+
+    async def fetchall(self, query, params=None):
+        async with self.transaction() as session:
+            return await session.fetchall(query, params)
+
+    async def fetchval(self, query, params=None):
+        async with self.transaction() as session:
+            return await session.fetchval(query, params)
+
+    async def stream(self, query, params=None, batch_size: int = STREAM_BATCH_SIZE):
+        """Рядки запиту через серверний курсор в окремій транзакції (див. DatabaseSession.stream)."""
+        async with self.transaction() as session:
+            async for row in session.stream(query, params, batch_size):
+                yield row
+
+    def _record_checkout(self, wait: float, hold: float):
+        self._checkouts += 1
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        self._hold_total += hold
+        self._hold_max = max(self._hold_max, hold)
+
+    def _checkout_stats(self) -> dict:
+        checkouts = self._checkouts or 1
+        return {
+            "checkouts": self._checkouts,
+            "checkout_wait_ms_avg": round(self._wait_total / checkouts * 1000, 2),
+            "checkout_wait_ms_max": round(self._wait_max * 1000, 2),
+            "checkout_hold_ms_avg": round(self._hold_total / checkouts * 1000, 2),
+            "checkout_hold_ms_max": round(self._hold_max * 1000, 2),
+        }
+
+
+class Database(BaseDatabase):
+    """
+    Асинхронний пул з'єднань з PostgreSQL.
+    Створюється в main() і закривається в on_shutdown_webhook.
+    """
+
+    mode = "async"
+
+    def __init__(self):
+        super().__init__()
+        self.pool = None
+
+    async def open(self, dsn: str, min_size: int = DB_POOL_MIN_SIZE, max_size: int = DB_POOL_MAX_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        """Відкриває пул і чекає, поки буде встановлено мінімальну кількість з'єднань."""
+        if self.pool is not None:
+            return
+        self.pool = AsyncConnectionPool(
+            dsn,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=timeout,
+            kwargs={"row_factory": dict_row, "options": f"-c statement_timeout={int(DB_QUERY_TIMEOUT * 1000)}"},
+            open=False,
+            name="bot-db",
+        )
+        await self.pool.open(wait=True)
+        logging.info(f"✅ Пул з'єднань з БД відкрито (min={min_size}, max={max_size}).")
+
+    async def close(self):
+        """Закриває пул і всі його з'єднання."""
+        if self.pool is None:
+            return
+        await self.pool.close()
+        self.pool = None
+        logging.info("✅ Пул з'єднань з БД закрито.")
+
+    @asynccontextmanager
+    async def transaction(self, timeout: float = DB_QUERY_TIMEOUT):
+        """
+        Видає з'єднання з пулу в межах однієї транзакції.
+        Транзакція комітиться при виході з блоку і відкочується у разі помилки.
+        timeout=None — без обмеження часу запитів (міграції): statement_timeout знімається до кінця транзакції.
+        """
+        if self.pool is None:
+            raise RuntimeError("Пул з'єднань з БД не ініціалізовано.")
+        requested_at = time.monotonic()
+        async with self.pool.connection() as conn:
+            acquired_at = time.monotonic()
+            try:
+                session = DatabaseSession(conn)
+                if timeout is None:
+                    await session.execute("SET LOCAL statement_timeout = 0;")
+                yield session
+            finally:
+                self._record_checkout(acquired_at - requested_at, time.monotonic() - acquired_at)
+
+    def stats(self) -> dict:
+        """Повертає статистику пулу: розмір, очікування та затримку видачі з'єднань."""
+        if self.pool is None:
+            return {"mode": self.mode, "pool_open": False}
+        pool_stats = self.pool.get_stats()
+        return {
+            "mode": self.mode,
+            "pool_open": True,
+            "pool_min": pool_stats.get("pool_min"),
+            "pool_max": pool_stats.get("pool_max"),
+            "pool_size": pool_stats.get("pool_size"),
+            "pool_available": pool_stats.get("pool_available"),
+            "requests_waiting": pool_stats.get("requests_waiting"),
+            "requests_wait_ms": pool_stats.get("requests_wait_ms", 0),
+            "requests_errors": pool_stats.get("requests_errors", 0),
+            **self._checkout_stats(),
+        }
+
+
+class ThreadedDatabase(BaseDatabase):
+    """
+    Проміжний режим для розгортань, які ще не перейшли на асинхронний драйвер.
+    Блокуючі виклики psycopg2 виконуються у виділеному пулі потоків з обмеженою чергою,
+    таймаутом на кожен запит і скасуванням запиту, якщо обробник оновлення скасовано.
+    """
+
+    mode = "thread"
+
+    def __init__(self):
+        super().__init__()
+        self.pool = None
+        self._executor = None
+        self._cancel_executor = None
+        self._conn_slots = None
+        self._max_size = 0
+        self._queue_size = 0
+        self._in_use = 0
+        self._pending = 0
+        self._running = 0
+        self._running_lock = threading.Lock()
+        self._max_queue_depth = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._cancelled = 0
+
+    async def open(self, dsn: str, min_size: int = DB_POOL_MIN_SIZE, max_size: int = DB_POOL_MAX_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        """Створює пул потоків і пул з'єднань psycopg2 того ж розміру."""
+        if self.pool is not None:
+            return
+        import psycopg2.extras
+        import psycopg2.pool
+
+        self._executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix="db")
+        # Скасування запиту (conn.cancel) — блокуючий мережевий виклик: виконуємо його не в циклі подій
+        # і не в пулі запитів, який саме може бути зайнятий повільними запитами
+        self._cancel_executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix="db-cancel")
+        self._conn_slots = asyncio.Semaphore(max_size)
+        self._max_size = max_size
+        self._queue_size = DB_THREAD_QUEUE_SIZE
+        self._checkout_timeout = timeout
+        loop = asyncio.get_running_loop()
+        self.pool = await loop.run_in_executor(
+            self._executor,
+            lambda: psycopg2.pool.ThreadedConnectionPool(
+                min_size, max_size, dsn,
+                cursor_factory=psycopg2.extras.RealDictCursor,
+                options=f"-c statement_timeout={int(DB_QUERY_TIMEOUT * 1000)}",
+            ),
+        )
+        logging.info(f"✅ Пул з'єднань з БД відкрито в режимі потоків (потоків={max_size}, черга={self._queue_size}).")
+
+    async def close(self):
+        """Закриває пул з'єднань і зупиняє пул потоків."""
+        if self.pool is None:
+            return
+        pool, executor = self.pool, self._executor
+        self.pool = None
+        await asyncio.get_running_loop().run_in_executor(executor, pool.closeall)
+        executor.shutdown(wait=False, cancel_futures=True)
+        self._cancel_executor.shutdown(wait=False, cancel_futures=True)
+        logging.info("✅ Пул з'єднань з БД закрито.")
+
+    async def run_in_thread(self, conn, func, *args, timeout: float = DB_QUERY_TIMEOUT):
+        """
+        Виконує блокуючу функцію в пулі потоків.
+        Якщо черга переповнена — відхиляє запит одразу (DatabaseBusyError).
+        Якщо запит перевищив timeout (None — без обмеження) або обробник скасовано — скасовує запит на сервері.
+        """
+        if self._pending >= self._max_size + self._queue_size:
+            self._rejected += 1
+            raise DatabaseBusyError("Черга запитів до БД переповнена.")
+
+        def call():
+            with self._running_lock:
+                self._running += 1
+            try:
+                return func(*args)
+            finally:
+                with self._running_lock:
+                    self._running -= 1
+
+        self._pending += 1
+        self._max_queue_depth = max(self._max_queue_depth, self._pending - self._running)
+        # Тримаємо власний concurrent.futures.Future: cancel() обгортки asyncio повертає True,
+        # навіть коли запит уже виконується в потоці, і про це не можна було б дізнатися
+        job = self._executor.submit(call)
+        future = asyncio.wrap_future(job)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self._timeouts += 1
+            else:
+                self._cancelled += 1
+            # Запит, який ще не почав виконуватись, просто знімаємо з черги,
+            # а той, що вже виконується, скасовуємо на сервері й чекаємо, поки потік звільнить з'єднання:
+            # лише після цього з'єднання можна відкотити й повернути в пул.
+            if not job.cancel():
+                cancel = asyncio.get_running_loop().run_in_executor(self._cancel_executor, conn.cancel)
+                cancel.add_done_callback(self._log_cancel_error)
+                while not future.done():
+                    try:
+                        await asyncio.wait({future})
+                    except asyncio.CancelledError:
+                        continue # Повторне скасування не повинно залишити потік із з'єднанням
+                if not future.cancelled():
+                    future.exception() # Помилка скасованого запиту (QueryCanceledError) очікувана
+            raise
+        finally:
+            self._pending -= 1
+
+    @staticmethod
+    def _log_cancel_error(cancel):
+        if not cancel.cancelled() and cancel.exception() is not None:
+            logging.warning(f"⚠️ Не вдалося скасувати запит на сервері: {cancel.exception()}")
+
+    @asynccontextmanager
+    async def transaction(self, timeout: float = DB_QUERY_TIMEOUT):
+        """
+        Видає з'єднання psycopg2 в межах однієї транзакції.
+        Кількість одночасно виданих з'єднань обмежена розміром пулу.
+        timeout=None — без обмеження часу запитів (міграції): ні очікування в asyncio, ні statement_timeout на сервері.
+        """
+        if self.pool is None:
+            raise RuntimeError("Пул з'єднань з БД не ініціалізовано.")
+        requested_at = time.monotonic()
+        try:
+            await asyncio.wait_for(self._conn_slots.acquire(), self._checkout_timeout)
+        except asyncio.TimeoutError:
+            raise DatabaseBusyError("Не вдалося отримати з'єднання з БД: пул вичерпано.")
+        conn = None
+        self._in_use += 1
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, self.pool.getconn)
+            try:
+                conn = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # З'єднання, яке потік встигне отримати, повертаємо в пул
+                future.add_done_callback(lambda f: not f.cancelled() and f.exception() is None and self.pool.putconn(f.result()))
+                raise
+            acquired_at = time.monotonic()
+            try:
+                session = ThreadedDatabaseSession(conn, self, timeout)
+                if timeout is None:
+                    await session.execute("SET LOCAL statement_timeout = 0;")
+                yield session
+                await self.run_in_thread(conn, conn.commit, timeout=timeout)
+            except BaseException:
+                # Відкат виконуємо навіть якщо обробник скасовано, щоб з'єднання повернулось у пул чистим
+                await asyncio.shield(asyncio.get_running_loop().run_in_executor(self._executor, conn.rollback))
+                raise
+            finally:
+                self._record_checkout(acquired_at - requested_at, time.monotonic() - acquired_at)
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+            self._in_use -= 1
+            self._conn_slots.release()
+
+    def stats(self) -> dict:
+        """Повертає статистику режиму потоків: розмір пулу, глибину черги, таймаути та скасування."""
+        if self.pool is None:
+            return {"mode": self.mode, "pool_open": False}
+        return {
+            "mode": self.mode,
+            "pool_open": True,
+            "pool_max": self._max_size,
+            "pool_in_use": self._in_use,
+            "queue_capacity": self._queue_size,
+            "queue_depth": max(self._pending - self._running, 0),
+            "queue_depth_max": self._max_queue_depth,
+            "queries_running": self._running,
+            "queries_rejected": self._rejected,
+            "queries_timed_out": self._timeouts,
+            "queries_cancelled": self._cancelled,
+            **self._checkout_stats(),
+        }
+
+
+database = ThreadedDatabase() if DB_EXECUTION_MODE == "thread" else Database()
+
+
+# --- Функції доступу до даних ---
+async def add_product_to_db(user_id: int, username: str, name: str, price: str, location: str, description: str, delivery: str, photo_file_ids: list = None,
+                            amount_minor: int = None, currency: str = None, session=None):
+    """
+    Додає новий товар разом з усіма його фотографіями до бази даних.
+    Товар і фото записуються одним запитом (одна транзакція, один round-trip).
+    price — ціна як її ввів користувач (для показу), amount_minor і currency — розібрана ціна (prices.parse_price).
+    session — виконати в уже відкритій транзакції (наприклад, разом з постановкою задачі в чергу).
+    """
+    try:
+        return await (session or database).fetchval(
+            """WITH new_product AS (
+                   INSERT INTO products (user_id, username, name, price, location, description, delivery, amount_minor, currency)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+               ), new_photos AS (
+                   INSERT INTO product_photos (product_id, file_id, photo_index)
+                   SELECT new_product.id, photo.file_id, photo.position - 1
+                   FROM new_product, unnest(%s::text[]) WITH ORDINALITY AS photo(file_id, position)
+               )
+               SELECT id FROM new_product;""",
+            (user_id, username, name, price, location, description, delivery, amount_minor, currency, list(photo_file_ids or []))
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка додавання товару до БД: {e}")
+        return None
+
+async def get_product_photos_from_db(product_id: int):
+    """Отримує список file_id фотографій для товару."""
+    try:
+        rows = await database.fetchall(
+            """SELECT file_id FROM product_photos WHERE product_id = %s ORDER BY photo_index;""",
+            (product_id,)
+        )
+        return [row['file_id'] for row in rows]
+    except Exception as e:
+        logging.error(f"❌ Помилка отримання фото з БД: {e}")
+        return []
+
+async def get_product_by_id(product_id: int):
+    """Отримує інформацію про товар за його ID."""
+    try:
+        return await database.fetchone("SELECT * FROM products WHERE id = %s;", (product_id,))
+    except Exception as e:
+        logging.error(f"❌ Помилка отримання товару за ID: {e}")
+        return None
+
+async def get_product_with_photos(product_id: int):
+    """
+    Отримує товар разом із впорядкованим списком file_id його фотографій одним запитом.
+    Фото повертаються в полі 'photo_file_ids'.
+    """
+    try:
+        return await database.fetchone(
+            """SELECT p.*,
+                      ARRAY(SELECT ph.file_id FROM product_photos ph
+                            WHERE ph.product_id = p.id ORDER BY ph.photo_index) AS photo_file_ids
+               FROM products p WHERE p.id = %s;""",
+            (product_id,)
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка отримання товару з фото за ID: {e}")
+        return None
+
+async def get_user_products(user_id: int, limit: int = USER_PRODUCTS_PAGE_SIZE, after: tuple = None):
+    """
+    Отримує сторінку товарів користувача одним запитом — з усіма полями,
+    потрібними для "Мої товари" та get_product_actions_keyboard.
+    Пагінація за ключем (created_at, id): after — ключ останнього товару попередньої сторінки.
+    """
+    try:
+        if after is None:
+            return await database.fetchall(
+                """SELECT id, name, price, status, created_at, views, republish_count, channel_message_id
+                   FROM products WHERE user_id = %s
+                   ORDER BY created_at DESC, id DESC LIMIT %s;""",
+                (user_id, limit)
+            )
+        return await database.fetchall(
+            """SELECT id, name, price, status, created_at, views, republish_count, channel_message_id
+               FROM products WHERE user_id = %s AND (created_at, id) < (%s, %s)
+               ORDER BY created_at DESC, id DESC LIMIT %s;""",
+            (user_id, after[0], after[1], limit)
+        )
+    except psycopg.ProgrammingError as e:
+        logging.error(f"❌ Помилка отримання товарів користувача: {e}")
+        logging.error("Можливо, схема бази даних не відповідає очікуваній. Спробуйте перезапустити бота.")
+        return []
+    except Exception as e:
+        logging.error(f"❌ Помилка отримання товарів користувача: {e}")
+        return []
+
+async def update_product_status(product_id: int, status: str, channel_message_id: int = None, session=None):
+    """Оновлює статус товару (session — в уже відкритій транзакції)."""
+    try:
+        if status == 'published' and channel_message_id:
+            await (session or database).execute(
+                """UPDATE products SET status = %s, published_at = CURRENT_TIMESTAMP, channel_message_id = %s WHERE id = %s;""",
+                (status, channel_message_id, product_id)
+            )
+        else:
+            await (session or database).execute(
+                """UPDATE products SET status = %s WHERE id = %s;""",
+                (status, product_id)
+            )
+    except Exception as e:
+        logging.error(f"❌ Помилка оновлення статусу товару: {e}")
+
+async def mark_product_sold(product: dict, exchange_rate: float, commission_rate: float, commission_minor: int):
+    """
+    Позначає товар проданим і записує комісію в облік (commissions) в одній транзакції.
+    Повертає True; False — якщо товар уже позначено проданим (повторне натискання); None — у разі помилки.
+    """
+    try:
+        async with database.transaction() as session:
+            if not await session.fetchone(
+                "UPDATE products SET status = 'sold' WHERE id = %s AND status <> 'sold' RETURNING id;",
+                (product['id'],)
+            ):
+                return False
+            await session.execute(
+                """INSERT INTO commissions (product_id, seller_id, amount_minor, currency, exchange_rate, commission_rate, commission_minor)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s);""",
+                (product['id'], product['user_id'], product['amount_minor'], product['currency'], exchange_rate, commission_rate, commission_minor)
+            )
+        return True
+    except Exception as e:
+        logging.error(f"❌ Помилка позначення товару проданим: {e}")
+        return None
+
+async def enqueue_product_publication(product_id: int, chat_id: int, payload: dict):
+    """
+    Позначає товар опублікованим і ставить пост у чергу публікацій (channel_outbox) одним запитом.
+    Сам пост надсилає фоновий диспетчер (outbox.py). Повертає ID запису в черзі,
+    або None, якщо товар уже не на модерації (наприклад, повторне натискання кнопки).
+    """
+    try:
+        return await database.fetchval(
+            """WITH published AS (
+                   UPDATE products SET status = 'published' WHERE id = %s AND status = 'moderation' RETURNING id
+               ), superseded AS (
+                   UPDATE channel_outbox SET status = 'cancelled'
+                   WHERE product_id IN (SELECT id FROM published) AND status = 'pending'
+               )
+               INSERT INTO channel_outbox (product_id, chat_id, payload)
+               SELECT id, %s, %s::jsonb FROM published
+               RETURNING id;""",
+            (product_id, chat_id, json.dumps(payload, ensure_ascii=False))
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка постановки товару в чергу публікацій: {e}")
+        return None
+
+async def update_product_moderator_message_id(product_id: int, message_id: int):
+    """Оновлює ID повідомлення модератору для товару."""
+    try:
+        await database.execute(
+            """UPDATE products SET moderator_message_id = %s WHERE id = %s;""",
+            (message_id, product_id)
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка оновлення ID повідомлення модератору: {e}")
+
+async def delete_product_from_db(product_id: int):
+    """Видаляє товар з бази даних."""
+    try:
+        await database.execute("DELETE FROM products WHERE id = %s;", (product_id,))
+    except Exception as e:
+        logging.error(f"❌ Помилка видалення товару з БД: {e}")
+
+async def update_product_price(product_id: int, new_price: str, amount_minor: int = None, currency: str = None, session=None):
+    """Оновлює ціну товару: текст для показу і розібрану суму (prices.parse_price). session — в уже відкритій транзакції."""
+    try:
+        await (session or database).execute(
+            """UPDATE products SET price = %s, amount_minor = %s, currency = %s WHERE id = %s;""",
+            (new_price, amount_minor, currency, product_id)
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка оновлення ціни товару: {e}")
+
+async def increment_product_republish_count(product_id: int, session=None):
+    """Збільшує лічильник переопублікацій товару (session — в уже відкритій транзакції)."""
+    try:
+        return await (session or database).fetchval(
+            """UPDATE products SET republish_count = republish_count + 1 WHERE id = %s RETURNING republish_count;""",
+            (product_id,)
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка збільшення лічильника переопублікацій: {e}")
+        return None
+
+async def replace_photo_hashes(product_id: int, hashes: list) -> bool:
+    """
+    Зберігає перцептивні хеші фото товару (BIGINT зі знаком, у порядку фото) замість попередніх.
+    Частини h0..h3 для multi-index hashing обчислюються в самому запиті.
+    """
+    try:
+        async with database.transaction() as session:
+            await session.execute("DELETE FROM photo_hashes WHERE product_id = %s;", (product_id,))
+            await session.execute(
+                """INSERT INTO photo_hashes (product_id, photo_index, hash, h0, h1, h2, h3)
+                   SELECT %s, item.position - 1, item.hash,
+                          (item.hash >> 48) & 65535, (item.hash >> 32) & 65535, (item.hash >> 16) & 65535, item.hash & 65535
+                   FROM unnest(%s::bigint[]) WITH ORDINALITY AS item(hash, position);""",
+                (product_id, list(hashes))
+            )
+        return True
+    except Exception as e:
+        logging.error(f"❌ Помилка збереження хешів фото товару {product_id}: {e}")
+        return False
+
+async def get_photo_hashes(product_id: int):
+    """Повертає хеші фото товару: [{'photo_index', 'hash'}, ...]."""
+    try:
+        return await database.fetchall(
+            "SELECT photo_index, hash FROM photo_hashes WHERE product_id = %s ORDER BY photo_index;",
+            (product_id,)
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка отримання хешів фото товару {product_id}: {e}")
+        return []
+
+async def find_photo_hash_candidates(product_id: int, hashes: list, probes: list, max_distance: int, limit: int = 500):
+    """
+    Схожі фото інших товарів: хоча б одна частина хеша h0..h3 є серед probes (probes — чотири списки значень,
+    див. image_hash.chunk_probes; кожна умова йде по своєму індексу), а відстань Геммінга до найближчого
+    з hashes (BIGINT зі знаком) не більша за max_distance. Відстань рахується в запиті ще до LIMIT,
+    тож поширене значення частини хеша не витіснить справжній дублікат. Найсхожіші — першими.
+    """
+    try:
+        return await database.fetchall(
+            """SELECT h.product_id, h.photo_index, h.hash, p.name, p.status, d.distance
+               FROM photo_hashes h
+               JOIN products p ON p.id = h.product_id
+               CROSS JOIN LATERAL (
+                   SELECT min(bit_count((h.hash # own.hash)::bit(64))) AS distance FROM unnest(%s::bigint[]) AS own(hash)
+               ) d
+               WHERE h.product_id <> %s
+                 AND (h.h0 = ANY(%s::int[]) OR h.h1 = ANY(%s::int[]) OR h.h2 = ANY(%s::int[]) OR h.h3 = ANY(%s::int[]))
+                 AND d.distance <= %s
+               ORDER BY d.distance, h.product_id, h.photo_index
+               LIMIT %s;""",
+            (list(hashes), product_id, *probes, max_distance, limit)
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка пошуку схожих фото для товару {product_id}: {e}")
+        return []
+
+_trigram_available = None
+
+async def is_trigram_search_available() -> bool:
+    """Чи встановлено розширення pg_trgm (перевіряється один раз на процес)."""
+    global _trigram_available
+    if _trigram_available is None:
+        try:
+            _trigram_available = bool(await database.fetchval("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm');"))
+        except Exception as e:
+            logging.error(f"❌ Помилка перевірки розширення pg_trgm: {e}")
+            return False
+    return _trigram_available
+
+def _search_conditions(query: dict, config: str):
+    """Умови WHERE для пошуку опублікованих товарів за словами та фасетами."""
+    conditions, params = ["p.status = 'published'"], []
+    if query['tsquery']:
+        conditions.append("p.search_vector @@ to_tsquery(%s::regconfig, %s)")
+        params += [config, query['tsquery']]
+    # Фільтр за ціною — по індексу idx_products_price (currency, amount_minor)
+    if query['min_price'] is not None or query['max_price'] is not None:
+        conditions.append("p.currency = %s")
+        params.append(query['currency'])
+    if query['min_price'] is not None:
+        conditions.append("p.amount_minor >= %s")
+        params.append(round(query['min_price'] * 100))
+    if query['max_price'] is not None:
+        conditions.append("p.amount_minor <= %s")
+        params.append(round(query['max_price'] * 100))
+    if query['delivery']:
+        conditions.append("p.delivery ILIKE %s")
+        params.append(f"%{query['delivery']}%")
+    if query['location']:
+        conditions.append("p.location ILIKE %s")
+        params.append(f"%{query['location']}%")
+    return " AND ".join(conditions), params
+
+async def search_products(query: dict, config: str, limit: int, offset: int = 0):
+    """
+    Повнотекстовий пошук опублікованих товарів з фасетами.
+    query — результат search.parse_search_query. Без слів у запиті — найновіші товари.
+    Зі словами — SEARCH_RANK_WINDOW найновіших збігів, відсортованих за релевантністю (назва важить більше за опис).
+    Вікно тримає час запиту сталим і для загальних слів: рідкісні слова йдуть по GIN-індексу idx_products_search,
+    а загальні — по idx_products_published до першої сотні збігів, без ранжування всіх збігів таблиці.
+    Якщо за словами нічого не знайдено і є pg_trgm, шукає схожі назви (помилки в словах).
+    Повертає limit + 1 рядків, щоб визначити наступну сторінку.
+    """
+    where, params = _search_conditions(query, config)
+    columns = """p.id, p.user_id, p.username, p.name, p.price, p.description, p.delivery, p.location, p.channel_message_id,
+                 (SELECT ph.file_id FROM product_photos ph WHERE ph.product_id = p.id ORDER BY ph.photo_index LIMIT 1) AS photo_file_id"""
+    select = f"SELECT {columns} FROM products p"
+    try:
+        if query['tsquery']:
+            rows = await database.fetchall(
+                f"""SELECT {columns} FROM (
+                        SELECT p.* FROM products p WHERE {where}
+                        ORDER BY p.published_at DESC, p.id DESC LIMIT %s
+                    ) p
+                    ORDER BY ts_rank(p.search_vector, to_tsquery(%s::regconfig, %s)) DESC, p.id DESC LIMIT %s OFFSET %s;""",
+                (*params, SEARCH_RANK_WINDOW, config, query['tsquery'], limit + 1, offset)
+            )
+        else:
+            rows = await database.fetchall(
+                f"{select} WHERE {where} ORDER BY p.published_at DESC, p.id DESC LIMIT %s OFFSET %s;",
+                (*params, limit + 1, offset)
+            )
+        if rows or not query['terms'] or not await is_trigram_search_available():
+            return rows
+        fuzzy_query = dict(query, tsquery=None)
+        where, params = _search_conditions(fuzzy_query, config)
+        text = " ".join(query['terms'])
+        return await database.fetchall(
+            f"{select} WHERE {where} AND lower(p.name) %% %s ORDER BY similarity(lower(p.name), %s) DESC, p.id DESC LIMIT %s OFFSET %s;",
+            (*params, text, text, limit + 1, offset)
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка пошуку товарів: {e}")
+        return []
+
+async def get_search_facets(query: dict, config: str, sample: int = 1000):
+    """
+    Значення фасетів серед знайдених товарів (не більше sample найновіших збігів):
+    [{'facet': 'delivery' | 'location', 'value', 'count'}, ...] і діапазон цін у валюті запиту
+    {'facet': 'price', 'min', 'max'} (у мінорних одиницях).
+    """
+    where, params = _search_conditions(query, config)
+    try:
+        return await database.fetchall(
+            f"""WITH matched AS (
+                    SELECT p.delivery, p.location, p.amount_minor, p.currency
+                    FROM products p WHERE {where}
+                    ORDER BY p.published_at DESC, p.id DESC LIMIT %s
+                )
+                SELECT 'price' AS facet, NULL AS value, count(amount_minor) AS count, min(amount_minor) AS min, max(amount_minor) AS max
+                FROM matched WHERE currency = %s
+                UNION ALL
+                SELECT 'delivery', lower(delivery), count(*), NULL, NULL FROM matched GROUP BY lower(delivery)
+                UNION ALL
+                SELECT 'location', lower(location), count(*), NULL, NULL FROM matched WHERE location <> '' GROUP BY lower(location)
+                ORDER BY count DESC;""",
+            (*params, sample, query['currency'])
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка отримання фасетів пошуку: {e}")
+        return []
+
+async def update_product_photos_in_db(product_id: int, new_file_ids: list, session=None):
+    """Оновлює фотографії товару в базі даних одним запитом (session — в уже відкритій транзакції)."""
+    try:
+        await (session or database).execute(
+            """WITH deleted AS (
+                   DELETE FROM product_photos WHERE product_id = %s
+               )
+               INSERT INTO product_photos (product_id, file_id, photo_index)
+               SELECT %s, photo.file_id, photo.position - 1
+               FROM unnest(%s::text[]) WITH ORDINALITY AS photo(file_id, position);""",
+            (product_id, product_id, list(new_file_ids))
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка оновлення фотографій товару в БД: {e}")
+
+# Звіти за комісіями: групування виконує PostgreSQL, рядки читаються серверним курсором (database.stream)
+COMMISSION_REPORTS = {
+    "sellers": """SELECT seller_id, count(*) AS sales, sum(commission_minor)::bigint AS commission_minor,
+                         coalesce(sum(commission_minor) FILTER (WHERE paid_at IS NULL), 0)::bigint AS unpaid_minor,
+                         min(created_at) AS first_sale, max(created_at) AS last_sale
+                  FROM commissions GROUP BY seller_id ORDER BY seller_id;""",
+    "periods": """SELECT date_trunc(%s, created_at) AS period, count(*) AS sales, count(DISTINCT seller_id) AS sellers,
+                         sum(commission_minor)::bigint AS commission_minor,
+                         coalesce(sum(commission_minor) FILTER (WHERE paid_at IS NULL), 0)::bigint AS unpaid_minor
+                  FROM commissions GROUP BY 1 ORDER BY 1;""",
+    "unpaid": """SELECT seller_id, count(*) AS sales, sum(commission_minor)::bigint AS unpaid_minor,
+                        min(created_at) AS oldest_sale, array_agg(product_id ORDER BY created_at) AS product_ids
+                 FROM commissions WHERE paid_at IS NULL GROUP BY seller_id ORDER BY seller_id;""",
+}
+COMMISSION_PERIODS = ("day", "week", "month", "quarter", "year")
+
+def stream_commission_report(report: str, period: str = "month"):
+    """
+    Рядки звіту за комісіями: "sellers" — за продавцями, "periods" — за періодами (period з COMMISSION_PERIODS),
+    "unpaid" — неоплачені за продавцями. Асинхронний генератор; помилки БД передаються викликачу.
+    """
+    params = (period,) if report == "periods" else None
+    return database.stream(COMMISSION_REPORTS[report], params)
+
+async def get_commission_totals():
+    """Загальні підсумки обліку комісій: кількість продажів, сума комісій і неоплачена сума (у копійках)."""
+    try:
+        return await database.fetchone(
+            """SELECT count(*) AS sales, coalesce(sum(commission_minor), 0)::bigint AS commission_minor,
+                      coalesce(sum(commission_minor) FILTER (WHERE paid_at IS NULL), 0)::bigint AS unpaid_minor
+               FROM commissions;"""
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка отримання підсумків комісій: {e}")
+        return None
+
+async def mark_commissions_paid(product_ids: list = None, seller_id: int = None) -> int:
+    """Позначає оплаченими неоплачені комісії за товарами або всі неоплачені комісії продавця. Повертає кількість записів."""
+    try:
+        return await database.execute(
+            """UPDATE commissions SET paid_at = CURRENT_TIMESTAMP
+               WHERE paid_at IS NULL AND (product_id = ANY(%s::int[]) OR seller_id = %s);""",
+            (list(product_ids or []), seller_id)
+        )
+    except Exception as e:
+        logging.error(f"❌ Помилка позначення комісій оплаченими: {e}")
+        return 0
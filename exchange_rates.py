@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+import aiohttp
+
+EXCHANGE_RATE_PROVIDER = os.getenv("EXCHANGE_RATE_PROVIDER", "nbu").strip().lower() # Джерело курсів: nbu, file або stub
+EXCHANGE_RATE_FILE = os.getenv("EXCHANGE_RATE_FILE", "exchange_rates.json") # Файл з курсами для провайдера file: {"USD": 41.5, ...}
+EXCHANGE_RATE_TTL = int(os.getenv("EXCHANGE_RATE_TTL", 3600)) # Через скільки секунд курс вважається застарілим і оновлюється
+EXCHANGE_RATE_RETRY_DELAY = 60 # Затримка перед повторною спробою після помилки джерела (сек), подвоюється до EXCHANGE_RATE_TTL
+EXCHANGE_RATE_TIMEOUT = 10 # Таймаут запиту до джерела курсів (сек)
+
+NBU_RATES_URL = "https://bank.gov.ua/NBUStatService/v1/statdirectory/exchange?json"
+BASE_CURRENCY = "UAH"
+CURRENCIES = ("USD", "EUR") # Які курси до гривні потрібні боту
+
+# Приблизні курси на випадок, якщо не отримано жодного (новий запуск без БД і без доступу до джерела)
+FALLBACK_RATES = {"USD": 40.0, "EUR": 43.0}
+
+
+class NbuRateProvider:
+    """Офіційні курси НБУ (JSON API bank.gov.ua)."""
+    name = "nbu"
+
+    async def fetch(self) -> dict:
+        timeout = aiohttp.ClientTimeout(total=EXCHANGE_RATE_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(NBU_RATES_URL) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+        return {item['cc']: float(item['rate']) for item in data if item.get('cc') in CURRENCIES}
+
+
+class FileRateProvider:
+    """Курси з локального JSON-файлу (без мережі): {"USD": 41.5, "EUR": 44.8}."""
+    name = "file"
+
+    def __init__(self, path: str = EXCHANGE_RATE_FILE):
+        self.path = path
+
+    async def fetch(self) -> dict:
+        def read():
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        return {currency: float(rate) for currency, rate in (await asyncio.to_thread(read)).items()}
+
+
+class StubRateProvider:
+    """Фіксовані курси — для тестів і локального запуску."""
+    name = "stub"
+
+    def __init__(self, rates: dict = None):
+        self.rates = dict(rates or FALLBACK_RATES)
+
+    async def fetch(self) -> dict:
+        return dict(self.rates)
+
+
+PROVIDERS = {"nbu": NbuRateProvider, "file": FileRateProvider, "stub": StubRateProvider}
+
+
+def create_rate_provider(name: str = EXCHANGE_RATE_PROVIDER):
+    """Створює провайдера курсів за назвою (EXCHANGE_RATE_PROVIDER)."""
+    if name not in PROVIDERS:
+        logging.warning(f"⚠️ Невідомий провайдер курсів '{name}', використовується stub.")
+        name = "stub"
+    return PROVIDERS[name]()
+
+
+class ExchangeRates:
+    """
+    Кеш курсів валют до гривні для розрахунку комісії.
+
+    get_rate() лише читає пам'ять і ніколи не звертається до мережі чи БД: курс оновлює фонова задача,
+    коли він старший за EXCHANGE_RATE_TTL. Кожен успішно отриманий курс зберігається в таблиці exchange_rates
+    (останній відомий курс) і завантажується звідти при запуску, тож після перезапуску без доступу до джерела
+    бот рахує за останнім відомим курсом, а не за FALLBACK_RATES.
+    """
+
+    def __init__(self, database, provider=None):
+        self.database = database
+        self.provider = provider or create_rate_provider()
+        self._rates = {} # валюта → (курс, час отримання за time.time(), джерело)
+        self._task = None
+        self._refreshed = 0
+        self._errors = 0
+        self._fallback_used = 0
+
+    def get_rate(self, currency: str):
+        """Курс валюти до гривні з пам'яті (можливо, застарілий) або приблизний FALLBACK_RATES; None — невідома валюта."""
+        if currency == BASE_CURRENCY:
+            return 1.0
+        cached = self._rates.get(currency)
+        if cached is not None:
+            return cached[0]
+        if currency in FALLBACK_RATES:
+            self._fallback_used += 1
+            logging.warning(f"⚠️ Курс {currency} ще не отримано, використовується приблизний: {FALLBACK_RATES[currency]}")
+            return FALLBACK_RATES[currency]
+        return None
+
+    async def load(self):
+        """Завантажує останні відомі курси з БД."""
+        try:
+            rows = await self.database.fetchall("SELECT currency, rate, source, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - fetched_at)::float AS age FROM exchange_rates;")
+        except Exception as e:
+            logging.error(f"❌ Помилка завантаження курсів валют з БД: {e}")
+            return
+        now = time.time()
+        for row in rows:
+            self._rates[row['currency']] = (float(row['rate']), now - row['age'], row['source'])
+
+    def start(self):
+        """Запускає фонове оновлення курсів."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def _seconds_until_stale(self) -> float:
+        """Скільки секунд до застарівання найстарішого з наявних курсів (0 — курсів ще немає)."""
+        held = [self._rates[currency][1] for currency in CURRENCIES if currency in self._rates]
+        if not held:
+            return 0
+        return max(0.0, min(held) + EXCHANGE_RATE_TTL - time.time())
+
+    async def _loop(self):
+        await self.load()
+        retry_delay = EXCHANGE_RATE_RETRY_DELAY
+        # Першу спробу робимо одразу, якщо якогось курсу немає; далі затримка ніколи не буває нульовою
+        delay = 0 if any(currency not in self._rates for currency in CURRENCIES) else self._seconds_until_stale()
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except Exception as e:
+                self._errors += 1
+                logging.warning(f"⚠️ Не вдалося оновити курси валют ({self.provider.name}), повтор через {retry_delay} с: {e}")
+                delay, retry_delay = retry_delay, min(retry_delay * 2, EXCHANGE_RATE_TTL)
+                continue
+            delay = self._seconds_until_stale()
+            now = time.time()
+            lagging = [currency for currency in CURRENCIES if currency not in self._rates or self._rates[currency][1] + EXCHANGE_RATE_TTL <= now]
+            if lagging:
+                # Джерело повертає не всі валюти: повторюємо з наростаючою затримкою, а не одразу
+                logging.warning(f"⚠️ Джерело курсів ({self.provider.name}) не повернуло {', '.join(lagging)}, повтор через {retry_delay} с.")
+                delay, retry_delay = retry_delay, min(retry_delay * 2, EXCHANGE_RATE_TTL)
+            else:
+                retry_delay = EXCHANGE_RATE_RETRY_DELAY
+
+    async def refresh(self):
+        """Отримує курси від провайдера і зберігає їх у пам'яті та в БД."""
+        rates = {currency: rate for currency, rate in (await self.provider.fetch()).items() if currency in CURRENCIES and rate > 0}
+        if not rates:
+            raise ValueError("джерело не повернуло жодного курсу")
+        now = time.time()
+        for currency, rate in rates.items():
+            self._rates[currency] = (rate, now, self.provider.name)
+        self._refreshed += 1
+        try:
+            await self.database.execute(
+                """INSERT INTO exchange_rates (currency, rate, source, fetched_at)
+                   SELECT item.currency, item.rate, %s, CURRENT_TIMESTAMP
+                   FROM unnest(%s::text[], %s::numeric[]) AS item(currency, rate)
+                   ON CONFLICT (currency) DO UPDATE SET rate = EXCLUDED.rate, source = EXCLUDED.source, fetched_at = EXCLUDED.fetched_at;""",
+                (self.provider.name, list(rates), list(rates.values()))
+            )
+        except Exception as e:
+            logging.error(f"❌ Помилка збереження курсів валют у БД: {e}")
+        logging.info(f"✅ Курси валют оновлено ({self.provider.name}): {rates}")
+
+    async def close(self):
+        """Зупиняє фонове оновлення."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "provider": self.provider.name,
+            "rates": {currency: {"rate": rate, "age_s": round(now - fetched_at), "source": source} for currency, (rate, fetched_at, source) in self._rates.items()},
+            "refreshed": self._refreshed,
+            "errors": self._errors,
+            "fallback_used": self._fallback_used,
+        }
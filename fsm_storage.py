@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+from cache import TTLCache
+
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 48 * 3600)) # Через скільки секунд неактивності чернетка вважається покинутою
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.5)) # Як часто записувати змінені стани в БД (сек)
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 300)) # Скільки секунд тримати прочитаний стан у пам'яті
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+FSM_CLEANUP_INTERVAL = 600 # Як часто видаляти прострочені стани з БД (сек)
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Сховище станів FSM у PostgreSQL (таблиця fsm_states).
+
+    - Читання обслуговуються з кешу в пам'яті процесу; до БД звертаємося лише при промаху.
+    - Запис відкладений (write-behind): зміни накопичуються і записуються пакетом раз на FSM_FLUSH_INTERVAL.
+    - Стани, які не змінювались FSM_STATE_TTL секунд (покинуті чернетки), вважаються простроченими і видаляються.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._cache = TTLCache(maxsize=FSM_CACHE_SIZE, ttl=FSM_CACHE_TTL)
+        self._dirty = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._last_cleanup = 0.0
+        self._flushes = 0
+        self._flush_errors = 0
+        self._last_flush_ms = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    async def _load(self, key: str, session=None) -> dict:
+        record = self._dirty.get(key)
+        if record is not None:
+            return record
+        if session is None:
+            record = self._cache.get(key)
+            if record is not None:
+                return record
+        query = "SELECT state, data FROM fsm_states WHERE storage_key = %s AND expires_at > CURRENT_TIMESTAMP;"
+        if session is None:
+            row = await self.database.fetchone(query, (key,))
+        else:
+            row = await session.fetchone(query, (key,))
+        record = {"state": row["state"], "data": row["data"] or {}} if row else {"state": None, "data": {}}
+        self._cache.set(key, record)
+        return record
+
+    def _store(self, key: str, record: dict):
+        self._cache.set(key, record)
+        self._dirty[key] = record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        record = await self._load(storage_key)
+        self._store(storage_key, {"state": state.state if isinstance(state, State) else state, "data": record["data"]})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key)))["state"]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        record = await self._load(storage_key)
+        self._store(storage_key, {"state": record["state"], "data": data.copy()})
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(self._key(key)))["data"].copy()
+
+    def start(self):
+        """Запускає фонову задачу, що записує змінені стани в БД."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            await self.flush()
+            if time.monotonic() - self._last_cleanup > FSM_CLEANUP_INTERVAL:
+                await self._cleanup_expired()
+
+    async def refresh(self, key: StorageKey, session):
+        """Перечитує стан з БД у межах переданої транзакції (його міг змінити інший процес)."""
+        await self._load(self._key(key), session=session)
+
+    async def flush(self, key: StorageKey = None, session=None):
+        """
+        Записує накопичені зміни в БД одним пакетом.
+        key — записати лише зміни цього ключа; session — записати в межах уже відкритої транзакції.
+        """
+        # Лише один запис одночасно: так запис за ключем дочекається фонового пакета, який міг забрати цей ключ
+        async with self._flush_lock:
+            if key is None:
+                batch, self._dirty = self._dirty, {}
+            else:
+                storage_key = self._key(key)
+                batch = {storage_key: self._dirty.pop(storage_key)} if storage_key in self._dirty else {}
+            if not batch:
+                return
+            started = time.monotonic()
+            try:
+                if session is None:
+                    async with self.database.transaction() as session:
+                        await self._write_batch(session, batch)
+                else:
+                    await self._write_batch(session, batch)
+                self._flushes += 1
+                self._last_flush_ms = round((time.monotonic() - started) * 1000, 2)
+            except BaseException as e:
+                # Повертаємо незаписані зміни, якщо їх ще не перезаписали новіші
+                for storage_key, record in batch.items():
+                    self._dirty.setdefault(storage_key, record)
+                if not isinstance(e, Exception):
+                    raise
+                self._flush_errors += 1
+                logging.error(f"❌ Помилка запису станів FSM в БД: {e}")
+
+    async def _write_batch(self, session, batch: dict):
+        to_delete = [key for key, record in batch.items() if record["state"] is None and not record["data"]]
+        to_upsert = [(key, record) for key, record in batch.items() if record["state"] is not None or record["data"]]
+        if to_delete:
+            await session.execute("DELETE FROM fsm_states WHERE storage_key = ANY(%s::text[]);", (to_delete,))
+        if to_upsert:
+            await session.execute(
+                """INSERT INTO fsm_states (storage_key, state, data, updated_at, expires_at)
+                   SELECT k, s, d::jsonb, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + make_interval(secs => %s)
+                   FROM unnest(%s::text[], %s::text[], %s::text[]) AS t(k, s, d)
+                   ON CONFLICT (storage_key) DO UPDATE
+                   SET state = EXCLUDED.state, data = EXCLUDED.data,
+                       updated_at = EXCLUDED.updated_at, expires_at = EXCLUDED.expires_at;""",
+                (
+                    FSM_STATE_TTL,
+                    [key for key, _ in to_upsert],
+                    [record["state"] for _, record in to_upsert],
+                    [json.dumps(record["data"], ensure_ascii=False, default=str) for _, record in to_upsert],
+                )
+            )
+
+    async def _cleanup_expired(self):
+        self._last_cleanup = time.monotonic()
+        try:
+            deleted = await self.database.execute("DELETE FROM fsm_states WHERE expires_at < CURRENT_TIMESTAMP;")
+            if deleted:
+                logging.info(f"ℹ️ Видалено {deleted} прострочених станів FSM.")
+        except Exception as e:
+            logging.error(f"❌ Помилка видалення прострочених станів FSM: {e}")
+
+    async def close(self) -> None:
+        """Зупиняє фонову задачу і записує залишок змін."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "cache": self._cache.stats(),
+            "dirty": len(self._dirty),
+            "flushes": self._flushes,
+            "flush_errors": self._flush_errors,
+            "last_flush_ms": self._last_flush_ms,
+        }
@@ -0,0 +1,171 @@
+import os
+import uuid
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+
+from cache import TTLCache
+from workers import WEB_CONCURRENCY
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bot_image_cache")) # Каталог дискового кешу зображень
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", 256)) # Максимальний розмір кешу (МБ) на всі процеси бота разом; 0 — кеш вимкнено
+
+ORIGINAL = "original"
+
+
+class ImageCache:
+    """
+    Дисковий кеш файлів Telegram, адресований за file_unique_id.
+
+    file_unique_id однаковий для того самого файлу незалежно від file_id, тому повторна обробка фото
+    (поворот, орієнтація, хеш) не завантажує його з Telegram вдруге. Поруч з оригіналом зберігаються
+    похідні варіанти ("rotate90", "oriented", ...). При перевищенні IMAGE_CACHE_MAX_MB витісняються
+    найдавніше використані файли; порядок використання зберігається в mtime, тож переживає перезапуск.
+    Відповідність file_id → file_unique_id запам'ятовується в пам'яті (remember/resolve).
+
+    Розмір кожен процес рахує лише за своїм індексом, тому при WEB_CONCURRENCY > 1 процес отримує
+    свою частку IMAGE_CACHE_MAX_MB, і разом процеси не займають більше за заданий ліміт.
+    """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_MB * 1024 * 1024 // WEB_CONCURRENCY):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # шлях → розмір, від найдавніше використаного
+        self._size = 0
+        self._aliases = TTLCache(maxsize=100000, ttl=86400)
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def remember(self, file_id: str, file_unique_id: str):
+        """Запам'ятовує file_unique_id для file_id (відомий з повідомлення або getFile)."""
+        self._aliases.set(file_id, file_unique_id)
+
+    def resolve(self, file_id: str):
+        """Повертає file_unique_id для file_id або None, якщо він ще не відомий."""
+        return self._aliases.get(file_id)
+
+    def _path(self, file_unique_id: str, variant: str) -> str:
+        return os.path.join(self.directory, file_unique_id[:2], f"{file_unique_id}.{variant}")
+
+    def _scan(self) -> list:
+        """Читає вміст каталогу кешу (у потоці): [(mtime, шлях, розмір), ...]."""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        return sorted(files)
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            try:
+                for _, path, size in await asyncio.to_thread(self._scan):
+                    self._entries[path] = size
+                    self._size += size
+                logging.info(f"✅ Кеш зображень: {len(self._entries)} файлів, {self._size // 1024} КБ ({self.directory}).")
+            except OSError as e:
+                logging.error(f"❌ Помилка читання каталогу кешу зображень: {e}")
+            self._loaded = True
+            await self._evict()
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path) # Позначаємо використання для порядку LRU після перезапуску
+        return data
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path) # Інші процеси ніколи не побачать недописаний файл
+
+    def _forget(self, path: str):
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self._size -= size
+
+    async def get(self, file_unique_id: str, variant: str = ORIGINAL):
+        """Повертає байти варіанту файлу з кешу або None."""
+        if not self.max_bytes or not file_unique_id:
+            return None
+        await self._ensure_loaded()
+        path = self._path(file_unique_id, variant)
+        try:
+            # Файл міг записати інший процес, тому читаємо з диска навіть без запису в індексі
+            data = await asyncio.to_thread(self._read, path)
+        except OSError:
+            self._forget(path)
+            self.misses += 1
+            return None
+        if path not in self._entries:
+            self._entries[path] = len(data)
+            self._size += len(data)
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return data
+
+    async def put(self, file_unique_id: str, data: bytes, variant: str = ORIGINAL):
+        """Зберігає варіант файлу в кеш, витісняючи найдавніше використані файли."""
+        if not self.max_bytes or not file_unique_id or len(data) > self.max_bytes:
+            return
+        await self._ensure_loaded()
+        path = self._path(file_unique_id, variant)
+        try:
+            await asyncio.to_thread(self._write, path, data)
+        except OSError as e:
+            logging.warning(f"⚠️ Не вдалося записати файл у кеш зображень: {e}")
+            return
+        self._forget(path)
+        self._entries[path] = len(data)
+        self._size += len(data)
+        await self._evict()
+
+    async def _evict(self):
+        victims = []
+        while self._size > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._size -= size
+            victims.append(path)
+        if not victims:
+            return
+        self.evictions += len(victims)
+        await asyncio.to_thread(self._remove, victims)
+
+    @staticmethod
+    def _remove(paths: list):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._entries),
+            "size_mb": round(self._size / 1024 / 1024, 2),
+            "max_mb": round(self.max_bytes / 1024 / 1024, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "aliases": len(self._aliases),
+        }
+
+
+image_cache = ImageCache()
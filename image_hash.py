@@ -0,0 +1,66 @@
+import os
+import io
+from itertools import combinations
+
+from PIL import Image
+
+DUPLICATE_PHOTO_DISTANCE = int(os.getenv("DUPLICATE_PHOTO_DISTANCE", 6)) # Максимальна відстань Геммінга між dHash схожих фото (з 64 біт)
+
+HASH_BITS = 64
+HASH_CHUNKS = 4 # На скільки частин ділиться хеш для пошуку (по 16 біт, кожна частина — окремий індекс у БД)
+CHUNK_BITS = HASH_BITS // HASH_CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def dhash(data) -> bytes:
+    """
+    Перцептивний хеш (dHash) зображення: 64 біти, 8 байт.
+    Зображення зменшується до 9×8 у відтінках сірого, кожен біт — чи яскравіший піксель за сусіда праворуч.
+    JPEG одразу декодується зменшеним (draft), тож повне зображення в пам'ять не розпаковується.
+    """
+    with Image.open(io.BytesIO(bytes(data))) as image:
+        image.draft("L", (64, 64))
+        small = image.convert("L").resize((9, 8), Image.Resampling.BOX)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value.to_bytes(HASH_BITS // 8, 'big')
+
+
+def hash_chunks(value: int) -> list:
+    """Ділить хеш на HASH_CHUNKS частин, від старших бітів до молодших (як h0..h3 в таблиці photo_hashes)."""
+    return [(value >> (CHUNK_BITS * (HASH_CHUNKS - 1 - i))) & CHUNK_MASK for i in range(HASH_CHUNKS)]
+
+
+def chunk_probes(hashes: list, max_distance: int = DUPLICATE_PHOTO_DISTANCE) -> list:
+    """
+    Значення частин хеша, які треба знайти в індексах (multi-index hashing).
+    Якщо два хеші відрізняються не більше ніж на max_distance біт, то хоча б одна з HASH_CHUNKS частин
+    відрізняється не більше ніж на max_distance // HASH_CHUNKS біт. Тому достатньо знайти всі записи,
+    у яких якась частина збігається з відповідною частиною шуканого хеша з точністю до цієї кількості біт.
+    Повертає HASH_CHUNKS списків значень — по одному на кожну частину.
+    """
+    radius = max_distance // HASH_CHUNKS
+    flips = [0]
+    for bits in range(1, radius + 1):
+        flips += [sum(1 << bit for bit in combination) for combination in combinations(range(CHUNK_BITS), bits)]
+    probes = [set() for _ in range(HASH_CHUNKS)]
+    for value in hashes:
+        for i, chunk in enumerate(hash_chunks(value)):
+            probes[i].update(chunk ^ flip for flip in flips)
+    return [sorted(values) for values in probes]
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return ((a ^ b) & ((1 << HASH_BITS) - 1)).bit_count()
+
+
+def to_signed(value: int) -> int:
+    """Беззнаковий 64-бітний хеш → значення для колонки BIGINT."""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value: int) -> int:
+    return value & ((1 << HASH_BITS) - 1)
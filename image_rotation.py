@@ -0,0 +1,168 @@
+import os
+import io
+import shutil
+import logging
+import subprocess
+
+from PIL import Image, ImageOps, JpegImagePlugin
+
+JPEGTRAN_PATH = os.getenv("JPEGTRAN_PATH") or shutil.which("jpegtran") # Шлях до jpegtran (libjpeg-turbo), якщо встановлено
+ROTATE_BY_EXIF_TAG = os.getenv("ROTATE_BY_EXIF_TAG", "false").lower() == "true" # Повертати лише зміною тегу Orientation (для файлів-документів)
+JPEGTRAN_TIMEOUT = 30 # Максимальний час роботи jpegtran (сек)
+
+# Обмеження Telegram для фото (sendPhoto)
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+PHOTO_MAX_DIMENSIONS_SUM = 10000
+PHOTO_MAX_SIDE = 2560 # Більші фото Telegram однаково зменшує до цього розміру
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Поворот за годинниковою стрілкою → метод Pillow
+TRANSPOSE_BY_DEGREES = {
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90,
+}
+
+# Значення EXIF Orientation без дзеркалення після повороту на 90° за годинниковою стрілкою
+ORIENTATION_AFTER_CLOCKWISE_TURN = {1: 6, 6: 3, 3: 8, 8: 1}
+# На скільки градусів за годинниковою стрілкою треба повернути пікселі для значення Orientation
+DEGREES_BY_ORIENTATION = {3: 180, 6: 90, 8: 270}
+
+
+def rotate_image(data, degrees: int = 90) -> bytes:
+    """
+    Повертає зображення на degrees (кратне 90) за годинниковою стрілкою, якомога менше втрачаючи якість.
+
+    1. ROTATE_BY_EXIF_TAG — змінюється лише тег EXIF Orientation, пікселі не чіпаються.
+    2. jpegtran -perfect — поворот без втрат: переставляються DCT-блоки, без декодування.
+    3. Image.transpose — з перекодуванням, але з тими самими таблицями квантування,
+       субдискретизацією, EXIF (Orientation скинуто) та ICC-профілем, що й в оригіналі.
+    Повороти накопичуються на боці бота і застосовуються до оригінального файлу одним викликом.
+    """
+    degrees %= 360
+    data = bytes(data)
+    if degrees == 0:
+        return data
+    if degrees not in TRANSPOSE_BY_DEGREES:
+        raise ValueError(f"Кут повороту має бути кратним 90°: {degrees}")
+
+    if ROTATE_BY_EXIF_TAG:
+        result = rotate_exif_orientation(data, degrees)
+        if result is not None:
+            return result
+
+    with Image.open(io.BytesIO(data)) as image:
+        is_jpeg = image.format == 'JPEG'
+        orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    # jpegtran не враховує тег Orientation, тому зображення з ним повертаємо через Pillow
+    if is_jpeg and orientation == 1 and JPEGTRAN_PATH:
+        result = jpegtran_rotate(data, degrees)
+        if result is not None:
+            return result
+    return transpose_rotate(data, degrees)
+
+
+def auto_orient(data) -> bytes:
+    """
+    Нормалізує зображення для надсилання як фото: застосовує тег EXIF Orientation до пікселів
+    і зменшує занадто великі зображення до обмежень Telegram.
+    JPEG без тегу, що вже вкладається в обмеження, повертається без змін.
+    """
+    data = bytes(data)
+    with Image.open(io.BytesIO(data)) as image:
+        is_jpeg = image.format == 'JPEG'
+        orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        fits = len(data) <= PHOTO_MAX_BYTES and sum(image.size) <= PHOTO_MAX_DIMENSIONS_SUM and max(image.size) <= PHOTO_MAX_SIDE
+    if is_jpeg and fits:
+        if orientation == 1:
+            return data
+        if orientation in DEGREES_BY_ORIENTATION and JPEGTRAN_PATH:
+            # Без втрат; EXIF не копіюємо, щоб тег не повернув зображення вдруге
+            result = jpegtran_rotate(data, DEGREES_BY_ORIENTATION[orientation], copy="none")
+            if result is not None:
+                return result
+    return transpose_rotate(data, 0, max_side=PHOTO_MAX_SIDE)
+
+
+def jpegtran_rotate(data: bytes, degrees: int, copy: str = "all"):
+    """Поворот JPEG без втрат через jpegtran. Повертає None, якщо без втрат неможливо (розмір не кратний MCU)."""
+    try:
+        completed = subprocess.run(
+            [JPEGTRAN_PATH, "-rotate", str(degrees), "-perfect", "-copy", copy, "-optimize"],
+            input=data, capture_output=True, timeout=JPEGTRAN_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.warning(f"⚠️ jpegtran недоступний: {e}")
+        return None
+    if completed.returncode != 0 or not completed.stdout:
+        return None
+    return completed.stdout
+
+
+def transpose_rotate(data: bytes, degrees: int, max_side: int = None) -> bytes:
+    """Поворот з перекодуванням, що зберігає параметри якості джерела. max_side — зменшити до цього розміру."""
+    with Image.open(io.BytesIO(data)) as image:
+        save_kwargs = {"format": "JPEG", "optimize": True}
+        if image.format == 'JPEG':
+            # Ті самі таблиці квантування та субдискретизація — без додаткової втрати якості на перекодуванні
+            save_kwargs["qtables"] = image.quantization
+            subsampling = JpegImagePlugin.get_sampling(image)
+            if subsampling != -1:
+                save_kwargs["subsampling"] = subsampling
+        else:
+            save_kwargs["quality"] = 95
+        if image.info.get("icc_profile"):
+            save_kwargs["icc_profile"] = image.info["icc_profile"]
+        exif = image.getexif()
+
+        # Спочатку застосовуємо наявний тег Orientation, потім сам поворот
+        rotated = ImageOps.exif_transpose(image)
+        if degrees:
+            rotated = rotated.transpose(TRANSPOSE_BY_DEGREES[degrees])
+        if max_side and max(rotated.size) > max_side:
+            rotated.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if rotated.mode not in ("RGB", "L", "CMYK"):
+            rotated = rotated.convert("RGB")
+        if exif:
+            exif[EXIF_ORIENTATION_TAG] = 1
+            save_kwargs["exif"] = exif.tobytes()
+
+    byte_arr = io.BytesIO()
+    rotated.save(byte_arr, **save_kwargs)
+    return byte_arr.getvalue()
+
+
+def rotate_exif_orientation(data: bytes, degrees: int):
+    """
+    Змінює лише значення тегу EXIF Orientation у заголовку JPEG (решта файлу без змін).
+    Повертає None, якщо тегу немає або зображення віддзеркалене.
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if marker == 0xDA: # Початок даних зображення — далі заголовків немає
+            return None
+        if marker == 0xE1 and data[pos + 4:pos + 10] == b'Exif\x00\x00':
+            tiff = pos + 10
+            order = 'little' if data[tiff:tiff + 2] == b'II' else 'big'
+            ifd = tiff + int.from_bytes(data[tiff + 4:tiff + 8], order)
+            for i in range(int.from_bytes(data[ifd:ifd + 2], order)):
+                entry = ifd + 2 + i * 12
+                if int.from_bytes(data[entry:entry + 2], order) != EXIF_ORIENTATION_TAG:
+                    continue
+                value_pos = entry + 8
+                orientation = int.from_bytes(data[value_pos:value_pos + 2], order)
+                for _ in range(degrees // 90):
+                    orientation = ORIENTATION_AFTER_CLOCKWISE_TURN.get(orientation)
+                    if orientation is None:
+                        return None
+                result = bytearray(data)
+                result[value_pos:value_pos + 2] = orientation.to_bytes(2, order)
+                return bytes(result)
+            return None
+        pos += 2 + length
+    return None
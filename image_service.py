@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from image_rotation import rotate_image, auto_orient
+from image_hash import dhash
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1)) # Скільки процесів обробляють зображення
+IMAGE_MAX_IN_FLIGHT = int(os.getenv("IMAGE_MAX_IN_FLIGHT", IMAGE_WORKERS * 2)) # Скільки зображень одночасно в обробці або в черзі пулу
+IMAGE_SHM_THRESHOLD = int(os.getenv("IMAGE_SHM_THRESHOLD", 256 * 1024)) # З якого розміру (байт) передавати зображення через спільну пам'ять
+
+
+# Операції, що виконуються в процесах пулу.
+# Кожна операція приймає байти зображення та параметри і повертає байти (нове зображення або хеш).
+OPERATIONS = {
+    "rotate": rotate_image,
+    "auto_orient": auto_orient,
+    "dhash": dhash,
+}
+
+
+def _run_operation(operation: str, payload, size: int, kwargs: dict):
+    """
+    Точка входу в процесі пулу.
+    payload — байти зображення або ім'я блоку спільної пам'яті (якщо size > 0).
+    Великий результат так само повертається через спільну пам'ять: ('shm', ім'я, розмір).
+    """
+    if size:
+        shm = shared_memory.SharedMemory(name=payload)
+        view = shm.buf[:size]
+        try:
+            result = OPERATIONS[operation](view, **kwargs)
+        finally:
+            view.release()
+            shm.close()
+    else:
+        result = OPERATIONS[operation](payload, **kwargs)
+    if len(result) <= IMAGE_SHM_THRESHOLD:
+        return result
+    out = shared_memory.SharedMemory(create=True, size=len(result))
+    out.buf[:len(result)] = result
+    out.close()
+    return ("shm", out.name, len(result))
+
+
+class ImageService:
+    """
+    Обробка зображень у пулі процесів, щоб декодування/кодування не блокувало цикл подій бота.
+
+    API — байти на вході, байти на виході: await image_service.run("rotate", data, degrees=90).
+    Одночасно в обробці не більше IMAGE_MAX_IN_FLIGHT зображень, решта чекає тут, а не в черзі пулу.
+    Зображення, більші за IMAGE_SHM_THRESHOLD, передаються через спільну пам'ять, а не через pipe.
+    Пул створюється при першому використанні і закривається в on_shutdown_webhook.
+    """
+
+    def __init__(self, workers: int = IMAGE_WORKERS, max_in_flight: int = IMAGE_MAX_IN_FLIGHT):
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self._executor = None
+        self._slots = None
+        self._in_flight = 0
+        self._waiting = 0
+        self._processed = 0
+        self._errors = 0
+        self._shm_transfers = 0
+        self._duration_total = 0.0
+        self._duration_max = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            logging.info(f"✅ Пул обробки зображень запущено (процесів={self.workers}).")
+        return self._executor
+
+    async def run(self, operation: str, data: bytes, **kwargs) -> bytes:
+        """Виконує операцію над зображенням у пулі процесів і повертає результат."""
+        if operation not in OPERATIONS:
+            raise ValueError(f"Невідома операція з зображенням: {operation}")
+        executor = self._get_executor()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+        started = time.monotonic()
+        shm = None
+        try:
+            if len(data) > IMAGE_SHM_THRESHOLD:
+                shm = shared_memory.SharedMemory(create=True, size=len(data))
+                shm.buf[:len(data)] = data
+                payload, size = shm.name, len(data)
+                self._shm_transfers += 1
+            else:
+                payload, size = data, 0
+            future = asyncio.get_running_loop().run_in_executor(executor, _run_operation, operation, payload, size, kwargs)
+            try:
+                # Якщо виклик скасовано, дочікуємось процесу, щоб не звільнити спільну пам'ять, яку він ще читає
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                await asyncio.wait({future})
+                if not future.cancelled() and future.exception() is None:
+                    self._read_result(future.result())
+                raise
+            return self._read_result(result)
+        except Exception:
+            self._errors += 1
+            raise
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            duration = time.monotonic() - started
+            self._processed += 1
+            self._duration_total += duration
+            self._duration_max = max(self._duration_max, duration)
+            self._in_flight -= 1
+            self._slots.release()
+
+    def _read_result(self, result) -> bytes:
+        if not isinstance(result, tuple):
+            return result
+        _, name, size = result
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            self._shm_transfers += 1
+            return bytes(shm.buf[:size])
+        finally:
+            shm.close()
+            shm.unlink()
+
+    async def close(self):
+        """Зупиняє пул процесів."""
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+        logging.info("✅ Пул обробки зображень зупинено.")
+
+    def stats(self) -> dict:
+        processed = self._processed or 1
+        return {
+            "workers": self.workers,
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "processed": self._processed,
+            "errors": self._errors,
+            "shm_transfers": self._shm_transfers,
+            "duration_ms_avg": round(self._duration_total / processed * 1000, 2),
+            "duration_ms_max": round(self._duration_max * 1000, 2),
+        }
+
+
+image_service = ImageService()
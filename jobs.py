@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1)) # Як часто перевіряти таблицю задач (сек)
+JOB_LEASE = int(os.getenv("JOB_LEASE", 300)) # Скільки секунд задача закріплена за процесом, що її виконує
+JOB_HEARTBEAT_INTERVAL = JOB_LEASE / 3 # Як часто продовжувати оренду задачі, що ще виконується (сек)
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", 5)) # Базова затримка перед повтором (сек), подвоюється з кожною спробою
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", 7)) # Скільки днів зберігати виконані задачі
+JOB_CLEANUP_INTERVAL = 3600 # Як часто видаляти старі виконані задачі (сек)
+
+
+class JobQueue:
+    """
+    Черга фонових задач: таблиця jobs у PostgreSQL + asyncio-воркери в кожному процесі.
+
+    Тип задачі реєструється декоратором @job_queue.job("тип", concurrency=N, max_attempts=M);
+    обробник отримує словник задачі (id, payload, attempts). Задача, що впала з винятком,
+    повторюється з експоненційною затримкою, після max_attempts отримує статус 'failed'.
+    Одночасно виконується не більше concurrency задач кожного типу в процесі.
+    Задачі забираються з FOR UPDATE SKIP LOCKED, тому кілька процесів не виконають одну задачу двічі,
+    а задача процесу, що впав, повертається в роботу після закінчення оренди (JOB_LEASE).
+    Поки обробник працює, оренда продовжується кожні JOB_HEARTBEAT_INTERVAL секунд, тож довга задача
+    (пакетний поворот фото, велике завантаження) не буде взята іншим процесом удруге.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._handlers = {}
+        self._running = {}
+        self._tasks = set()
+        self._wakeup = asyncio.Event()
+        self._loop_task = None
+        self._stopping = False
+        self._last_cleanup = 0.0
+        self._stats = {}
+
+    def job(self, job_type: str, concurrency: int = 1, max_attempts: int = 3):
+        """Декоратор, що реєструє обробник задач типу job_type."""
+        def decorator(handler):
+            self._handlers[job_type] = (handler, concurrency, max_attempts)
+            self._running[job_type] = 0
+            self._stats[job_type] = {"done": 0, "retried": 0, "failed": 0, "duration_total": 0.0, "delay_total": 0.0, "delay_max": 0.0}
+            return handler
+        return decorator
+
+    async def enqueue(self, job_type: str, payload: dict, delay: float = 0, session=None):
+        """
+        Додає задачу в чергу і повертає її ID (None — якщо не вдалося записати).
+        session — записати задачу в уже відкритій транзакції (разом зі зміною даних, яку вона доповнює);
+        задача стане видимою лише після коміту, тож після нього варто викликати wakeup().
+        """
+        if job_type not in self._handlers:
+            raise ValueError(f"Невідомий тип задачі: {job_type}")
+        query = """INSERT INTO jobs (job_type, payload, max_attempts, run_at)
+                   VALUES (%s, %s::jsonb, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+                   RETURNING id;"""
+        params = (job_type, json.dumps(payload, ensure_ascii=False), self._handlers[job_type][2], delay)
+        try:
+            if session is not None:
+                job_id = await session.fetchval(query, params)
+            else:
+                job_id = await self.database.fetchval(query, params)
+        except Exception as e:
+            logging.error(f"❌ Помилка додавання задачі {job_type} в чергу: {e}")
+            return None
+        if delay <= 0 and session is None:
+            self._wakeup.set()
+        return job_id
+
+    def wakeup(self):
+        """Будить цикл вибору задач (після коміту транзакції, в якій задачі додано через session)."""
+        self._wakeup.set()
+
+    def start(self):
+        """Запускає цикл, що забирає задачі з таблиці та розподіляє їх між воркерами."""
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                await self._claim_and_run()
+                if time.monotonic() - self._last_cleanup > JOB_CLEANUP_INTERVAL:
+                    await self._cleanup_finished()
+            except Exception as e:
+                logging.error(f"❌ Помилка вибору задач з черги: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _claim_and_run(self):
+        token = uuid.uuid4().hex
+        for job_type, (handler, concurrency, max_attempts) in self._handlers.items():
+            free = concurrency - self._running[job_type]
+            if free <= 0 or self._stopping:
+                continue
+            jobs = await self.database.fetchall(
+                """UPDATE jobs SET status = 'running', attempts = attempts + 1, claim_token = %s,
+                       started_at = CURRENT_TIMESTAMP, locked_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                   WHERE id IN (
+                       SELECT id FROM jobs
+                       WHERE job_type = %s
+                         AND ((status = 'queued' AND run_at <= CURRENT_TIMESTAMP)
+                              OR (status = 'running' AND locked_until < CURRENT_TIMESTAMP))
+                       ORDER BY run_at, id
+                       LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING id, job_type, payload, attempts, max_attempts, claim_token,
+                             EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - run_at)::float AS delay;""",
+                (token, JOB_LEASE, job_type, free)
+            )
+            for job in jobs:
+                self._running[job_type] += 1
+                task = asyncio.create_task(self._run(handler, job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, handler, job: dict):
+        job_type = job['job_type']
+        stats = self._stats[job_type]
+        stats["delay_total"] += job['delay'] or 0.0
+        stats["delay_max"] = max(stats["delay_max"], job['delay'] or 0.0)
+        started = time.monotonic()
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            try:
+                await handler(job)
+            finally:
+                heartbeat.cancel()
+        except asyncio.CancelledError:
+            # Процес зупиняється: повертаємо задачу в чергу без втрати спроби
+            await asyncio.shield(self._finish(job, "queued", attempts_delta=-1))
+            raise
+        except Exception as e:
+            if job['attempts'] >= job['max_attempts']:
+                stats["failed"] += 1
+                logging.error(f"❌ Задачу {job_type} #{job['id']} скасовано після {job['attempts']} спроб: {e}")
+                await self._finish(job, "failed", error=str(e))
+            else:
+                stats["retried"] += 1
+                retry_delay = JOB_RETRY_DELAY * 2 ** (job['attempts'] - 1)
+                logging.warning(f"⚠️ Задача {job_type} #{job['id']} завершилась помилкою (спроба {job['attempts']}), повтор через {retry_delay:.0f} с: {e}")
+                await self._finish(job, "queued", error=str(e), retry_delay=retry_delay)
+        else:
+            stats["done"] += 1
+            await self._finish(job, "done")
+        finally:
+            stats["duration_total"] += time.monotonic() - started
+            self._running[job_type] -= 1
+            self._wakeup.set() # Звільнилось місце для наступної задачі цього типу
+
+    async def _heartbeat(self, job: dict):
+        """Продовжує оренду задачі, поки її обробник працює."""
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                extended = await self.database.execute(
+                    """UPDATE jobs SET locked_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                       WHERE id = %s AND claim_token = %s AND status = 'running';""",
+                    (JOB_LEASE, job['id'], job['claim_token'])
+                )
+            except Exception as e:
+                logging.warning(f"⚠️ Не вдалося продовжити оренду задачі #{job['id']}: {e}")
+                continue
+            if not extended:
+                logging.warning(f"⚠️ Оренду задачі {job['job_type']} #{job['id']} втрачено: її міг узяти інший процес.")
+                return
+
+    async def _finish(self, job: dict, status: str, error: str = None, retry_delay: float = 0, attempts_delta: int = 0):
+        try:
+            await self.database.execute(
+                """UPDATE jobs SET status = %s, last_error = COALESCE(%s, last_error), attempts = attempts + %s,
+                       run_at = CASE WHEN %s = 'queued' THEN CURRENT_TIMESTAMP + make_interval(secs => %s) ELSE run_at END,
+                       finished_at = CASE WHEN %s IN ('done', 'failed') THEN CURRENT_TIMESTAMP END,
+                       claim_token = NULL, locked_until = NULL
+                   WHERE id = %s AND claim_token = %s;""",
+                (status, error, attempts_delta, status, retry_delay, status, job['id'], job['claim_token'])
+            )
+        except Exception as e:
+            logging.error(f"❌ Помилка збереження статусу задачі #{job['id']}: {e}")
+
+    async def _cleanup_finished(self):
+        self._last_cleanup = time.monotonic()
+        deleted = await self.database.execute(
+            "DELETE FROM jobs WHERE status = 'done' AND finished_at < CURRENT_TIMESTAMP - make_interval(days => %s);",
+            (JOB_RETENTION_DAYS,)
+        )
+        if deleted:
+            logging.info(f"ℹ️ Видалено {deleted} виконаних задач.")
+
+    async def close(self, timeout: float = 10):
+        """Зупиняє вибір нових задач і чекає завершення поточних (не довше timeout секунд)."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._loop_task is not None:
+            await asyncio.wait({self._loop_task})
+            self._loop_task = None
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def stats(self) -> dict:
+        result = {}
+        for job_type, stats in self._stats.items():
+            finished = (stats["done"] + stats["retried"] + stats["failed"]) or 1
+            result[job_type] = {
+                "running": self._running[job_type],
+                "concurrency": self._handlers[job_type][1],
+                "done": stats["done"],
+                "retried": stats["retried"],
+                "failed": stats["failed"],
+                "duration_ms_avg": round(stats["duration_total"] / finished * 1000, 2),
+                "queue_delay_ms_avg": round(stats["delay_total"] / finished * 1000, 2),
+                "queue_delay_ms_max": round(stats["delay_max"] * 1000, 2),
+            }
+        return result
@@ -0,0 +1,66 @@
+import os
+import asyncio
+
+from aiogram.types import Update
+
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", 0.6)) # Скільки секунд чекати на наступні фото альбому
+
+
+class MediaGroupCollector:
+    """
+    Збирає повідомлення одного альбому (спільний media_group_id) в одне оновлення.
+
+    Перше повідомлення альбому відкриває буфер на MEDIA_GROUP_WINDOW секунд; кожна наступна частина
+    продовжує вікно. Коли вікно закривається, весь альбом передається обробнику одним викликом:
+    обробник отримує перше повідомлення як event і всі повідомлення в параметрі album.
+    """
+
+    def __init__(self, on_album, window: float = MEDIA_GROUP_WINDOW):
+        # on_album(chat_key, updates) — що робити з готовим альбомом (зазвичай поставити в чергу чату)
+        self.on_album = on_album
+        self.window = window
+        self._groups = {}
+        self._albums = 0
+        self._parts = 0
+
+    def collect(self, chat_key, update: Update) -> bool:
+        """Буферизує частину альбому. Повертає False, якщо оновлення не є частиною альбому."""
+        message = update.message
+        if message is None or message.media_group_id is None:
+            return False
+        group_key = (chat_key, message.media_group_id)
+        group = self._groups.get(group_key)
+        if group is None:
+            group = self._groups[group_key] = {"chat_key": chat_key, "updates": [], "timer": None}
+        else:
+            group["timer"].cancel()
+        group["updates"].append(update)
+        group["timer"] = asyncio.get_running_loop().call_later(self.window, self.flush, group_key)
+        self._parts += 1
+        return True
+
+    def flush(self, group_key):
+        """Закриває буфер альбому і передає його далі."""
+        group = self._groups.pop(group_key, None)
+        if group is None:
+            return
+        group["timer"].cancel()
+        updates = sorted(group["updates"], key=lambda u: u.message.message_id)
+        self._albums += 1
+        self.on_album(group["chat_key"], updates)
+
+    def flush_chat(self, chat_key):
+        """
+        Одразу передає всі відкриті альбоми чату.
+        Викликається перед звичайним оновленням цього чату, щоб не порушити порядок оновлень.
+        """
+        for group_key in [key for key in self._groups if key[0] == chat_key]:
+            self.flush(group_key)
+
+    def flush_all(self):
+        """Одразу передає всі відкриті альбоми (при зупинці процесу)."""
+        for group_key in list(self._groups):
+            self.flush(group_key)
+
+    def stats(self) -> dict:
+        return {"open_albums": len(self._groups), "albums": self._albums, "album_parts": self._parts}
@@ -0,0 +1,324 @@
+import logging
+
+from db import database
+from prices import parse_price
+
+# Ключ advisory-блокування, щоб кілька процесів не застосовували міграції одночасно
+MIGRATIONS_LOCK_KEY = 96_000_001
+PRICE_BACKFILL_BATCH = 1000 # Скільки товарів розбирати за один запит при заповненні amount_minor
+
+
+async def enable_trigram_search(session):
+    """
+    Вмикає pg_trgm для пошуку назв з помилками, якщо розширення доступне на сервері.
+    Без нього (або без прав на CREATE EXTENSION) пошук працює лише за повнотекстовим індексом.
+    """
+    if not await session.fetchone("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm';"):
+        logging.warning("⚠️ Розширення pg_trgm недоступне: пошук з помилками в словах вимкнено.")
+        return
+    await session.execute("SAVEPOINT enable_trigram_search;")
+    try:
+        await session.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        await session.execute(
+            "CREATE INDEX IF NOT EXISTS idx_products_name_trgm ON products USING GIN (lower(name) gin_trgm_ops) WHERE status = 'published';"
+        )
+        await session.execute("RELEASE SAVEPOINT enable_trigram_search;")
+    except Exception as e:
+        await session.execute("ROLLBACK TO SAVEPOINT enable_trigram_search;")
+        logging.warning(f"⚠️ Не вдалося увімкнути pg_trgm: {e}")
+
+
+def batched(step):
+    """
+    Позначає крок міграції, який виконується після коміту її DDL, пакетами — кожен пакет в окремій транзакції.
+    Такий крок отримує базу даних і версію міграції; прогрес (останній оброблений id) зберігається в migration_progress,
+    тож після перезапуску крок продовжує з того місця, де зупинився. Версія записується, лише коли крок завершено.
+    """
+    step.batched = True
+    return step
+
+
+@batched
+async def backfill_structured_prices(database, version: int):
+    """
+    Заповнює amount_minor і currency для наявних товарів з текстової ціни (prices.parse_price).
+    Кожен пакет (PRICE_BACKFILL_BATCH товарів за id) комітиться окремо, тож рядки products не лишаються
+    заблокованими до кінця заповнення всієї таблиці і запити бота чекають щонайбільше один пакет.
+    Нерозпізнані ціни лишаються з NULL — вони показуються як текст, але не потрапляють у фільтр за ціною.
+    """
+    last_id = await database.fetchval("SELECT last_id FROM migration_progress WHERE version = %s;", (version,)) or 0
+    updated, unparsed = 0, 0
+    while True:
+        async with database.transaction() as session:
+            rows = await session.fetchall(
+                "SELECT id, price FROM products WHERE id > %s ORDER BY id LIMIT %s;",
+                (last_id, PRICE_BACKFILL_BATCH)
+            )
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            ids, prices, amounts, currencies = [], [], [], []
+            for row in rows:
+                parsed = parse_price(row['price'])
+                if parsed is None or parsed[0] is None:
+                    unparsed += parsed is None
+                    continue
+                ids.append(row['id'])
+                prices.append(row['price'])
+                amounts.append(parsed[0])
+                currencies.append(parsed[1])
+            if ids:
+                # Пропускаємо товари, ціну яких бот уже змінив (і розібрав) після читання пакета
+                updated += await session.execute(
+                    """UPDATE products p SET amount_minor = item.amount_minor, currency = item.currency
+                       FROM unnest(%s::int[], %s::text[], %s::bigint[], %s::text[]) AS item(id, price, amount_minor, currency)
+                       WHERE p.id = item.id AND p.price = item.price AND p.amount_minor IS NULL;""",
+                    (ids, prices, amounts, currencies)
+                )
+            await session.execute(
+                """INSERT INTO migration_progress (version, last_id) VALUES (%s, %s)
+                   ON CONFLICT (version) DO UPDATE SET last_id = EXCLUDED.last_id;""",
+                (version, last_id)
+            )
+    logging.info(f"ℹ️ Структуровані ціни заповнено для {updated} товарів, не розпізнано: {unparsed}.")
+
+
+# Версійовані міграції схеми. Кожна міграція — (версія, опис, кроки).
+# Крок — це SQL-рядок, async-функція, яка отримує сесію БД, або крок @batched (заповнення даних після DDL).
+# Міграція виконується в одній транзакції і записується в schema_migrations,
+# тому при наступних запусках DDL не виконується повторно.
+# Уже застосовані міграції НЕ змінюємо — лише додаємо нові в кінець списку.
+MIGRATIONS = [
+    (1, "Початкові таблиці products та product_photos", [
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username TEXT,
+            name TEXT NOT NULL,
+            price TEXT NOT NULL,
+            photos TEXT[],
+            location TEXT,
+            description TEXT NOT NULL,
+            delivery TEXT NOT NULL,
+            status TEXT DEFAULT 'moderation',
+            moderator_message_id BIGINT,
+            channel_message_id BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            published_at TIMESTAMP,
+            views INT DEFAULT 0,
+            republish_count INT DEFAULT 0
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS product_photos (
+            id SERIAL PRIMARY KEY,
+            product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            file_id TEXT NOT NULL,
+            photo_index INTEGER NOT NULL
+        );
+        """,
+    ]),
+    (2, "Індекси для списку товарів користувача, черги модерації та фото товару", [
+        # "Мої товари": WHERE user_id = ? ORDER BY created_at DESC, id DESC (пагінація за ключем)
+        "CREATE INDEX IF NOT EXISTS idx_products_user_created ON products (user_id, created_at DESC, id DESC);",
+        # Частковий індекс лише для товарів, що очікують на модерацію
+        "CREATE INDEX IF NOT EXISTS idx_products_moderation ON products (created_at) WHERE status = 'moderation';",
+        # Фото товару у правильному порядку
+        "CREATE INDEX IF NOT EXISTS idx_product_photos_product ON product_photos (product_id, photo_index);",
+    ]),
+    (3, "Таблиця станів FSM", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            storage_key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at);",
+    ]),
+    (4, "Черга публікацій у канал (transactional outbox)", [
+        """
+        CREATE TABLE IF NOT EXISTS channel_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            chat_id BIGINT NOT NULL,
+            payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            sent_chunks INTEGER NOT NULL DEFAULT 0,
+            message_ids BIGINT[] NOT NULL DEFAULT '{}',
+            claim_token TEXT,
+            locked_until TIMESTAMP,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        );
+        """,
+        # Диспетчер вибирає лише незавершені записи, тому індекс частковий
+        "CREATE INDEX IF NOT EXISTS idx_channel_outbox_due ON channel_outbox (next_attempt_at) WHERE status IN ('pending', 'sending');",
+        "CREATE INDEX IF NOT EXISTS idx_channel_outbox_product ON channel_outbox (product_id);",
+    ]),
+    (5, "Таблиця фонових задач", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            payload JSONB NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            claim_token TEXT,
+            locked_until TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+        """,
+        # Воркери вибирають лише незавершені задачі свого типу
+        "CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (job_type, run_at) WHERE status IN ('queued', 'running');",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs (finished_at) WHERE status = 'done';",
+    ]),
+    (6, "Перцептивні хеші фото товарів (пошук дублікатів)", [
+        """
+        CREATE TABLE IF NOT EXISTS photo_hashes (
+            product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            photo_index INTEGER NOT NULL,
+            hash BIGINT NOT NULL,
+            h0 INTEGER NOT NULL,
+            h1 INTEGER NOT NULL,
+            h2 INTEGER NOT NULL,
+            h3 INTEGER NOT NULL,
+            PRIMARY KEY (product_id, photo_index)
+        );
+        """,
+        # Multi-index hashing: окремий індекс для кожної 16-бітної частини хеша (див. image_hash.chunk_probes)
+        "CREATE INDEX IF NOT EXISTS idx_photo_hashes_h0 ON photo_hashes (h0);",
+        "CREATE INDEX IF NOT EXISTS idx_photo_hashes_h1 ON photo_hashes (h1);",
+        "CREATE INDEX IF NOT EXISTS idx_photo_hashes_h2 ON photo_hashes (h2);",
+        "CREATE INDEX IF NOT EXISTS idx_photo_hashes_h3 ON photo_hashes (h3);",
+    ]),
+    (7, "Повнотекстовий пошук товарів", [
+        # Назва важить більше за опис; апострофи прибираються так само, як у search.normalize_text
+        """
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', translate(coalesce(name, ''), $$'’ʼ`$$, '')), 'A') ||
+            setweight(to_tsvector('simple', translate(coalesce(description, ''), $$'’ʼ`$$, '')), 'B')
+        ) STORED;
+        """,
+        # Шукаємо лише серед опублікованих товарів, тому індекс частковий
+        "CREATE INDEX IF NOT EXISTS idx_products_search ON products USING GIN (search_vector) WHERE status = 'published';",
+        "CREATE INDEX IF NOT EXISTS idx_products_published ON products (published_at DESC, id DESC) WHERE status = 'published';",
+        enable_trigram_search,
+    ]),
+    (8, "Структурована ціна товару (amount_minor + currency)", [
+        "ALTER TABLE products ADD COLUMN IF NOT EXISTS amount_minor BIGINT;", # Сума в копійках/центах; NULL — договірна або нерозпізнана
+        "ALTER TABLE products ADD COLUMN IF NOT EXISTS currency TEXT;",
+        # Фільтр і сортування за ціною серед опублікованих товарів
+        "CREATE INDEX IF NOT EXISTS idx_products_price ON products (currency, amount_minor) WHERE status = 'published';",
+        backfill_structured_prices,
+    ]),
+    (9, "Останні відомі курси валют", [
+        """
+        CREATE TABLE IF NOT EXISTS exchange_rates (
+            currency TEXT PRIMARY KEY,
+            rate NUMERIC(14, 6) NOT NULL,
+            source TEXT NOT NULL,
+            fetched_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    (10, "Облік комісій з проданих товарів", [
+        # Один запис на кожен продаж (переопублікований товар можна продати знову).
+        # Без зовнішнього ключа на products: продавець може видалити проданий товар, а запис про комісію має лишитися
+        """
+        CREATE TABLE IF NOT EXISTS commissions (
+            id BIGSERIAL PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            seller_id BIGINT NOT NULL,
+            amount_minor BIGINT NOT NULL,
+            currency TEXT NOT NULL,
+            exchange_rate NUMERIC(14, 6) NOT NULL,
+            commission_rate NUMERIC(5, 4) NOT NULL,
+            commission_minor BIGINT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            paid_at TIMESTAMP
+        );
+        """,
+        # Звіти групують за продавцем або за часом; неоплачені — окремий невеликий індекс
+        "CREATE INDEX IF NOT EXISTS idx_commissions_seller ON commissions (seller_id, created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_commissions_created ON commissions (created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_commissions_unpaid ON commissions (seller_id, created_at) WHERE paid_at IS NULL;",
+    ]),
+]
+
+
+async def run_migrations():
+    """
+    Застосовує міграції, яких ще немає в таблиці schema_migrations.
+    Помилку міграції не приховує: бот не повинен запускатися на частково оновленій схемі.
+    """
+    try:
+        # Блокування тримає окрема транзакція до кінця всіх міграцій (разом з пакетними кроками, які комітяться окремо);
+        # інший процес, що чекав, побачить уже застосовані версії. Сама вона нічого не змінює і рядків не блокує.
+        # DB_QUERY_TIMEOUT розрахований на запити бота, а не на перебудову великої таблиці
+        # (згенерована колонка й індекси в міграції 7), тому міграції виконуються без обмеження часу запитів.
+        async with database.transaction(timeout=None) as lock_session:
+            await lock_session.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_KEY,))
+            async with database.transaction(timeout=None) as session:
+                await session.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                # Прогрес пакетних кроків (@batched) незавершених міграцій
+                await session.execute("""
+                    CREATE TABLE IF NOT EXISTS migration_progress (
+                        version INTEGER PRIMARY KEY,
+                        last_id BIGINT NOT NULL
+                    );
+                """)
+
+            applied = {row['version'] for row in await database.fetchall("SELECT version FROM schema_migrations;")}
+            for version, description, steps in MIGRATIONS:
+                if version in applied:
+                    continue
+                logging.info(f"ℹ️ Застосування міграції {version}: {description}")
+                batched_steps = [step for step in steps if getattr(step, 'batched', False)]
+                # DDL кожної міграції — окрема транзакція: якщо вона впаде, попередні залишаться застосованими
+                async with database.transaction(timeout=None) as session:
+                    for step in steps:
+                        if step in batched_steps:
+                            continue
+                        if callable(step):
+                            await step(session)
+                        else:
+                            await session.execute(step)
+                    if not batched_steps:
+                        await session.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+                            (version, description)
+                        )
+                if batched_steps:
+                    # DDL ідемпотентний (IF NOT EXISTS), тож після збою посередині заповнення він просто повториться,
+                    # а пакетні кроки продовжать з migration_progress
+                    for step in batched_steps:
+                        await step(database, version)
+                    async with database.transaction() as session:
+                        await session.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+                            (version, description)
+                        )
+                        await session.execute("DELETE FROM migration_progress WHERE version = %s;", (version,))
+                logging.info(f"✅ Міграцію {version} застосовано.")
+        logging.info("✅ Схема бази даних актуальна.")
+    except Exception as e:
+        logging.error(f"❌ Помилка застосування міграцій бази даних: {e}")
+        raise
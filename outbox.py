@@ -0,0 +1,243 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+
+from aiogram.types import InputMediaPhoto
+
+from rate_limiter import bulk_sends
+
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 2)) # Як часто перевіряти чергу публікацій (сек)
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 10)) # Скільки записів забирати з черги за раз
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5)) # Після скількох невдалих спроб публікацію скасовано
+OUTBOX_LEASE = int(os.getenv("OUTBOX_LEASE", 300)) # Скільки секунд запис закріплений за процесом, що його надсилає
+OUTBOX_RETRY_DELAY = 10 # Базова затримка перед повторною спробою (сек), подвоюється з кожною спробою
+
+MEDIA_GROUP_LIMIT = 10 # Максимум фото в одній медіагрупі Telegram
+
+
+class ChannelOutbox:
+    """
+    Фоновий диспетчер черги публікацій у канал (таблиця channel_outbox).
+
+    Обробник модератора лише записує пост у чергу в тій самій транзакції, що й статус товару,
+    а надсилання відбувається тут. Записи забираються пакетами з FOR UPDATE SKIP LOCKED,
+    тому кілька процесів не надішлють той самий пост. Кожна надіслана частина (медіагрупа)
+    одразу фіксується в БД — після перезапуску процесу надсилання продовжиться з наступної частини.
+
+    on_sent(row, message_ids) і on_failed(row, error) викликаються після успішної публікації
+    та після останньої невдалої спроби відповідно.
+    """
+
+    def __init__(self, database, bot, on_sent=None, on_failed=None):
+        self.database = database
+        self.bot = bot
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self._sent = 0
+        self._retried = 0
+        self._failed = 0
+        self._cancelled = 0
+        self._delay_total = 0.0
+        self._delay_max = 0.0
+        self._last_batch_ms = 0.0
+
+    def start(self):
+        """Запускає фонову задачу диспетчера."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def wake(self):
+        """Будить диспетчер, щоб новий запис було надіслано без очікування наступного опитування."""
+        self._wakeup.set()
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # Повний пакет означає, що в черзі, ймовірно, є ще записи
+                while await self.dispatch_batch() == OUTBOX_BATCH_SIZE and not self._stopping:
+                    pass
+            except Exception as e:
+                logging.error(f"❌ Помилка обробки черги публікацій: {e}")
+
+    async def _claim(self, token: str) -> list:
+        """Закріплює за цим процесом до OUTBOX_BATCH_SIZE записів, готових до надсилання."""
+        async with self.database.transaction() as session:
+            # Записи товарів, які вже зняли з публікації (продано, відправлено на модерацію), скасовуємо
+            cancelled = await session.execute(
+                """UPDATE channel_outbox o SET status = 'cancelled', locked_until = NULL
+                   FROM products p
+                   WHERE p.id = o.product_id AND p.status <> 'published' AND o.status = 'pending';"""
+            )
+            self._cancelled += max(cancelled, 0)
+            return await session.fetchall(
+                """UPDATE channel_outbox SET status = 'sending', attempts = attempts + 1, claim_token = %s,
+                       locked_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                   WHERE id IN (
+                       SELECT id FROM channel_outbox
+                       WHERE (status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+                          OR (status = 'sending' AND locked_until < CURRENT_TIMESTAMP)
+                       ORDER BY id
+                       LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING *;""",
+                (token, OUTBOX_LEASE, OUTBOX_BATCH_SIZE)
+            )
+
+    async def dispatch_batch(self) -> int:
+        """Надсилає один пакет записів з черги. Повертає кількість забраних записів."""
+        started = time.monotonic()
+        token = uuid.uuid4().hex
+        rows = await self._claim(token)
+        if not rows:
+            return 0
+        # Пости надсилаються по черзі, щоб у каналі вони з'являлися в порядку публікації модератором
+        rows = sorted(rows, key=lambda r: r['id'])
+        for index, row in enumerate(rows):
+            if self._stopping:
+                await self._release(rows[index:], token)
+                break
+            await self._send(row, token)
+        self._last_batch_ms = round((time.monotonic() - started) * 1000, 2)
+        return len(rows)
+
+    async def _send(self, row: dict, token: str):
+        payload = row['payload']
+        photo_file_ids = payload.get('photo_file_ids') or []
+        message_ids = list(row['message_ids'] or [])
+        try:
+            # Продовжуємо оренду перед надсиланням: якщо запис уже забрав інший процес, пропускаємо його
+            if not await self.database.execute(
+                """UPDATE channel_outbox SET locked_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                   WHERE id = %s AND claim_token = %s AND status = 'sending';""",
+                (OUTBOX_LEASE, row['id'], token)
+            ):
+                return
+            with bulk_sends():
+                if photo_file_ids:
+                    chunks = [photo_file_ids[i:i + MEDIA_GROUP_LIMIT] for i in range(0, len(photo_file_ids), MEDIA_GROUP_LIMIT)]
+                    for index in range(row['sent_chunks'], len(chunks)):
+                        media = [InputMediaPhoto(media=file_id) for file_id in chunks[index]]
+                        if index == 0:
+                            media[0].caption = payload['text']
+                            media[0].parse_mode = payload.get('parse_mode')
+                        sent = await self.bot.send_media_group(chat_id=row['chat_id'], media=media)
+                        message_ids += [message.message_id for message in sent]
+                        await self._record_progress(row['id'], index + 1, message_ids)
+                elif not message_ids:
+                    sent = await self.bot.send_message(chat_id=row['chat_id'], text=payload['text'], parse_mode=payload.get('parse_mode'))
+                    message_ids.append(sent.message_id)
+                    await self._record_progress(row['id'], 1, message_ids)
+        except Exception as e:
+            await self._retry_or_fail(row, e)
+            return
+        await self._complete(row, message_ids)
+
+    async def _release(self, rows: list, token: str):
+        """Повертає в чергу записи, які процес забрав, але не почав надсилати (зупинка процесу)."""
+        await self.database.execute(
+            """UPDATE channel_outbox SET status = 'pending', attempts = attempts - 1, claim_token = NULL, locked_until = NULL
+               WHERE id = ANY(%s::bigint[]) AND claim_token = %s AND status = 'sending';""",
+            ([row['id'] for row in rows], token)
+        )
+
+    async def _record_progress(self, outbox_id: int, sent_chunks: int, message_ids: list):
+        await self.database.execute(
+            "UPDATE channel_outbox SET sent_chunks = %s, message_ids = %s::bigint[] WHERE id = %s;",
+            (sent_chunks, message_ids, outbox_id)
+        )
+
+    async def _complete(self, row: dict, message_ids: list):
+        async with self.database.transaction() as session:
+            delay = await session.fetchval(
+                """UPDATE channel_outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, locked_until = NULL, last_error = NULL
+                   WHERE id = %s
+                   RETURNING EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at)::float;""",
+                (row['id'],)
+            )
+            await session.execute(
+                """UPDATE products SET channel_message_id = %s, published_at = CURRENT_TIMESTAMP
+                   WHERE id = %s AND status = 'published';""",
+                (message_ids[0], row['product_id'])
+            )
+        self._sent += 1
+        self._delay_total += delay or 0.0
+        self._delay_max = max(self._delay_max, delay or 0.0)
+        logging.info(f"✅ Товар {row['product_id']} опубліковано в каналі (повідомлення {message_ids[0]}).")
+        if self.on_sent is not None:
+            try:
+                await self.on_sent(row, message_ids)
+            except Exception as e:
+                logging.warning(f"⚠️ Помилка обробки успішної публікації товару {row['product_id']}: {e}")
+
+    async def _retry_or_fail(self, row: dict, error: Exception):
+        final = row['attempts'] >= OUTBOX_MAX_ATTEMPTS
+        async with self.database.transaction() as session:
+            if final:
+                await session.execute(
+                    "UPDATE channel_outbox SET status = 'failed', locked_until = NULL, last_error = %s WHERE id = %s;",
+                    (str(error), row['id'])
+                )
+                # Товар повертається на модерацію, щоб модератор міг опублікувати його повторно
+                await session.execute(
+                    "UPDATE products SET status = 'moderation' WHERE id = %s AND status = 'published';",
+                    (row['product_id'],)
+                )
+            else:
+                await session.execute(
+                    """UPDATE channel_outbox SET status = 'pending', locked_until = NULL, last_error = %s,
+                           next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                       WHERE id = %s;""",
+                    (str(error), OUTBOX_RETRY_DELAY * 2 ** (row['attempts'] - 1), row['id'])
+                )
+        if not final:
+            self._retried += 1
+            logging.warning(f"⚠️ Не вдалося опублікувати товар {row['product_id']} (спроба {row['attempts']}): {error}")
+            return
+        self._failed += 1
+        logging.error(f"❌ Публікацію товару {row['product_id']} скасовано після {row['attempts']} спроб: {error}")
+        if self.on_failed is not None:
+            try:
+                await self.on_failed(row, error)
+            except Exception as e:
+                logging.warning(f"⚠️ Помилка обробки невдалої публікації товару {row['product_id']}: {e}")
+
+    async def close(self, timeout: float = 10):
+        """
+        Зупиняє диспетчер: дає дописати пост, що надсилається зараз (не довше timeout секунд).
+        Решта записів залишається в черзі до наступного запуску.
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.wait({self._task}, timeout=timeout)
+        if not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def stats(self) -> dict:
+        sent = self._sent or 1
+        return {
+            "sent": self._sent,
+            "retried": self._retried,
+            "failed": self._failed,
+            "cancelled": self._cancelled,
+            "publish_delay_ms_avg": round(self._delay_total / sent * 1000, 2),
+            "publish_delay_ms_max": round(self._delay_max * 1000, 2),
+            "last_batch_ms": self._last_batch_ms,
+        }
@@ -0,0 +1,74 @@
+import re
+
+DEFAULT_CURRENCY = "UAH" # Валюта ціни, якщо в тексті її не вказано
+
+# Позначення валют у тексті ціни (у нижньому регістрі) → код ISO 4217
+CURRENCY_ALIASES = {
+    "грн": "UAH", "гривень": "UAH", "гривні": "UAH", "гривня": "UAH", "гривна": "UAH", "uah": "UAH", "₴": "UAH",
+    "usd": "USD", "$": "USD", "дол": "USD", "долар": "USD", "доларів": "USD", "долари": "USD", "у.о": "USD", "уо": "USD",
+    "eur": "EUR", "€": "EUR", "євро": "EUR", "евро": "EUR",
+}
+CURRENCY_SYMBOLS = {"UAH": "грн", "USD": "$", "EUR": "€"}
+MAX_AMOUNT_MINOR = 10 ** 15 # Більша сума — явно помилка введення (і не вміщається в BIGINT з запасом)
+
+# Ціна, про яку домовляються (сума не вказана)
+NEGOTIABLE_WORDS = ("договірна", "договірна ціна", "договорна", "торг", "обмін", "безкоштовно")
+
+# Множники: "15к", "1,5 тис"
+MULTIPLIERS = {"к": 1000, "k": 1000, "тис": 1000, "тисяч": 1000, "тисячі": 1000}
+
+# Число з можливими розділювачами тисяч (пробіл, нерозривний пробіл, апостроф, крапка, кома) та дробовою частиною
+NUMBER_PATTERN = re.compile(r"\d(?:[\d.,'’]|[ \u00a0\u202f](?=\d))*\d|\d")
+CURRENCY_PATTERN = re.compile("|".join(re.escape(alias) for alias in sorted(CURRENCY_ALIASES, key=len, reverse=True)))
+MULTIPLIER_PATTERN = re.compile(r"\s*(тисячі|тисяч|тис|к|k)(?![a-zа-яіїєґ])")
+
+
+def _parse_number(text: str) -> float:
+    """"1 500" → 1500, "1,500" → 1500, "12,5" → 12.5, "1.500,50" → 1500.5, "1.500.000" → 1500000."""
+    text = re.sub(r"[ \u00a0\u202f'’]", "", text)
+    separators = [char for char in text if char in ".,"]
+    if not separators:
+        return float(text)
+    last = text.rfind(separators[-1])
+    fraction = text[last + 1:]
+    # Останній розділювач — дробовий, якщо він один такий і після нього не рівно три цифри
+    # (або перед ним був розділювач іншого виду: "1.500,50")
+    if text.count(separators[-1]) == 1 and (len(fraction) != 3 or len(set(separators)) == 2 or text.startswith("0")):
+        return float(re.sub(r"[.,]", "", text[:last]) + "." + fraction)
+    return float(re.sub(r"[.,]", "", text))
+
+
+def parse_price(text: str):
+    """
+    Розбирає ціну, введену користувачем: "1 500 грн", "20$", "$20", "15к", "1,5 тис грн", "договірна".
+    Повертає (amount_minor, currency) — сума в копійках/центах і код валюти; (None, None) для договірної ціни;
+    None, якщо ціну не вдалося розпізнати.
+    """
+    normalized = (text or "").strip().lower()
+    if not normalized:
+        return None
+    match = NUMBER_PATTERN.search(normalized)
+    if match is None:
+        return (None, None) if any(word in normalized for word in NEGOTIABLE_WORDS) else None
+
+    amount = _parse_number(match.group(0))
+    multiplier = MULTIPLIER_PATTERN.match(normalized, match.end())
+    if multiplier:
+        amount *= MULTIPLIERS[multiplier.group(1)]
+    if amount * 100 > MAX_AMOUNT_MINOR:
+        return None
+    currency = CURRENCY_PATTERN.search(normalized)
+    return round(amount * 100), CURRENCY_ALIASES[currency.group(0)] if currency else DEFAULT_CURRENCY
+
+
+def parse_currency(text: str):
+    """Код валюти за її позначенням ("грн", "$", "usd") або None."""
+    currency = CURRENCY_PATTERN.search((text or "").lower())
+    return CURRENCY_ALIASES[currency.group(0)] if currency else None
+
+
+def format_amount(amount_minor: int, currency: str) -> str:
+    """Сума в мінорних одиницях для показу: 150050, "UAH" → "1 500.50 грн"."""
+    amount = f"{amount_minor / 100:,.2f}".replace(",", " ").removesuffix(".00")
+    symbol = CURRENCY_SYMBOLS.get(currency, currency)
+    return f"{symbol}{amount}" if symbol == "$" else f"{amount} {symbol}"
@@ -0,0 +1,198 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from cache import TTLCache
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30)) # Повідомлень на секунду для всього бота
+TG_PRIVATE_CHAT_RATE = float(os.getenv("TG_PRIVATE_CHAT_RATE", 1)) # Повідомлень на секунду в одному приватному чаті
+TG_GROUP_CHAT_RATE = float(os.getenv("TG_GROUP_CHAT_RATE", 20)) / 60 # Повідомлень на секунду в групі/каналі (20 на хвилину)
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3)) # Скільки разів повторювати запит після 429 RetryAfter
+
+# Пріоритети: менше число — раніше отримує бюджет
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Методи, на які поширюються ліміти Telegram на надсилання повідомлень
+RATE_LIMITED_PREFIXES = ("send", "copy", "forward", "edit", "delete")
+
+# Явний пріоритет для поточної задачі (наприклад, фонові розсилки); None — визначається за чатом
+_send_priority = ContextVar("send_priority", default=None)
+
+
+@contextmanager
+def bulk_sends():
+    """Позначає всі запити до Telegram у цьому блоці як масові (нижчий пріоритет)."""
+    token = _send_priority.set(PRIORITY_BULK)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+class ChatBucket:
+    """Відро токенів з резервуванням: кожен запит отримує свій момент відправки в порядку черги."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.next_free = 0.0 # Момент, починаючи з якого бюджет чату знову доступний
+        self.paused_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        """Резервує один слот і повертає, скільки секунд треба зачекати."""
+        earliest = max(self.next_free, now - (self.burst - 1) / self.rate, self.paused_until)
+        self.next_free = earliest + 1 / self.rate
+        return max(0.0, earliest - now)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class PriorityTokenBucket:
+    """Глобальне відро токенів: коли бюджету не вистачає, запити обслуговуються за пріоритетом."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._pump_task = None
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, cost: float, priority: int):
+        self._refill()
+        if not self._waiters and self.tokens >= cost and time.monotonic() >= self.paused_until:
+            self.tokens -= cost
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), min(cost, self.burst), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        while self._waiters:
+            priority, sequence, cost, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            self._refill()
+            delay = max(self.paused_until - time.monotonic(), (cost - self.tokens) / self.rate)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._waiters)
+            self.tokens -= cost
+            future.set_result(None)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+
+class RateLimiterMiddleware(BaseRequestMiddleware):
+    """
+    Планувальник вихідних запитів до Telegram (middleware сесії бота).
+
+    - Загальний бюджет бота (~30 повідомлень/с) і окремі бюджети для кожного чату та каналу.
+    - Відповіді в приватних чатах мають пріоритет над масовими відправками (канали, групи, bulk_sends()).
+    - При 429 RetryAfter чекає вказаний Telegram час і повторює запит автоматично.
+    """
+
+    def __init__(self):
+        self.global_bucket = PriorityTokenBucket(TG_GLOBAL_RATE)
+        self.chat_buckets = TTLCache(maxsize=50000, ttl=600)
+        self._requests = 0
+        self._retries = 0
+        self._failed = 0
+        self._latency = {PRIORITY_INTERACTIVE: [0, 0.0, 0.0], PRIORITY_BULK: [0, 0.0, 0.0]} # кількість, сума, максимум
+
+    @staticmethod
+    def _is_private(chat_id) -> bool:
+        return isinstance(chat_id, int) and chat_id > 0
+
+    def _chat_bucket(self, chat_id) -> ChatBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if self._is_private(chat_id):
+                bucket = ChatBucket(TG_PRIVATE_CHAT_RATE, burst=3)
+            else:
+                bucket = ChatBucket(TG_GROUP_CHAT_RATE, burst=5)
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _wait_for_budget(self, method, chat_id, priority: int):
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+        # Медіагрупа — це кілька повідомлень у загальному бюджеті
+        cost = len(getattr(method, 'media', None) or [None])
+        await self.global_bucket.acquire(cost, priority)
+
+    def _record_latency(self, priority: int, latency: float):
+        stats = self._latency[priority]
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+
+    async def __call__(self, make_request, bot, method):
+        if not type(method).__api_method__.startswith(RATE_LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, 'chat_id', None)
+        priority = _send_priority.get()
+        if priority is None:
+            priority = PRIORITY_INTERACTIVE if chat_id is None or self._is_private(chat_id) else PRIORITY_BULK
+
+        self._requests += 1
+        for attempt in range(TG_MAX_RETRIES + 1):
+            queued_at = time.monotonic()
+            await self._wait_for_budget(method, chat_id, priority)
+            self._record_latency(priority, time.monotonic() - queued_at)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == TG_MAX_RETRIES:
+                    self._failed += 1
+                    raise
+                self._retries += 1
+                logging.warning(f"⚠️ Flood control Telegram: чекаємо {e.retry_after} с перед повтором {type(method).__name__}.")
+                # Пауза для чату, куди надсилали; для запитів без чату — для всього бота
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    self.global_bucket.pause(e.retry_after)
+
+    def stats(self) -> dict:
+        latency = {}
+        for priority, name in ((PRIORITY_INTERACTIVE, "interactive"), (PRIORITY_BULK, "bulk")):
+            count, total, maximum = self._latency[priority]
+            latency[f"{name}_queue_ms_avg"] = round(total / (count or 1) * 1000, 2)
+            latency[f"{name}_queue_ms_max"] = round(maximum * 1000, 2)
+        return {
+            "requests": self._requests,
+            "waiting_global": self.global_bucket.waiting,
+            "retries_after_429": self._retries,
+            "failed_after_retries": self._failed,
+            **latency,
+        }
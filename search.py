@@ -0,0 +1,130 @@
+import re
+
+from cache import TTLCache
+from prices import DEFAULT_CURRENCY, parse_currency
+
+SEARCH_CONFIG = "simple" # Конфігурація повнотекстового пошуку PostgreSQL (українського словника в стандартній поставці немає)
+
+# Апострофи, які прибираються і в документі (див. міграцію 7), і в запиті: "м'який" == "мʼякий" == "мякий"
+APOSTROPHES = "'’ʼ`"
+
+# Закінчення іменників і прикметників, що відкидаються з кінця слова запиту (від найдовших).
+# Решта слова шукається як префікс (":*"), тому "телефони" знаходить "телефон", "телефона", "телефонів".
+UKRAINIAN_ENDINGS = sorted([
+    "ами", "ями", "ові", "еві", "єві", "ого", "ому", "ими", "іми", "ій", "ий", "ої", "ою", "ею", "єю",
+    "их", "им", "ів", "їв", "ах", "ях", "ам", "ям", "ом", "ем", "єм", "ок",
+    "а", "я", "у", "ю", "е", "є", "о", "и", "і", "ї", "ь",
+], key=len, reverse=True)
+MIN_STEM_LENGTH = 3 # Коротша основа дає забагато збігів, тому слово лишається як є
+
+# Фасети в тексті запиту: "ціна:100-500", "ціна:10-50$", "доставка:нова пошта", "місто:київ"
+FACET_ALIASES = {
+    "ціна": "price", "price": "price",
+    "доставка": "delivery", "delivery": "delivery",
+    "місто": "location", "локація": "location", "location": "location",
+}
+FACET_PATTERN = re.compile(r"(\w+):(\"[^\"]*\"|\S+)")
+PRICE_RANGE_PATTERN = re.compile(r"^(\d+(?:[.,]\d+)?)?-?(\d+(?:[.,]\d+)?)?(\D*)$")
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+
+def normalize_text(text: str) -> str:
+    """Нижній регістр без апострофів — так само, як текст індексується в БД."""
+    return text.lower().translate(str.maketrans("", "", APOSTROPHES))
+
+
+def stem_word(word: str) -> str:
+    """Легкий стемер для української: відкидає типове закінчення, якщо лишається достатньо довга основа."""
+    for ending in UKRAINIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def parse_search_query(text: str) -> dict:
+    """
+    Розбирає пошуковий запит на слова та фасети.
+    Повертає {'terms', 'tsquery', 'min_price', 'max_price', 'currency', 'delivery', 'location'};
+    tsquery — рядок для to_tsquery (основи слів з префіксним збігом, через AND) або None.
+    """
+    query = {"terms": [], "tsquery": None, "min_price": None, "max_price": None, "currency": DEFAULT_CURRENCY, "delivery": None, "location": None}
+    text = normalize_text(text or "")
+
+    def take_facet(match):
+        facet = FACET_ALIASES.get(match.group(1))
+        if facet is None:
+            return match.group(0)
+        value = match.group(2).strip('"').strip()
+        if facet == "price":
+            price_range = PRICE_RANGE_PATTERN.match(value)
+            if price_range and (price_range.group(1) or price_range.group(2)):
+                low, high, currency = price_range.groups()
+                query["currency"] = parse_currency(currency) or DEFAULT_CURRENCY
+                if "-" not in value:
+                    high = low # "ціна:500" — точна ціна
+                query["min_price"] = float(low.replace(",", ".")) if low else None
+                query["max_price"] = float(high.replace(",", ".")) if high else None
+        elif value:
+            query[facet] = value
+        return " "
+
+    text = FACET_PATTERN.sub(take_facet, text)
+    query["terms"] = WORD_PATTERN.findall(text)
+    if query["terms"]:
+        query["tsquery"] = " & ".join(f"{stem_word(term)}:*" for term in query["terms"])
+    return query
+
+
+def search_cache_key(query: dict, offset: int = 0) -> tuple:
+    """Ключ кешу результатів: однакові за змістом запити ("Телефони", "телефони ") мають один ключ."""
+    return (query["tsquery"], query["min_price"], query["max_price"], query["currency"], query["delivery"], query["location"], offset)
+
+
+def matches_query(query: dict, product: dict) -> bool:
+    """Чи відповідає товар словам запиту — те саме правило, що й to_tsquery з префіксами, але в Python."""
+    words = WORD_PATTERN.findall(normalize_text(f"{product['name']} {product['description']}"))
+    return all(any(word.startswith(stem_word(term)) for word in words) for term in query["terms"])
+
+
+class PrefixResultCache:
+    """
+    LRU-кеш результатів інлайн-пошуку за текстом запиту.
+
+    Інлайн-запити приходять на кожне натискання клавіші: "т", "те", "тел", "теле"...
+    Якщо для коротшого префікса з тими самими фасетами вже збережено ПОВНИЙ список збігів,
+    результати довшого запиту — його підмножина, тож вони фільтруються в пам'яті без запиту до БД.
+    """
+
+    def __init__(self, maxsize: int = 5000, ttl: float = 60.0):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(normalize_text(text or "").split())
+
+    def get(self, text: str, query: dict):
+        """Повертає (товари, чи повний список) або None, якщо запит доведеться виконати в БД."""
+        entry = self._cache.get(text)
+        if entry is not None:
+            self.hits += 1
+            return entry[0], entry[1]
+        facets = search_cache_key(query)[1:]
+        for end in range(len(text) - 1, -1, -1):
+            entry = self._cache.get(text[:end])
+            if entry is None or not entry[1] or entry[2] != facets:
+                continue
+            products = [product for product in entry[0] if matches_query(query, product)]
+            self._cache.set(text, (products, True, facets))
+            self.prefix_hits += 1
+            return products, True
+        self.misses += 1
+        return None
+
+    def set(self, text: str, query: dict, products: list, complete: bool):
+        self._cache.set(text, (products, complete, search_cache_key(query)[1:]))
+
+    def stats(self) -> dict:
+        return {"size": len(self._cache), "hits": self.hits, "prefix_hits": self.prefix_hits, "misses": self.misses}
@@ -0,0 +1,33 @@
+import os
+
+os.environ.setdefault("BOT_TOKEN", "1:test")
+
+import app
+
+
+def make_product(description: str, photo_file_id="photo") -> dict:
+    return {
+        "id": 1, "user_id": 42, "username": "seller", "name": "Телефон", "price": "1000 грн",
+        "description": description, "delivery": "Нова пошта", "location": "Київ",
+        "channel_message_id": None, "photo_file_id": photo_file_id,
+    }
+
+
+def test_short_caption_is_unchanged():
+    product = make_product("Майже новий")
+    assert app.build_inline_result(product).caption == app.format_channel_caption(product)
+
+
+def test_oversized_description_is_truncated():
+    # Емодзі — дві одиниці UTF-16, "<" після екранування — чотири символи
+    description = "Опис <з> розміткою 📱 " * 400
+    photo = app.build_inline_result(make_product(description))
+    article = app.build_inline_result(make_product(description, photo_file_id=None))
+
+    assert app.telegram_length(photo.caption) <= app.INLINE_CAPTION_LIMIT
+    assert app.telegram_length(article.input_message_content.message_text) <= app.INLINE_MESSAGE_LIMIT
+    assert "…" in photo.caption
+    assert app.telegram_length(photo.caption) > app.INLINE_CAPTION_LIMIT - 10 # Обрізано лише стільки, скільки потрібно
+    # Решта підпису не постраждала
+    assert "🚚 Доставка: Нова пошта" in photo.caption
+    assert photo.caption.endswith("👤 Продавець: @seller")
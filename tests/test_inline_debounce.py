@@ -0,0 +1,48 @@
+import os
+import asyncio
+
+os.environ.setdefault("BOT_TOKEN", "1:test")
+
+from aiogram.types import InlineQuery, Update, User
+
+import app
+from update_scheduler import INLINE_DEBOUNCE, UpdateScheduler
+
+
+def make_inline_update(update_id: int, text: str) -> Update:
+    return Update(
+        update_id=update_id,
+        inline_query=InlineQuery(id=str(update_id), from_user=User(id=42, is_bot=False, first_name="u"), query=text, offset=""),
+    )
+
+
+def test_inline_burst_hits_database_once(monkeypatch):
+    searches, answers = [], []
+
+    async def fake_search(query, offset=0, limit=app.SEARCH_PAGE_SIZE, with_facets=False):
+        searches.append(query["terms"])
+        return [], False, None
+
+    async def fake_answer(self, results, **kwargs):
+        answers.append(self.query)
+
+    monkeypatch.setattr(app, "get_search_results", fake_search)
+    monkeypatch.setattr(InlineQuery, "answer", fake_answer)
+    app.inline_results._cache.clear()
+
+    async def burst():
+        scheduler = UpdateScheduler(app.dp, app.bot)
+        started = asyncio.get_running_loop().time()
+        for update_id, text in enumerate(["т", "те", "тел", "теле"], start=1):
+            await scheduler.submit(make_inline_update(update_id, text))
+            await asyncio.sleep(INLINE_DEBOUNCE / 6)
+        await scheduler.close()
+        return asyncio.get_running_loop().time() - started, scheduler.stats()
+
+    elapsed, stats = asyncio.run(burst())
+
+    assert searches == [["теле"]]
+    assert answers == ["теле"]
+    assert stats["inline_debounced"] == 3
+    # Останній запит чекає лише один інтервал дебаунсу, а не по одному на кожне натискання
+    assert elapsed < INLINE_DEBOUNCE * 2
@@ -0,0 +1,205 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from aiohttp import web
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+from media_groups import MediaGroupCollector
+
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 20)) # Скільки оновлень (з різних чатів) обробляються одночасно
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", 500)) # Скільки прийнятих, але ще не оброблених оновлень допускаємо
+UPDATE_BACKPRESSURE_TIMEOUT = float(os.getenv("UPDATE_BACKPRESSURE_TIMEOUT", 5)) # Скільки webhook-запит чекає на місце в черзі
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", 0.3)) # Скільки секунд інлайн-запит чекає наступного натискання клавіші, перш ніж піти в обробку
+
+
+class SchedulerBusyError(Exception):
+    """Черга оновлень заповнена, оновлення не прийнято."""
+
+
+class UpdateScheduler:
+    """
+    Планувальник оновлень перед диспетчером.
+
+    - Оновлення одного чату обробляються строго по черзі, в порядку надходження
+      (крім інлайн-запитів — кожен з них обробляється окремо).
+    - Різні чати обробляються паралельно, але не більше ніж max_concurrency одночасно.
+    - Якщо прийнято max_pending оновлень, нові webhook-запити чекають на місце (зворотний тиск),
+      а після таймауту отримують 503, і Telegram надішле оновлення повторно пізніше.
+    - Частини альбому (media_group_id) збираються в одне оновлення з параметром album.
+    - Інлайн-запит (перша сторінка) чекає inline_debounce секунд і відкидається, якщо за цей час
+      той самий користувач надіслав новіший: поки текст набирається, до обробника доходить лише останній.
+    """
+
+    def __init__(self, dispatcher, bot, max_concurrency: int = UPDATE_CONCURRENCY, max_pending: int = UPDATE_QUEUE_LIMIT,
+                 inline_debounce: float = INLINE_DEBOUNCE, **data):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.data = data
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.inline_debounce = inline_debounce
+        self._workers = asyncio.Semaphore(max_concurrency)
+        self._capacity = asyncio.Semaphore(max_pending)
+        self._queues = {}
+        self._tasks = set()
+        self.media_groups = MediaGroupCollector(self._enqueue_album)
+        self._inline_latest = {} # користувач → update_id його останнього інлайн-запиту
+        self._debounced = 0
+        self._pending = 0
+        self._running = 0
+        self._processed = 0
+        self._rejected = 0
+        self._wait_max = 0.0
+        self._wait_total = 0.0
+
+    @staticmethod
+    def chat_key(update: Update):
+        """Повертає ключ чату, в межах якого оновлення треба впорядкувати (None — оновлення обробляється окремо)."""
+        if update.inline_query is not None or update.chosen_inline_result is not None:
+            # Інлайн-запити не змінюють стан чату, а черговість по одному зламала б їхній дебаунс (INLINE_DEBOUNCE):
+            # наступне натискання клавіші має оброблятися, поки попередній запит ще чекає
+            return None
+        try:
+            event = update.event
+        except Exception:
+            return None
+        chat = getattr(event, 'chat', None)
+        if chat is None and getattr(event, 'message', None) is not None:
+            chat = event.message.chat
+        if chat is not None:
+            return chat.id
+        user = getattr(event, 'from_user', None)
+        return f"user:{user.id}" if user is not None else None
+
+    async def submit(self, update: Update, timeout: float = UPDATE_BACKPRESSURE_TIMEOUT):
+        """Ставить оновлення в чергу його чату. Чекає на місце, якщо черга заповнена."""
+        try:
+            await asyncio.wait_for(self._capacity.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self._rejected += 1
+            raise SchedulerBusyError("Черга оновлень заповнена.")
+        self._pending += 1
+        if update.inline_query is not None and not update.inline_query.offset and self.inline_debounce > 0:
+            self._debounce_inline(update)
+            return
+        key = self.chat_key(update) or f"update:{update.update_id}"
+        if self.media_groups.collect(key, update):
+            return
+        # Альбом, що ще збирається, має потрапити в чергу раніше за наступні оновлення чату
+        self.media_groups.flush_chat(key)
+        self.enqueue(key, update)
+
+    def _debounce_inline(self, update: Update):
+        self._inline_latest[update.inline_query.from_user.id] = update.update_id
+        task = asyncio.create_task(self._release_inline(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _release_inline(self, update: Update):
+        """Після паузи ставить інлайн-запит у чергу, якщо він досі останній від користувача, інакше відкидає."""
+        user_id = update.inline_query.from_user.id
+        await asyncio.sleep(self.inline_debounce)
+        if self._inline_latest.get(user_id) != update.update_id:
+            self._debounced += 1
+            self._pending -= 1
+            self._capacity.release()
+            return
+        del self._inline_latest[user_id]
+        self.enqueue(f"update:{update.update_id}", update)
+
+    def _enqueue_album(self, key, updates: list):
+        """Ставить зібраний альбом у чергу чату як одне оновлення."""
+        # Місця в черзі, зайняті рештою частин альбому, звільняємо одразу
+        for _ in updates[1:]:
+            self._pending -= 1
+            self._capacity.release()
+        carrier = next((u for u in updates if u.message.photo), updates[0])
+        self.enqueue(key, carrier, album=[u.message for u in updates])
+
+    def enqueue(self, key, update: Update, **kwargs):
+        """Додає оновлення в чергу чату (місце в черзі вже зайнято) і запускає її обробку, якщо потрібно."""
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            task = asyncio.create_task(self._drain(key, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append((time.monotonic(), update, kwargs))
+
+    async def _drain(self, key, queue: deque):
+        try:
+            while queue:
+                enqueued_at, update, kwargs = queue[0]
+                async with self._workers:
+                    wait = time.monotonic() - enqueued_at
+                    self._wait_total += wait
+                    self._wait_max = max(self._wait_max, wait)
+                    self._running += 1
+                    try:
+                        await self._process(update, kwargs)
+                    finally:
+                        self._running -= 1
+                        self._processed += 1
+                        self._pending -= 1
+                        queue.popleft()
+                        self._capacity.release()
+        finally:
+            self._queues.pop(key, None)
+
+    async def _process(self, update: Update, kwargs: dict):
+        try:
+            result = await self.dispatcher.feed_update(self.bot, update, **self.data, **kwargs)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+        except Exception as e:
+            logging.error(f"❌ Помилка обробки оновлення {update.update_id}: {e}")
+
+    async def close(self, timeout: float = 10):
+        """Передає в черги альбоми, що ще збираються, і чекає завершення вже прийнятих оновлень (не довше timeout секунд)."""
+        # Telegram уже отримав відповідь 200 на частини цих альбомів і повторно їх не надішле
+        self.media_groups.flush_all()
+        # Черги, що з'являються під час очікування (альбоми, інлайн-запити після паузи), теж дочікуємось
+        deadline = time.monotonic() + timeout
+        while self._tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.wait(set(self._tasks), timeout=remaining)
+
+    def stats(self) -> dict:
+        processed = self._processed or 1
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "running": self._running,
+            "chats_queued": len(self._queues),
+            "processed": self._processed,
+            "rejected": self._rejected,
+            "inline_debounced": self._debounced,
+            "queue_wait_ms_avg": round(self._wait_total / processed * 1000, 2),
+            "queue_wait_ms_max": round(self._wait_max * 1000, 2),
+            **self.media_groups.stats(),
+        }
+
+
+class ScheduledRequestHandler(SimpleRequestHandler):
+    """Webhook-обробник, що передає оновлення в UpdateScheduler замість прямого виклику диспетчера."""
+
+    def __init__(self, scheduler: UpdateScheduler, **kwargs):
+        super().__init__(dispatcher=scheduler.dispatcher, bot=scheduler.bot, **kwargs)
+        self.scheduler = scheduler
+
+    async def _handle_request_background(self, bot, request: web.Request) -> web.Response:
+        update = Update.model_validate(await request.json(loads=bot.session.json_loads), context={"bot": bot})
+        try:
+            await self.scheduler.submit(update)
+        except SchedulerBusyError:
+            logging.warning(f"⚠️ Черга оновлень заповнена, оновлення {update.update_id} буде отримано повторно.")
+            return web.Response(status=503, text="Too many pending updates")
+        return web.json_response({}, dumps=bot.session.json_dumps)
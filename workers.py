@@ -0,0 +1,104 @@
+import os
+import signal
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+from contextlib import asynccontextmanager
+
+from aiogram.fsm.storage.base import BaseEventIsolation, StorageKey
+
+from db import DB_POOL_MAX_SIZE
+
+# Кількість процесів, які одночасно обслуговують webhook (див. README, розділ про масштабування)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+
+# Простір ключів advisory-блокувань для ізоляції подій одного користувача в чаті
+EVENT_LOCK_NAMESPACE = 96
+
+
+class PostgresEventIsolation(BaseEventIsolation):
+    """
+    Ізоляція подій між процесами: оновлення одного користувача в одному чаті
+    обробляються по черзі, навіть якщо вони потрапили в різні процеси.
+
+    Поки обробник працює, тримаємо транзакційне advisory-блокування в PostgreSQL.
+    Після отримання блокування стан FSM перечитується в тій самій транзакції (його міг змінити інший процес),
+    а зміни стану записуються в ній же — до того, як блокування буде знято.
+    """
+
+    def __init__(self, database, storage, max_locks: int = None):
+        self.database = database
+        self.storage = storage
+        # Кожне блокування тримає з'єднання з пулу, тому обмежуємо їх кількість,
+        # щоб обробникам завжди залишались вільні з'єднання для власних запитів
+        self._slots = asyncio.Semaphore(max_locks or max(1, DB_POOL_MAX_SIZE // 2))
+        # Оновлення того самого користувача в цьому процесі чекають тут, а не займають з'єднання.
+        # Ключ → [блокування, скільки обробників його тримають або чекають]; запис видаляється, коли їх не лишилось
+        self._local_locks = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        entry = self._local_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                async with self.database.transaction() as session:
+                    await session.execute(
+                        "SELECT pg_advisory_xact_lock(%s, hashtext(%s));",
+                        (EVENT_LOCK_NAMESPACE, f"{key.bot_id}:{key.chat_id}:{key.user_id}")
+                    )
+                    await self.storage.refresh(key, session)
+                    try:
+                        yield
+                    finally:
+                        await self.storage.flush(key, session=session)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._local_locks[key]
+
+    async def close(self) -> None:
+        self._local_locks.clear()
+
+
+def run_workers(target, workers: int):
+    """
+    Запускає workers процесів, кожен з яких викликає target(worker_index)
+    і слухає той самий порт (SO_REUSEPORT). SIGTERM/SIGINT передаються всім процесам.
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=(i,), name=f"bot-worker-{i}") for i in range(workers)]
+    for process in processes:
+        process.start()
+    logging.info(f"🎉 Запущено {workers} процесів бота.")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        logging.info("ℹ️ Зупинка процесів бота...")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # Процес, що впав сам (наприклад, на міграціях), зупиняє решту, а головний процес завершується
+    # з ненульовим кодом, щоб платформа перезапустила сервіс, а не вважала його коректно зупиненим
+    failed = []
+    running = list(processes)
+    while running:
+        multiprocessing.connection.wait([process.sentinel for process in running])
+        for process in [process for process in running if not process.is_alive()]:
+            running.remove(process)
+            if process.exitcode and not stopping:
+                failed.append(process.name)
+        if failed and not stopping:
+            logging.error(f"❌ Процеси бота завершились з помилкою: {', '.join(failed)}")
+            stop(None, None)
+    for process in processes:
+        process.join()
+    if failed:
+        raise SystemExit(1)